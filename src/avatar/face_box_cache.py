@@ -0,0 +1,107 @@
+''' Stores the face boxes found in a video next to it, so lip syncing the same video again skips face detection '''
+from __future__ import annotations
+
+import json
+import logging
+import os
+import uuid
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+from utils.file_utils import FileUtils
+
+logger = logging.getLogger(__file__)
+
+
+class FaceBoxCache:
+    '''
+    Face boxes are kept in a '<video>.faceboxes.json' sidecar. A sidecar is used while the video's modification time and size
+    are unchanged; if they changed it is still used when the video's contents hash the same, otherwise it is stale.
+    '''
+    VERSION = 1
+    SUFFIX = ".faceboxes.json"
+
+    class JsonKeys:
+        VERSION = "version"
+        MTIME = "mtime"
+        SIZE = "size"
+        HASH = "hash"
+        PARAMS = "params"
+        BOXES = "boxes"
+
+    @classmethod
+    def sidecar_path(cls, video_path: Path) -> Path:
+        base, _ = os.path.splitext(video_path)
+        return Path(base + FaceBoxCache.SUFFIX)
+
+    @classmethod
+    def load(cls, video_path: Path, params: Dict[str, Any]) -> Optional[np.ndarray]:
+        '''
+        Returns the stored boxes for a video, or None if there are none for these parameters or the video has changed
+
+        Args:
+            video_path (Path): video the boxes were detected in
+            params (Dict[str, Any]): detection parameters (padding, smoothing, ...) the boxes must have been made with
+
+        Returns:
+            Optional[np.ndarray]: (frames, 4) array of x1, y1, x2, y2
+        '''
+        sidecar_path = FaceBoxCache.sidecar_path(video_path)
+        if not os.path.isfile(sidecar_path) or not os.path.isfile(video_path):
+            return None
+        try:
+            with open(sidecar_path, "r", encoding="utf8") as fhndl:
+                data = json.load(fhndl)
+            if data.get(FaceBoxCache.JsonKeys.VERSION) != FaceBoxCache.VERSION or data.get(FaceBoxCache.JsonKeys.PARAMS) != cls._canonical(params):
+                return None
+
+            stat = os.stat(video_path)
+            if data[FaceBoxCache.JsonKeys.MTIME] != stat.st_mtime or data[FaceBoxCache.JsonKeys.SIZE] != stat.st_size:
+                # Touched or copied, only stale if the contents changed
+                if data[FaceBoxCache.JsonKeys.HASH] != FileUtils.file_hash(video_path):
+                    logger.info(f"Face boxes for {video_path} are stale")
+                    return None
+                data[FaceBoxCache.JsonKeys.MTIME], data[FaceBoxCache.JsonKeys.SIZE] = stat.st_mtime, stat.st_size
+                cls._write(sidecar_path, data)
+            return np.array(data[FaceBoxCache.JsonKeys.BOXES], dtype=int).reshape(-1, 4)
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable face boxes {sidecar_path}: {e}")
+            return None
+
+    @classmethod
+    def save(cls, video_path: Path, params: Dict[str, Any], boxes: np.ndarray):
+        '''
+        Stores the boxes detected in a video
+
+        Args:
+            video_path (Path): video the boxes were detected in
+            params (Dict[str, Any]): detection parameters used
+            boxes (np.ndarray): (frames, 4) array of x1, y1, x2, y2
+        '''
+        stat = os.stat(video_path)
+        data = {FaceBoxCache.JsonKeys.VERSION: FaceBoxCache.VERSION,
+                FaceBoxCache.JsonKeys.MTIME: stat.st_mtime,
+                FaceBoxCache.JsonKeys.SIZE: stat.st_size,
+                FaceBoxCache.JsonKeys.HASH: FileUtils.file_hash(video_path),
+                FaceBoxCache.JsonKeys.PARAMS: cls._canonical(params),
+                FaceBoxCache.JsonKeys.BOXES: np.asarray(boxes, dtype=int).tolist()}
+        cls._write(FaceBoxCache.sidecar_path(video_path), data)
+
+    @classmethod
+    def _canonical(cls, params: Dict[str, Any]) -> Dict[str, Any]:
+        ''' Returns params as they read back from JSON, so stored and requested parameters compare equal '''
+        return json.loads(json.dumps(params, sort_keys=True))
+
+    @classmethod
+    def _write(cls, path: Path, data: Dict[str, Any]):
+        scratch_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}")
+        try:
+            with open(scratch_path, "w", encoding="utf8") as fhndl:
+                json.dump(data, fhndl)
+            os.replace(scratch_path, path)
+        except Exception as e:
+            logger.warning(f"Failed to save face boxes {path}: {e}")
+            if os.path.isfile(scratch_path):
+                os.remove(scratch_path)
@@ -0,0 +1,157 @@
+''' On-disk cache of decoded video frames, shared between renders through memory mapping '''
+from __future__ import annotations
+
+import json
+import logging
+import os
+import uuid
+from pathlib import Path
+from threading import Lock
+from typing import Any, Callable, Dict, Tuple
+
+import numpy as np
+
+from utils.file_utils import FileUtils
+
+logger = logging.getLogger(__file__)
+
+
+class FrameCache:
+    '''
+    Stores arrays made from a video (its decoded frames, its face crops) as raw .npy files keyed by the video's content hash,
+    and hands them out memory mapped read-only. Renders of the same video, including concurrent ones, then share one copy
+    through the OS page cache instead of each decoding the video into RAM. Least recently used entries beyond max_bytes are removed.
+    '''
+    class Filenames:
+        ARRAY = "{name}.npy"
+        META = "{name}.json"
+
+    def __init__(self, cache_dir: Path, max_bytes: int = 8 << 30):
+        '''
+        Initialize a FrameCache
+
+        Args:
+            cache_dir (Path): directory to store arrays in, should be on a local disk
+            max_bytes (int, optional): total size of arrays to keep
+        '''
+        self._cache_dir: Path = Path(cache_dir)
+        self._max_bytes: int = max_bytes
+        self._lock: Lock = Lock()
+        self._entry_locks: Dict[str, Lock] = {}
+        self._hashes: Dict[Tuple[str, float, int], str] = {}
+
+    @property
+    def cache_dir(self) -> Path:
+        return self._cache_dir
+
+    @property
+    def max_bytes(self) -> int:
+        return self._max_bytes
+
+    def video_key(self, video_path: Path) -> str:
+        ''' Returns the content hash of a video, only re-reading it if its modification time or size changed '''
+        stat = os.stat(video_path)
+        stat_key = (os.path.abspath(video_path), stat.st_mtime, stat.st_size)
+        with self._lock:
+            video_hash = self._hashes.get(stat_key)
+        if video_hash is None:
+            video_hash = FileUtils.file_hash(video_path)
+            with self._lock:
+                self._hashes[stat_key] = video_hash
+        return video_hash
+
+    def get_frames(self, video_path: Path, tag: str, decoder: Callable[[], Tuple[np.ndarray, float]]) -> Tuple[np.ndarray, float]:
+        '''
+        Returns a video's decoded frames, decoding and storing them on a miss
+
+        Args:
+            video_path (Path): video file
+            tag (str): distinguishes different decodings of the same video, eg resize factor
+            decoder (Callable[[], Tuple[np.ndarray, float]]): returns the (frames, height, width, 3) frames and their rate
+
+        Returns:
+            Tuple[np.ndarray, float]: read-only memory mapped frames and their rate
+        '''
+        def make() -> Tuple[np.ndarray, Dict[str, Any]]:
+            frames, fps = decoder()
+            return np.asarray(frames), {"fps": fps}
+        frames, meta = self._get(f"{self.video_key(video_path)}.frames.{tag}", make)
+        return frames, meta["fps"]
+
+    def get_crops(self, video_path: Path, tag: str, cropper: Callable[[], np.ndarray]) -> np.ndarray:
+        '''
+        Returns a video's face crops, making and storing them on a miss
+
+        Args:
+            video_path (Path): video file
+            tag (str): identifies the boxes and crop size used
+            cropper (Callable[[], np.ndarray]): returns the (frames, size, size, 3) crops
+
+        Returns:
+            np.ndarray: read-only memory mapped crops
+        '''
+        crops, _ = self._get(f"{self.video_key(video_path)}.crops.{tag}", lambda: (np.asarray(cropper()), {}))
+        return crops
+
+    def _get(self, name: str, make: Callable[[], Tuple[np.ndarray, Dict[str, Any]]]) -> Tuple[np.ndarray, Dict[str, Any]]:
+        array_path = self._cache_dir / FrameCache.Filenames.ARRAY.format(name=name)
+        meta_path = self._cache_dir / FrameCache.Filenames.META.format(name=name)
+
+        # One job makes an entry while the others wait to map it
+        with self._lock:
+            entry_lock = self._entry_locks.setdefault(name, Lock())
+        with entry_lock:
+            if os.path.isfile(meta_path) and os.path.isfile(array_path):
+                try:
+                    with open(meta_path, "r", encoding="utf8") as fhndl:
+                        meta = json.load(fhndl)
+                    array = np.load(array_path, mmap_mode="r")
+                    os.utime(array_path)
+                    return array, meta
+                except Exception as e:
+                    logger.warning(f"Ignoring unreadable frame cache entry {array_path}: {e}")
+
+            array, meta = make()
+            self._put(array_path, meta_path, array, meta)
+            array = np.load(array_path, mmap_mode="r")
+        self._evict(keep=array_path)
+        return array, meta
+
+    def _put(self, array_path: Path, meta_path: Path, array: np.ndarray, meta: Dict[str, Any]):
+        ''' Writes an entry. The metadata is written last, so an entry without it is incomplete '''
+        os.makedirs(self._cache_dir, exist_ok=True)
+        scratch_path = array_path.with_name(f".{array_path.name}.{uuid.uuid4().hex}")
+        try:
+            mapped = np.lib.format.open_memmap(scratch_path, mode="w+", dtype=array.dtype, shape=array.shape)
+            mapped[:] = array
+            mapped.flush()
+            del mapped
+            os.replace(scratch_path, array_path)
+            with open(scratch_path, "w", encoding="utf8") as fhndl:
+                json.dump(meta, fhndl)
+            os.replace(scratch_path, meta_path)
+        finally:
+            if os.path.isfile(scratch_path):
+                os.remove(scratch_path)
+
+    def _evict(self, keep: Path):
+        ''' Removes the least recently used entries, other than keep, until the arrays fit in max_bytes '''
+        with self._lock:
+            arrays = []
+            for entry in os.scandir(self._cache_dir):
+                if entry.name.endswith(".npy") and not entry.name.startswith("."):
+                    stat = entry.stat()
+                    arrays.append((stat.st_mtime, stat.st_size, Path(entry.path)))
+            total = sum(size for _, size, _ in arrays)
+            for _, size, array_path in sorted(arrays):
+                if total <= self._max_bytes:
+                    break
+                if array_path == keep:
+                    continue
+                # Renders still mapping the file keep their pages until they are done
+                name = array_path.name[:-len(".npy")]
+                for path in [array_path, self._cache_dir / FrameCache.Filenames.META.format(name=name)]:
+                    if os.path.isfile(path):
+                        os.remove(path)
+                total -= size
+                logger.info(f"Evicted {name} from the frame cache")
@@ -1,13 +1,27 @@
 ''' Handles running Wav2Lip on an Avatar '''
 from avatar.profile import Profile
+from concurrent.futures import Future
 from pathlib import Path
-from typing import List
+from typing import Any, Dict, List, Optional, Tuple
+from utils.audio_utils import get_audio_duration
+from utils.file_utils import FileUtils
 from utils.shared import Shared
-from wav2lip.wav2lip.inference import main, parseArgs
+from utils.single_flight import SingleFlight
+from utils.tts_chunker import TtsChunker
+from utils.video_io import VideoWriter
+from avatar.frame_cache import FrameCache
+from avatar.lip_sync_store import LipSyncStore
+from avatar.lip_sync_stream import LipSyncStream
+from avatar.video_info import VideoInfo
+from avatar.wav2lip_onnx import Wav2LipOnnx
+from avatar.wav2lip_worker import Wav2LipWorker
+import dataclasses
 import os
+import shutil
 import subprocess
 import logging
 import gdown
+from threading import Lock, Thread
 
 logger = logging.getLogger(__file__)
 
@@ -16,23 +30,204 @@ class LipSync:
     # Taken from https://github.com/eyaler/avatars4all
     URL = "https://drive.google.com/uc?id=1dwHujX7RVNCvdR1RR93z0FS2T2yzqup9"
     CHECKPOINT = os.path.join(Shared.getInstance().data_dir, "wav2lip", "wav2lip_gan.pth")
+    # Exported from CHECKPOINT for the onnxruntime modes
+    ONNX_MODEL = os.path.join(Shared.getInstance().data_dir, "wav2lip", "wav2lip_gan.onnx")
+    ONNX_INT8_MODEL = os.path.join(Shared.getInstance().data_dir, "wav2lip", "wav2lip_gan.int8.onnx")
+    MODES = ["torch", "onnx", "onnx-int8"]
+    _frame_cache: Optional[FrameCache] = None
+    _store: Optional[LipSyncStore] = None
+    # Identical renders in flight at the same time share one job
+    _flights: SingleFlight = SingleFlight(name="LipSync")
+    _export_lock: Lock = Lock()
 
     @classmethod
-    def render(cls, input_image_or_video: Path, input_audio: Path, output_path: Path):
+    def render(cls, input_image_or_video: Path, input_audio: Path, output_path: Path) -> Wav2LipWorker.Result:
         '''
-        Render lipsync to output file
+        Render lipsync to output file. A render of the same speech on the same face with the same settings is served
+        from the store, or joined if it is still rendering. Only the frames of the face video the speech needs are used
 
         Args:
             output_path (Path): output path
+
+        Returns:
+            Wav2LipWorker.Result: frame count and per-stage timings (of the render it was served from)
+        '''
+        return cls._render_stored(face_path=input_image_or_video, audio_path=input_audio, output_path=output_path,
+                                  settings=cls.get_settings(), frame_range=cls._fit_frames(input_image_or_video, get_audio_duration(input_audio)))
+
+    @classmethod
+    def _render_stored(cls, face_path: Path, audio_path: Path, output_path: Path, settings: Wav2LipWorker.Settings,
+                       start_frame: int = 0, hls_dir: Path = None, frame_range: Optional[Tuple[int, int]] = None) -> Wav2LipWorker.Result:
+        ''' Same as Wav2LipWorker.render, but served from the store or joined to an identical render in flight when possible '''
+        store = cls._get_store()
+        if store is None:
+            return cls.get_worker().render(face_path=face_path, audio_path=audio_path, output_path=output_path, settings=settings,
+                                           start_frame=start_frame, hls_dir=hls_dir, frame_range=frame_range)
+
+        key = store.make_key(face_path, audio_path, cls._store_params(settings, start_frame, frame_range))
+        for attempt in range(2):
+            stored: Wav2LipWorker.Result = LipSync._flights.submit(
+                key, lambda: cls._submit_to_store(store, key, face_path, audio_path, settings, start_frame, hls_dir, frame_range)).result()
+            try:
+                FileUtils.link_or_copy(stored.output_path, output_path)
+                break
+            except FileNotFoundError:
+                # Evicted by another render before it could be linked, it is no longer in the store so this renders it
+                if attempt > 0:
+                    raise
+                logger.info(f"Lip sync store entry [{key}] was evicted, rendering it again")
+        if hls_dir is not None and not os.path.isfile(os.path.join(hls_dir, VideoWriter.Filenames.PLAYLIST)):
+            # Served from the store, or joined to a render writing its own playlist
+            VideoWriter.write_hls(output_path, hls_dir, settings=settings.encode)
+        return Wav2LipWorker.Result(output_path=Path(output_path), frame_cnt=stored.frame_cnt, timings=stored.timings)
+
+    @classmethod
+    def _submit_to_store(cls, store: LipSyncStore, key: str, face_path: Path, audio_path: Path, settings: Wav2LipWorker.Settings,
+                         start_frame: int = 0, hls_dir: Path = None, frame_range: Optional[Tuple[int, int]] = None) -> Future:
+        ''' Returns a Future resolving to the stored video, rendering it first if it is not in the store '''
+        future = Future()
+        entry = store.get(key)
+        if entry is not None:
+            logger.info(f"Lip sync store hit [{key}]")
+            future.set_result(Wav2LipWorker.Result(output_path=entry.video_path, frame_cnt=entry.frame_cnt))
+            return future
+
+        def store_result(done: Future):
+            try:
+                result: Wav2LipWorker.Result = done.result()
+                entry = store.put(key, result.output_path, result.frame_cnt)
+                if entry is not None:
+                    os.remove(result.output_path)
+                    result.output_path = entry.video_path
+                else:
+                    # Every render joined to this one links it, so move it to the temp dir rather than leave it in the store
+                    result.output_path = Path(shutil.move(result.output_path, f"{Shared.getInstance().unique_file_prefix}_synced_video.mp4"))
+                future.set_result(result)
+            except Exception as e:
+                future.set_exception(e)
+        cls.get_worker().submit(face_path=face_path, audio_path=audio_path, output_path=store.scratch_path(key), settings=settings,
+                                start_frame=start_frame, hls_dir=hls_dir, frame_range=frame_range).add_done_callback(store_result)
+        return future
+
+    @classmethod
+    def _store_params(cls, settings: Wav2LipWorker.Settings, start_frame: int = 0, frame_range: Optional[Tuple[int, int]] = None) -> Dict[str, Any]:
+        ''' Returns what changes the rendered video: the model, the render settings and the face video frames used '''
+        params = dataclasses.asdict(settings)
+        # These change how the video is rendered, not what is in it
+        for name in ["segments", "min_segment_seconds"]:
+            params.pop(name, None)
+        params["model"] = [os.path.basename(LipSync.CHECKPOINT), Shared.getInstance().args.lipsync_mode]
+        params["frame_range"] = list(frame_range) if frame_range is not None else None
+        params["start_frame"] = start_frame
+        return params
+
+    @classmethod
+    def _fit_frames(cls, input_image_or_video: Path, duration: Optional[float]) -> Optional[Tuple[int, int]]:
         '''
+        Returns the frames of the face video to lip sync speech of a given length over, see VideoInfo.fit
+
+        Args:
+            input_image_or_video (Path): video or still image of the face
+            duration (Optional[float]): seconds of speech, None if not known
+
+        Returns:
+            Optional[Tuple[int, int]]: (start, end) frame range, None to use the whole video
+        '''
+        if Wav2LipWorker.is_image(input_image_or_video):
+            return None
+        try:
+            return VideoInfo(video_path=input_image_or_video).fit(duration)
+        except Exception as e:
+            logger.warning(f"Using all of {input_image_or_video}, it could not be indexed: {e}")
+            return None
+
+    @classmethod
+    def _get_store(cls) -> Optional[LipSyncStore]:
+        args = Shared.getInstance().args
+        if cls._store is None and args.lipsync_store_size > 0:
+            cls._store = LipSyncStore(store_dir=args.lipsync_store_dir, max_entries=args.lipsync_store_size)
+        return cls._store
+
+    @classmethod
+    def render_hls(cls, input_image_or_video: Path, input_audio: Path, output_path: Path, hls_dir: Path) -> Future:
+        '''
+        Start rendering lipsync to output file, writing it to an HLS playlist in hls_dir as it renders so it can be
+        played before it is finished. Stored renders are split into the playlist without rendering them again
+
+        Args:
+            output_path (Path): output path, written once rendering is complete
+            hls_dir (Path): directory for the playlist (VideoWriter.Filenames.PLAYLIST) and its segments
+
+        Returns:
+            Future: resolves to a Wav2LipWorker.Result
+        '''
+        future = Future()
+        settings = cls.get_settings()
+        frame_range = cls._fit_frames(input_image_or_video, get_audio_duration(input_audio))
+
+        def render_func():
+            try:
+                future.set_result(cls._render_stored(face_path=input_image_or_video, audio_path=input_audio, output_path=output_path,
+                                                     settings=settings, hls_dir=hls_dir, frame_range=frame_range))
+            except Exception as e:
+                future.set_exception(e)
+        Thread(target=render_func, name="LipSyncHls", daemon=True).start()
+        return future
+
+    @classmethod
+    def render_stream(cls, input_image_or_video: Path, chunker: TtsChunker) -> LipSyncStream:
+        '''
+        Start lip syncing speech chunk by chunk while it is synthesized. Its length is not known yet, so the chunks play
+        the face video's longest loop if it has one. Each chunk is served from the store when it has been rendered before
+
+        Args:
+            input_image_or_video (Path): video or still image of the face
+            chunker (TtsChunker): chunker synthesizing the speech
+
+        Returns:
+            LipSyncStream: the started stream, read segments from it in order
+        '''
+        return LipSyncStream(chunker=chunker, face_path=input_image_or_video, output_dir=Shared.getInstance().args.temp_dir,
+                             render_func=cls._render_stored, settings=cls.get_settings(),
+                             frame_range=cls._fit_frames(input_image_or_video, None)).start()
+
+    @classmethod
+    def get_settings(cls) -> Wav2LipWorker.Settings:
+        ''' Returns the render settings chosen on the command line '''
+        args = Shared.getInstance().args
+        return Wav2LipWorker.Settings(mouth_only=args.lipsync_mouth_only, detect_interval=args.lipsync_detect_interval,
+                                      segments=args.lipsync_segments, min_segment_seconds=args.lipsync_min_segment_seconds,
+                                      encode=VideoWriter.Settings(codec=args.video_codec, preset=args.video_preset, crf=args.video_crf))
+
+    @classmethod
+    def get_worker(cls) -> Wav2LipWorker:
+        ''' Returns the resident Wav2Lip worker, downloading the checkpoint first if needed '''
         if not cls._check_models():
             raise Exception("Missing Wav2Lip checkpoint")
+        args = Shared.getInstance().args
+        scheduling = dict(job_threads=args.lipsync_jobs, max_batch_size=args.lipsync_max_batch, batch_wait=args.lipsync_batch_wait / 1000)
+        if args.lipsync_mode == "torch":
+            return Wav2LipWorker.get_worker(checkpoint_path=LipSync.CHECKPOINT, frame_cache=cls._get_frame_cache(), **scheduling)
+        return Wav2LipWorker.get_worker(checkpoint_path=cls._check_onnx_model(quantized=args.lipsync_mode == "onnx-int8"),
+                                        frame_cache=cls._get_frame_cache(), backend="onnx", intra_op_threads=args.lipsync_onnx_threads,
+                                        **scheduling)
+
+    @classmethod
+    def _get_frame_cache(cls) -> Optional[FrameCache]:
+        args = Shared.getInstance().args
+        if cls._frame_cache is None and args.lipsync_frame_cache_dir:
+            cls._frame_cache = FrameCache(cache_dir=args.lipsync_frame_cache_dir, max_bytes=int(args.lipsync_frame_cache_size * (1 << 30)))
+        return cls._frame_cache
 
-        args = ["--checkpoint_path", LipSync.CHECKPOINT,
-                "--face", input_image_or_video,
-                "--audio", input_audio,
-                "--outfile", output_path]
-        main(parseArgs(args))
+    @classmethod
+    def warm_up(cls):
+        ''' Loads Wav2Lip in the background so the first lip sync does not wait on it '''
+        def warm_up_func():
+            try:
+                cls.get_worker().warm_up()
+            except Exception as e:
+                logger.warning(f"Wav2Lip warm-up failed: {e}")
+        Thread(target=warm_up_func, name="Wav2LipWarmUp", daemon=True).start()
 
     @classmethod
     def _check_models(cls) -> bool:
@@ -41,3 +236,21 @@ class LipSync:
             os.makedirs(os.path.dirname(LipSync.CHECKPOINT), exist_ok=True)
             gdown.download(url=LipSync.URL, output=LipSync.CHECKPOINT)
         return os.path.exists(LipSync.CHECKPOINT)
+
+    @classmethod
+    def _check_onnx_model(cls, quantized: bool = False) -> Path:
+        '''
+        Exports (and quantizes) the checkpoint for onnxruntime if that has not been done yet
+
+        Args:
+            quantized (bool, optional): return the int8 model rather than the float one
+
+        Returns:
+            Path: the model
+        '''
+        with LipSync._export_lock:
+            if not os.path.exists(LipSync.ONNX_MODEL):
+                Wav2LipOnnx.export(Wav2LipWorker.load_torch_model(LipSync.CHECKPOINT), LipSync.ONNX_MODEL)
+            if quantized and not os.path.exists(LipSync.ONNX_INT8_MODEL):
+                Wav2LipOnnx.quantize(LipSync.ONNX_MODEL, LipSync.ONNX_INT8_MODEL)
+        return Path(LipSync.ONNX_INT8_MODEL if quantized else LipSync.ONNX_MODEL)
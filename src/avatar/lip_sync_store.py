@@ -0,0 +1,122 @@
+''' On-disk store of finished lip sync videos, keyed by their inputs' contents '''
+from __future__ import annotations
+
+import json
+import os
+import wave
+from dataclasses import dataclass
+from pathlib import Path
+from threading import Lock
+from typing import Any, Dict, Optional, Tuple
+
+from utils.disk_lru import DiskLru
+from utils.file_utils import FileUtils
+
+
+class LipSyncStore:
+    '''
+    Keeps rendered lip sync videos keyed by a hash of the speech's PCM samples, the face video's contents and the render
+    settings, so the same speech on the same avatar video is only rendered once. Least recently used entries beyond
+    max_entries are removed.
+    '''
+    class Filenames:
+        VIDEO = "video.mp4"
+        RESULT = "result.json"
+
+    @dataclass
+    class Entry:
+        video_path: Path
+        frame_cnt: int = 0
+
+    def __init__(self, store_dir: Path, max_entries: int = 64):
+        '''
+        Initialize a LipSyncStore
+
+        Args:
+            store_dir (Path): directory to store videos in
+            max_entries (int, optional): maximum number of videos to keep
+        '''
+        self._lru: DiskLru = DiskLru(root_dir=store_dir, max_entries=max_entries, name="lip sync store")
+        self._lock: Lock = Lock()
+        self._hashes: Dict[Tuple[str, float, int], str] = {}
+
+    def make_key(self, face_path: Path, audio_path: Path, params: Dict[str, Any]) -> str:
+        '''
+        Returns the key of a render
+
+        Args:
+            face_path (Path): video or still image of the face
+            audio_path (Path): speech, WAV files are keyed by their samples so rewriting the same speech matches
+            params (Dict[str, Any]): JSON serializable settings which change the output
+
+        Returns:
+            str: hex digest identifying the render
+        '''
+        canonical = json.dumps({"face": self._file_hash(face_path), "audio": self._audio_hash(audio_path), "params": params},
+                               sort_keys=True)
+        return FileUtils.text_hash(canonical)
+
+    def get(self, key: str) -> Optional[LipSyncStore.Entry]:
+        '''
+        Look up a video
+
+        Args:
+            key (str): key from make_key
+
+        Returns:
+            Optional[LipSyncStore.Entry]: the stored video, or None
+        '''
+        def read(entry_dir: Path) -> LipSyncStore.Entry:
+            with open(entry_dir.joinpath(LipSyncStore.Filenames.RESULT), "r", encoding="utf8") as fhndl:
+                data = json.load(fhndl)
+            video_path = entry_dir.joinpath(LipSyncStore.Filenames.VIDEO)
+            if not os.path.isfile(video_path):
+                raise FileNotFoundError(video_path)
+            return LipSyncStore.Entry(video_path=video_path, frame_cnt=data["frame_cnt"])
+        return self._lru.read(key, read)
+
+    def put(self, key: str, video_path: Path, frame_cnt: int) -> Optional[LipSyncStore.Entry]:
+        '''
+        Adds a finished video to the store, evicting old videos if the store is full
+
+        Args:
+            key (str): key from make_key
+            video_path (Path): video to store, it is hard linked where possible and left in place
+            frame_cnt (int): frames in the video
+
+        Returns:
+            Optional[LipSyncStore.Entry]: the stored video, None if it could not be stored
+        '''
+        def write(entry_dir: Path):
+            FileUtils.link_or_copy(video_path, entry_dir.joinpath(LipSyncStore.Filenames.VIDEO))
+            with open(entry_dir.joinpath(LipSyncStore.Filenames.RESULT), "w", encoding="utf8") as fhndl:
+                json.dump({"frame_cnt": frame_cnt}, fhndl)
+        entry_dir = self._lru.write(key, write)
+        if entry_dir is None:
+            return None
+        return LipSyncStore.Entry(video_path=entry_dir.joinpath(LipSyncStore.Filenames.VIDEO), frame_cnt=frame_cnt)
+
+    def scratch_path(self, key: str) -> Path:
+        ''' Returns a path in the store's directory to render a video to before it is put '''
+        return self._lru.scratch_path(key, suffix=".mp4")
+
+    def _file_hash(self, path: Path) -> str:
+        ''' Returns the content hash of a file, only re-reading it if its modification time or size changed '''
+        stat = os.stat(path)
+        stat_key = (os.path.abspath(path), stat.st_mtime, stat.st_size)
+        with self._lock:
+            file_hash = self._hashes.get(stat_key)
+        if file_hash is None:
+            file_hash = FileUtils.file_hash(path)
+            with self._lock:
+                self._hashes[stat_key] = file_hash
+        return file_hash
+
+    def _audio_hash(self, audio_path: Path) -> str:
+        ''' Returns a hash of a WAV file's format and samples, or of the whole file for other formats '''
+        try:
+            with wave.open(str(audio_path), "rb") as wav:
+                header = f"{wav.getnchannels()}:{wav.getsampwidth()}:{wav.getframerate()}:"
+                return FileUtils.text_hash(header + FileUtils.bytes_hash(wav.readframes(wav.getnframes())))
+        except (wave.Error, EOFError):
+            return self._file_hash(audio_path)
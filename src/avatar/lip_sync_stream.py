@@ -0,0 +1,118 @@
+''' Lip syncs TTS audio chunk by chunk as it is synthesized '''
+from __future__ import annotations
+
+import logging
+import os
+import queue
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+from threading import Event, Thread
+from typing import Callable, Optional, Tuple
+
+from avatar.wav2lip_worker import Wav2LipWorker
+from utils.audio_utils import save_audio_to_file
+from utils.tts_chunker import TtsChunker
+
+logger = logging.getLogger(__file__)
+
+
+class LipSyncStream:
+    '''
+    Renders a short lip synced video for each TtsChunker chunk as soon as its audio is ready, rather than waiting for
+    the whole reply. Each segment continues the face video from the frame the previous one ended on, so played back
+    in order the segments look like one render
+    '''
+    @dataclass
+    class Segment:
+        chunk_id: int
+        video_path: Path
+        start_frame: int
+        frame_cnt: int
+        text: str
+
+    def __init__(self, chunker: TtsChunker, face_path: Path, output_dir: Path, render_func: Callable[..., Wav2LipWorker.Result],
+                 settings: Wav2LipWorker.Settings = None, chunk_timeout: float = 240, frame_range: Tuple[int, int] = None):
+        '''
+        Initialize a LipSyncStream, call start to begin rendering
+
+        Args:
+            chunker (TtsChunker): chunker the speech is being synthesized by
+            face_path (Path): video or still image of the face
+            output_dir (Path): directory to write the chunk audio and segment videos to
+            render_func (Callable[..., Wav2LipWorker.Result]): renders a chunk, takes the arguments of Wav2LipWorker.render
+            settings (Wav2LipWorker.Settings, optional): render settings
+            chunk_timeout (float, optional): max seconds to wait for the next chunk of audio
+            frame_range (Tuple[int, int], optional): face video frames to loop over, defaults to the whole video
+        '''
+        self._chunker: TtsChunker = chunker
+        self._face_path: Path = Path(face_path)
+        self._output_dir: Path = Path(output_dir)
+        self._render_func: Callable[..., Wav2LipWorker.Result] = render_func
+        self._settings: Wav2LipWorker.Settings = settings or Wav2LipWorker.Settings()
+        self._chunk_timeout: float = chunk_timeout
+        self._frame_range: Optional[Tuple[int, int]] = frame_range
+        self._stream_id: str = uuid.uuid4().hex
+        # Segments in playback order, None once there are no more
+        self._segments: queue.Queue[Optional[LipSyncStream.Segment]] = queue.Queue()
+        self._done: bool = False
+        self._cancel_event: Event = Event()
+        self._thread: Thread = Thread(target=self._stream_func, name="LipSyncStream", daemon=True)
+
+    def start(self) -> LipSyncStream:
+        ''' Starts rendering chunks in the background '''
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        ''' Stops after the chunk being rendered '''
+        self._cancel_event.set()
+
+    def next_segment(self, timeout: float = None) -> Optional[LipSyncStream.Segment]:
+        '''
+        Waits for the next segment
+
+        Args:
+            timeout (float, optional): max seconds to wait
+
+        Returns:
+            Optional[LipSyncStream.Segment]: the next segment, or None if the stream is finished or the wait timed out
+        '''
+        if self._done:
+            return None
+        try:
+            segment = self._segments.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if segment is None:
+            self._done = True
+        return segment
+
+    def _stream_func(self):
+        os.makedirs(self._output_dir, exist_ok=True)
+        chunk_id = 0
+        start_frame = 0
+        try:
+            while not self._cancel_event.is_set():
+                audio = self._chunker.wait_for_chunk(chunk_id, timeout=self._chunk_timeout)
+                if audio is None:
+                    break
+                if audio.data is None or len(audio.data) == 0:
+                    # Synthesis of this chunk failed, carry on with the next one
+                    chunk_id += 1
+                    continue
+
+                audio_path = self._output_dir / f"{self._stream_id}_{chunk_id:04d}_audio.wav"
+                video_path = self._output_dir / f"{self._stream_id}_{chunk_id:04d}_synced_video.mp4"
+                save_audio_to_file(sampling_rate=audio.sample_rate, audio_data=audio.data, output_path=str(audio_path))
+                result = self._render_func(face_path=self._face_path, audio_path=audio_path, output_path=video_path,
+                                             settings=self._settings, start_frame=start_frame, frame_range=self._frame_range)
+                self._segments.put(LipSyncStream.Segment(chunk_id=chunk_id, video_path=video_path, start_frame=start_frame,
+                                                         frame_cnt=result.frame_cnt, text=audio.text))
+                logger.info(f"Lip synced chunk {chunk_id} from frame {start_frame}: {result.frame_cnt} frames, {result.timings}")
+                start_frame += result.frame_cnt
+                chunk_id += 1
+        except Exception:
+            logger.exception(f"Lip sync stream of {self._face_path} failed at chunk {chunk_id}")
+        finally:
+            self._segments.put(None)
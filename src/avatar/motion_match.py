@@ -4,7 +4,14 @@ from pathlib import Path
 from typing import List
 from utils.shared import Shared
 
-from tpsmm.tpsmm.demo import parseArgs, main
+from utils.video_io import VideoReader, VideoWriter
+
+from tpsmm.tpsmm.demo import load_checkpoints, relative_kp
+from skimage import img_as_ubyte
+from skimage.transform import resize
+
+import cv2
+import numpy as np
 
 import os
 import subprocess
@@ -20,27 +27,62 @@ class MotionMatch:
     URL = "https://drive.google.com/uc?id=1-CKOjv_y_TzNe-dwQsjjeVxJUuyBAb5X"
     CHECKPOINT = os.path.join(Shared.getInstance().data_dir, "tpsmm", "vox.pth.tar")
     CONFIG = os.path.join("external", "repos", "tpsmm", "tpsmm",  os.path.join("config", "vox-256.yaml"))
+    IMG_SHAPE = (256, 256)
+    MODES = ["standard", "relative", "avd"]
 
     @classmethod
-    def render(cls, source_image: Path, driving_video: Path, output_path: Path):
+    def render(cls, source_image: Path, driving_video: Path, output_path: Path, mode: str = "relative", encode: VideoWriter.Settings = None):
         '''
-        Render MotionMatch to output file
+        Render MotionMatch to output file. Driving frames are read, animated and encoded one at a time,
+        so memory use does not grow with the length of the driving video
 
         Args:
+            source_image (Path): image to animate
+            driving_video (Path): video whose motion is copied
             output_path (Path): output path
+            mode (str, optional): one of MODES, how driving keypoints are mapped onto the source
+            encode (VideoWriter.Settings, optional): encoder settings, defaults to the command line settings
         '''
         if not cls._check_models():
             raise Exception("Missing Thin Plate Spline Motion Model checkpoint")
+        if mode not in MotionMatch.MODES:
+            raise ValueError(f"Unsupported motion match mode: {mode}")
+        if encode is None:
+            args = Shared.getInstance().args
+            encode = VideoWriter.Settings(codec=args.video_codec, preset=args.video_preset, crf=args.video_crf)
+
+        import torch
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        inpainting, kp_detector, dense_motion_network, avd_network = load_checkpoints(
+            config_path=MotionMatch.CONFIG, checkpoint_path=MotionMatch.CHECKPOINT, device=device)
 
-        args = ["--checkpoint", MotionMatch.CHECKPOINT,
-                "--config", MotionMatch.CONFIG,
-                "--source_image", source_image,
-                "--driving_video", driving_video,
-                "--result_video", output_path]
+        reader = VideoReader(driving_video)
+        height, width = MotionMatch.IMG_SHAPE
+        with torch.no_grad(), VideoWriter(output_path, width=width, height=height, fps=reader.fps, settings=encode, input_pix_fmt="rgb24") as writer:
+            source = cls._to_tensor(cv2.imread(str(source_image)), device)
+            kp_source = kp_detector(source)
+            kp_driving_initial = None
+            for frame in reader:
+                kp_driving = kp_detector(cls._to_tensor(frame, device))
+                if kp_driving_initial is None:
+                    kp_driving_initial = kp_driving
+
+                if mode == "standard":
+                    kp_norm = kp_driving
+                elif mode == "relative":
+                    kp_norm = relative_kp(kp_source=kp_source, kp_driving=kp_driving, kp_driving_initial=kp_driving_initial)
+                else:
+                    kp_norm = avd_network(kp_source, kp_driving)
+                dense_motion = dense_motion_network(source_image=source, kp_driving=kp_norm, kp_source=kp_source, bg_param=None, dropout_flag=False)
+                prediction = inpainting(source, dense_motion)["prediction"][0].permute(1, 2, 0).cpu().numpy()
+                writer.write(img_as_ubyte(np.clip(prediction, 0.0, 1.0)))
+
+    @classmethod
+    def _to_tensor(cls, bgr_image: np.ndarray, device):
+        ''' Converts an OpenCV image to the model's (1, 3, H, W) RGB input in the range [0, 1] '''
         import torch
-        if not torch.cuda.is_available():
-            args.append("--cpu")
-        main(parseArgs(args))
+        image = resize(cv2.cvtColor(bgr_image, cv2.COLOR_BGR2RGB), MotionMatch.IMG_SHAPE)[..., :3]
+        return torch.tensor(image[np.newaxis].astype(np.float32)).permute(0, 3, 1, 2).to(device)
 
     @classmethod
     def _check_models(cls) -> bool:
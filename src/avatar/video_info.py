@@ -1,20 +1,64 @@
 ''' Class representing a video file '''
 from __future__ import annotations
+from dataclasses import dataclass, field
 from pathlib import Path
 from PIL import Image
 from utils.image_utils import ImageUtils
-from typing import Optional, List
+from utils.video_io import VideoReader
+from typing import Callable, Optional, List, Tuple
 import cv2
+import json
+import logging
+import math
+import numpy as np
 import os
+import random
+import uuid
+
+logger = logging.getLogger(__file__)
 
 
 class VideoInfo():
     IMG_EXTS = ['.png', '.jpg']
     VID_EXTS = ['.webm', '.mp4', '.mkv', '.gif', '.avi']
+    # Frame rate, frame count and loop points are kept in a '<video>.videoinfo.json' sidecar
+    INDEX_VERSION = 1
+    INDEX_SUFFIX = ".videoinfo.json"
+    # Frames are compared as tiny grayscale thumbnails. A loop's end frame must differ from its start frame by less than
+    # LOOP_THRESHOLD (mean absolute difference, 0-1) to play back into it without a visible jump
+    LOOP_THUMB_SIZE = 32
+    LOOP_THRESHOLD = 0.03
+    MIN_LOOP_SECONDS = 1.0
+    MAX_LOOPS = 8
+    MAX_LOOP_STARTS = 64
+
+    class JsonKeys:
+        VERSION = "version"
+        MTIME = "mtime"
+        SIZE = "size"
+        FPS = "fps"
+        FRAME_CNT = "frame_cnt"
+        LOOPS = "loops"
+
+    @dataclass
+    class Index:
+        fps: float
+        frame_cnt: int
+        loops: List[Tuple[int, int]] = field(default_factory=list)  # (start, end) frame ranges, longest first
+
+        @property
+        def duration(self) -> float:
+            return self.frame_cnt / self.fps
+
+        @property
+        def loop_seconds(self) -> float:
+            ''' Length of the longest loop, 0 if the video has none '''
+            return (self.loops[0][1] - self.loops[0][0]) / self.fps if self.loops else 0.0
 
     def __init__(self, video_path: Path):
         self._path: Path = video_path
         self._thumbnail: Image.Image = None
+        self._index: VideoInfo.Index = None
 
     @property
     def thumbnail(self) -> Image.Image:
@@ -26,6 +70,126 @@ class VideoInfo():
     def path(self) -> Path:
         return self._path
 
+    @property
+    def index(self) -> VideoInfo.Index:
+        ''' The video's frame rate, frame count and loop points, read from its sidecar or indexed on first use '''
+        if self._index is None:
+            self._index = self._load_index()
+            if self._index is None:
+                self._index = self._build_index()
+                self._save_index(self._index)
+        return self._index
+
+    def fit(self, duration: Optional[float]) -> Optional[Tuple[int, int]]:
+        '''
+        Returns the frames to lip sync speech of a given length over. A long enough video is trimmed to the frames the
+        speech needs, a shorter one plays its longest loop over and over
+
+        Args:
+            duration (Optional[float]): seconds of speech, None if not known yet (eg streamed speech)
+
+        Returns:
+            Optional[Tuple[int, int]]: (start, end) frame range, None to use the whole video
+        '''
+        index = self.index
+        if duration is not None:
+            # The mel windows run a frame or so past the speech
+            needed = math.ceil(duration * index.fps) + 2
+            if needed < index.frame_cnt:
+                return (0, needed)
+        if index.loops:
+            return index.loops[0]
+        return None
+
+    def _try_index(self) -> bool:
+        ''' Returns true if the video could be indexed '''
+        try:
+            return self.index is not None
+        except Exception as e:
+            logger.warning(f"Could not index {self._path}: {e}")
+            return False
+
+    def _load_index(self) -> Optional[VideoInfo.Index]:
+        sidecar_path = self._index_path()
+        if not os.path.isfile(sidecar_path):
+            return None
+        try:
+            with open(sidecar_path, "r", encoding="utf8") as fhndl:
+                data = json.load(fhndl)
+            stat = os.stat(self._path)
+            if (data.get(VideoInfo.JsonKeys.VERSION) != VideoInfo.INDEX_VERSION or data[VideoInfo.JsonKeys.MTIME] != stat.st_mtime or
+                    data[VideoInfo.JsonKeys.SIZE] != stat.st_size):
+                return None
+            return VideoInfo.Index(fps=data[VideoInfo.JsonKeys.FPS], frame_cnt=data[VideoInfo.JsonKeys.FRAME_CNT],
+                                   loops=[tuple(loop) for loop in data[VideoInfo.JsonKeys.LOOPS]])
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable video index {sidecar_path}: {e}")
+            return None
+
+    def _save_index(self, index: VideoInfo.Index):
+        sidecar_path = self._index_path()
+        stat = os.stat(self._path)
+        data = {VideoInfo.JsonKeys.VERSION: VideoInfo.INDEX_VERSION,
+                VideoInfo.JsonKeys.MTIME: stat.st_mtime,
+                VideoInfo.JsonKeys.SIZE: stat.st_size,
+                VideoInfo.JsonKeys.FPS: index.fps,
+                VideoInfo.JsonKeys.FRAME_CNT: index.frame_cnt,
+                VideoInfo.JsonKeys.LOOPS: [list(loop) for loop in index.loops]}
+        scratch_path = sidecar_path.with_name(f".{sidecar_path.name}.{uuid.uuid4().hex}")
+        try:
+            with open(scratch_path, "w", encoding="utf8") as fhndl:
+                json.dump(data, fhndl)
+            os.replace(scratch_path, sidecar_path)
+        except Exception as e:
+            logger.warning(f"Failed to save video index {sidecar_path}: {e}")
+            if os.path.isfile(scratch_path):
+                os.remove(scratch_path)
+
+    def _index_path(self) -> Path:
+        base, _ = os.path.splitext(self._path)
+        return Path(base + VideoInfo.INDEX_SUFFIX)
+
+    def _build_index(self) -> VideoInfo.Index:
+        ''' Decodes the video once, counting its frames and keeping a tiny grayscale copy of each to find loops in '''
+        reader = VideoReader(self._path)
+        size = VideoInfo.LOOP_THUMB_SIZE
+        thumbs = np.asarray([cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), (size, size), interpolation=cv2.INTER_AREA).reshape(-1)
+                             for frame in reader], dtype=np.uint8)
+        if len(thumbs) == 0:
+            raise ValueError(f"No frames read from {self._path}")
+        loops = self._find_loops(thumbs, reader.fps)
+        logger.info(f"Indexed {self._path}: {len(thumbs)} frames at {reader.fps:.2f} fps, {len(loops)} loops")
+        return VideoInfo.Index(fps=reader.fps, frame_cnt=len(thumbs), loops=loops)
+
+    @classmethod
+    def _find_loops(cls, thumbs: np.ndarray, fps: float) -> List[Tuple[int, int]]:
+        '''
+        Finds frame ranges which can be played over and over: from start frames every half second (at most MAX_LOOP_STARTS
+        of them), the furthest later frame which looks like the start frame, and is followed by frames which look like
+        the ones after it, ends the range
+
+        Args:
+            thumbs (np.ndarray): (frames, pixels) grayscale thumbnails
+            fps (float): frame rate
+
+        Returns:
+            List[Tuple[int, int]]: up to MAX_LOOPS (start, end) ranges, longest first. Frame end matches frame start, so
+            playing start to end - 1 and then start again looks like the video continuing
+        '''
+        min_frames = max(2, int(VideoInfo.MIN_LOOP_SECONDS * fps))
+        step = max(1, int(fps / 2), len(thumbs) // VideoInfo.MAX_LOOP_STARTS)
+        loops = []
+        # Frames a fifth of a second on must match too, so the motion carries on in the same direction across the join
+        lead = max(1, int(fps / 5))
+        for start in range(0, len(thumbs) - min_frames - lead, step):
+            diffs = np.maximum(np.abs(thumbs[start + min_frames:len(thumbs) - lead].astype(np.int16) - thumbs[start]).mean(axis=1),
+                               np.abs(thumbs[start + min_frames + lead:].astype(np.int16) - thumbs[start + lead]).mean(axis=1)) / 255.
+            ends = np.flatnonzero(diffs < VideoInfo.LOOP_THRESHOLD)
+            if len(ends) > 0:
+                loops.append((start, start + min_frames + int(ends[-1])))
+        loops.sort(key=lambda loop: loop[1] - loop[0], reverse=True)
+        return loops[:VideoInfo.MAX_LOOPS]
+
     def _load_thumbnail(self) -> Optional[Image.Image]:
         thumbnail_path = self._locate_thumbnail()
         if not thumbnail_path:
@@ -60,6 +224,75 @@ class VideoInfo():
                     preview_name = base + VideoInfo.IMG_EXTS[0]
                 img.save(preview_name)
 
+    def get_controlnet_map(self, module: str, detector: Callable[..., Optional[Image.Image]], **params) -> Optional[Image.Image]:
+        '''
+        Returns the ControlNet preprocessor output for this video's thumbnail, running the detector only if
+        there is no up-to-date copy stored next to the thumbnail
+
+        Args:
+            module (str): ControlNet module (preprocessor) name
+            detector (Callable[..., Optional[Image.Image]]): called as detector(module=module, image=thumbnail, **params) on a cache miss
+            params: preprocessor parameters, eg processor_res
+
+        Returns:
+            Optional[Image.Image]: the detected map, or None if the detector failed
+        '''
+        if self.thumbnail is None:
+            return None
+        thumbnail_path = self._locate_thumbnail()
+
+        param_tag = "_".join(f"{key}-{params[key]}" for key in sorted(params.keys()))
+        base, _ = os.path.splitext(self._path)
+        map_path = f"{base}.controlnet.{module}.{param_tag}{VideoInfo.IMG_EXTS[0]}" if param_tag else f"{base}.controlnet.{module}{VideoInfo.IMG_EXTS[0]}"
+
+        # Stale if the thumbnail was refreshed after the map was made
+        if os.path.exists(map_path) and os.path.getmtime(map_path) >= os.path.getmtime(thumbnail_path):
+            # Loaded now, the file may be replaced by another detection while the image is in use
+            with Image.open(map_path) as stored_map:
+                return stored_map.copy()
+
+        detected_map = detector(module=module, image=self.thumbnail, **params)
+        if detected_map is not None:
+            _, ext = os.path.splitext(map_path)
+            scratch_path = os.path.join(os.path.dirname(map_path), f".{os.path.basename(map_path)}.{uuid.uuid4().hex}{ext}")
+            try:
+                detected_map.save(scratch_path)
+                os.replace(scratch_path, map_path)
+            except Exception as e:
+                logger.warning(f"Failed to save ControlNet map {map_path}: {e}")
+                if os.path.isfile(scratch_path):
+                    os.remove(scratch_path)
+        return detected_map
+
+    @classmethod
+    def best_fit(cls, videos: List[VideoInfo], duration: Optional[float]) -> Optional[VideoInfo]:
+        '''
+        Picks the video to lip sync speech of a given length over. Any video at least as long as the speech fits it, and
+        is trimmed to the same number of frames, so one of those is picked at random. Otherwise the video which repeats
+        the fewest times is picked, preferring one with a loop over one which jumps back to its first frame. Videos which
+        cannot be indexed are only picked if none can
+
+        Args:
+            videos (List[VideoInfo]): videos to pick from
+            duration (Optional[float]): seconds of speech, None if not known yet
+
+        Returns:
+            Optional[VideoInfo]: the video, None if there are none
+        '''
+        if not videos:
+            return None
+        indexed = [video for video in videos if video._try_index()]
+        if not indexed:
+            return random.choice(videos)
+        videos = indexed
+        if duration is None:
+            looping = [video for video in videos if video.index.loops]
+            return random.choice(looping or videos)
+        long_enough = [video for video in videos if video.index.duration >= duration]
+        if long_enough:
+            return random.choice(long_enough)
+        return max(videos, key=lambda video: (video.index.loop_seconds > 0, video.index.loop_seconds or video.index.duration))
+
     @classmethod
     def list_directory(self, path: Path, valid_exts: List[str] = None) -> List[VideoInfo]:
         ''' Returns a list of videos in the driving_videos directory '''
@@ -0,0 +1,94 @@
+''' ONNX Runtime execution of Wav2Lip, for CPU-only machines '''
+from __future__ import annotations
+
+import logging
+import os
+import uuid
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger(__file__)
+
+
+class Wav2LipOnnx:
+    '''
+    Runs an exported Wav2Lip model with onnxruntime on the CPU. Called like the torch model, but on numpy arrays:
+    mel (N, 1, 80, 16) and face (N, 6, 96, 96) float32 in, generated faces (N, 3, 96, 96) in the range [0, 1] out
+    '''
+    OPSET = 13
+
+    class InputNames:
+        MEL = "mel"
+        FACE = "face"
+
+    @classmethod
+    def export(cls, model, onnx_path: Path):
+        '''
+        Exports a torch Wav2Lip model, with a variable batch size
+
+        Args:
+            model (Wav2Lip): model in eval mode
+            onnx_path (Path): file to write
+        '''
+        import torch
+        os.makedirs(os.path.dirname(os.path.abspath(onnx_path)), exist_ok=True)
+        scratch_path = Path(onnx_path).with_name(f".{Path(onnx_path).name}.{uuid.uuid4().hex}")
+        device = next(model.parameters()).device
+        try:
+            torch.onnx.export(model.cpu(), (torch.zeros((1, 1, 80, 16)), torch.zeros((1, 6, 96, 96))), str(scratch_path),
+                              input_names=[Wav2LipOnnx.InputNames.MEL, Wav2LipOnnx.InputNames.FACE], output_names=["output"],
+                              dynamic_axes={Wav2LipOnnx.InputNames.MEL: {0: "batch"}, Wav2LipOnnx.InputNames.FACE: {0: "batch"}, "output": {0: "batch"}},
+                              opset_version=Wav2LipOnnx.OPSET, do_constant_folding=True)
+            os.replace(scratch_path, onnx_path)
+        finally:
+            model.to(device)
+            if os.path.isfile(scratch_path):
+                os.remove(scratch_path)
+        logger.info(f"Exported Wav2Lip to {onnx_path}")
+
+    @classmethod
+    def quantize(cls, onnx_path: Path, int8_path: Path):
+        '''
+        Writes an int8 weight quantized copy of an exported model. Activations are quantized on the fly,
+        so no calibration data is needed
+
+        Args:
+            onnx_path (Path): exported float model
+            int8_path (Path): file to write
+        '''
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        scratch_path = Path(int8_path).with_name(f".{Path(int8_path).name}.{uuid.uuid4().hex}")
+        try:
+            quantize_dynamic(str(onnx_path), str(scratch_path), weight_type=QuantType.QInt8)
+            os.replace(scratch_path, int8_path)
+        finally:
+            if os.path.isfile(scratch_path):
+                os.remove(scratch_path)
+        logger.info(f"Quantized Wav2Lip to {int8_path}")
+
+    def __init__(self, onnx_path: Path, intra_op_threads: int = 0):
+        '''
+        Initialize a Wav2LipOnnx
+
+        Args:
+            onnx_path (Path): exported model, float or int8
+            intra_op_threads (int, optional): threads used inside each operator, 0 for one per physical core
+        '''
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        # One model call per batch, so all the threads go to the operators
+        options.inter_op_num_threads = 1
+        options.intra_op_num_threads = intra_op_threads
+        self._onnx_path: Path = Path(onnx_path)
+        self._session = ort.InferenceSession(str(onnx_path), sess_options=options, providers=["CPUExecutionProvider"])
+
+    def __call__(self, mel: np.ndarray, face: np.ndarray) -> np.ndarray:
+        return self._session.run(None, {Wav2LipOnnx.InputNames.MEL: np.ascontiguousarray(mel, dtype=np.float32),
+                                        Wav2LipOnnx.InputNames.FACE: np.ascontiguousarray(face, dtype=np.float32)})[0]
+
+    @property
+    def path(self) -> Path:
+        return self._onnx_path
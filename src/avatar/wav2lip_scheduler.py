@@ -0,0 +1,154 @@
+''' Batches Wav2Lip model calls from concurrent render jobs together '''
+from __future__ import annotations
+
+import logging
+import time
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from threading import Condition, Thread
+from typing import Callable, Deque, Dict, List, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__file__)
+
+
+class InferenceScheduler:
+    '''
+    Runs one model for every render job. Jobs submit batches of model inputs, the scheduler thread merges whatever is
+    waiting into batches of up to max_batch_size frames (waiting at most max_wait for more to arrive once it has some),
+    runs the model once per merged batch and hands each job back the outputs for its inputs
+    '''
+    @dataclass
+    class Output:
+        pred: np.ndarray
+        queue_wait: float = 0.0
+
+    @dataclass
+    class Request:
+        img_batch: np.ndarray
+        mel_batch: np.ndarray
+        future: Future = field(default_factory=Future)
+        submitted: float = field(default_factory=time.time)
+        started: float = 0.0
+        preds: List[Tuple[int, np.ndarray]] = field(default_factory=list)
+        done_cnt: int = 0
+
+    def __init__(self, infer_func: Callable[[np.ndarray, np.ndarray], np.ndarray], max_batch_size: int = 256, max_wait: float = 0.02,
+                 name: str = "InferenceScheduler"):
+        '''
+        Initialize an InferenceScheduler
+
+        Args:
+            infer_func (Callable[[np.ndarray, np.ndarray], np.ndarray]): runs the model on (img_batch, mel_batch), returning one output per frame
+            max_batch_size (int, optional): most frames per model call
+            max_wait (float, optional): seconds to hold a part-filled batch open for more frames
+            name (str, optional): scheduler thread name
+        '''
+        self._infer_func: Callable[[np.ndarray, np.ndarray], np.ndarray] = infer_func
+        self._max_batch_size: int = max(1, max_batch_size)
+        self._max_wait: float = max_wait
+        self._cond: Condition = Condition()
+        # (request, first frame not yet scheduled)
+        self._pending: Deque[Tuple[InferenceScheduler.Request, int]] = deque()
+        self._pending_frames: int = 0
+        self._stats: Dict[str, float] = {"frames": 0, "batches": 0, "requests": 0, "busy_s": 0.0, "queue_wait_s": 0.0}
+        self._thread: Thread = Thread(target=self._scheduler_func, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, img_batch: np.ndarray, mel_batch: np.ndarray) -> Future:
+        '''
+        Queues model inputs
+
+        Args:
+            img_batch (np.ndarray): face inputs, one per frame
+            mel_batch (np.ndarray): mel windows, one per frame
+
+        Returns:
+            Future: resolves to an InferenceScheduler.Output with one output per frame
+        '''
+        request = InferenceScheduler.Request(img_batch=img_batch, mel_batch=mel_batch)
+        if len(img_batch) == 0:
+            request.future.set_result(InferenceScheduler.Output(pred=np.zeros((0,))))
+            return request.future
+        with self._cond:
+            self._pending.append((request, 0))
+            self._pending_frames += len(img_batch)
+            self._cond.notify()
+        return request.future
+
+    def get_stats(self) -> Dict[str, float]:
+        ''' Returns frame and batch counts, model throughput and the mean time a request waits for the model '''
+        with self._cond:
+            stats = dict(self._stats)
+        stats["frames_per_s"] = stats["frames"] / stats["busy_s"] if stats["busy_s"] > 0 else 0.0
+        stats["mean_batch"] = stats["frames"] / stats["batches"] if stats["batches"] > 0 else 0.0
+        stats["mean_queue_wait_s"] = stats["queue_wait_s"] / stats["requests"] if stats["requests"] > 0 else 0.0
+        return stats
+
+    def _take_batch(self) -> List[Tuple[InferenceScheduler.Request, int, int]]:
+        ''' Waits for work and returns up to max_batch_size frames of it as (request, start, end) slices '''
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            # Give other jobs a moment to add to a part-filled batch
+            deadline = time.time() + self._max_wait
+            while self._pending_frames < self._max_batch_size and time.time() < deadline:
+                self._cond.wait(timeout=max(0.0, deadline - time.time()))
+
+            now = time.time()
+            slices = []
+            capacity = self._max_batch_size
+            while self._pending and capacity > 0:
+                request, start = self._pending.popleft()
+                end = min(len(request.img_batch), start + capacity)
+                if start == 0:
+                    request.started = now
+                slices.append((request, start, end))
+                capacity -= end - start
+                self._pending_frames -= end - start
+                if end < len(request.img_batch):
+                    # The rest goes first in the next batch
+                    self._pending.appendleft((request, end))
+            return slices
+
+    def _scheduler_func(self):
+        while True:
+            slices = self._take_batch()
+            start_time = time.time()
+            try:
+                if len(slices) == 1 and slices[0][1] == 0 and slices[0][2] == len(slices[0][0].img_batch):
+                    img_batch, mel_batch = slices[0][0].img_batch, slices[0][0].mel_batch
+                else:
+                    img_batch = np.concatenate([request.img_batch[start:end] for request, start, end in slices])
+                    mel_batch = np.concatenate([request.mel_batch[start:end] for request, start, end in slices])
+                pred = self._infer_func(img_batch, mel_batch)
+            except Exception as e:
+                logger.exception("Lip sync inference failed")
+                for request, _, _ in slices:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                continue
+            busy = time.time() - start_time
+
+            offset = 0
+            finished = []
+            for request, start, end in slices:
+                request.preds.append((start, pred[offset:offset + end - start]))
+                offset += end - start
+                request.done_cnt += end - start
+                if request.done_cnt == len(request.img_batch) and not request.future.done():
+                    finished.append(request)
+
+            with self._cond:
+                self._stats["frames"] += len(img_batch)
+                self._stats["batches"] += 1
+                self._stats["busy_s"] += busy
+                for request in finished:
+                    self._stats["requests"] += 1
+                    self._stats["queue_wait_s"] += request.started - request.submitted
+            for request in finished:
+                preds = [part for _, part in sorted(request.preds, key=lambda item: item[0])]
+                request.future.set_result(InferenceScheduler.Output(pred=np.concatenate(preds) if len(preds) > 1 else preds[0],
+                                                                    queue_wait=request.started - request.submitted))
@@ -0,0 +1,192 @@
+''' Renders long lip sync clips in segments across worker processes '''
+from __future__ import annotations
+
+import logging
+import multiprocessing
+import os
+import shutil
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import torch
+from wav2lip.wav2lip.models import Wav2Lip
+
+from avatar.frame_cache import FrameCache
+from avatar.wav2lip_onnx import Wav2LipOnnx
+from avatar.wav2lip_worker import Wav2LipWorker
+from utils.video_io import VideoWriter
+
+logger = logging.getLogger(__file__)
+
+
+class SegmentRenderer:
+    '''
+    Splits a clip's frame range into segments and renders them in parallel, one per worker process, each process with its
+    own copy of the model. The mel windows and face boxes come from the whole clip, so every segment's windows take in the
+    audio either side of its edges and the joins match a single pass render. Segments are written without audio and joined
+    by copying their video streams, muxing the audio in once
+    '''
+    @dataclass
+    class Task:
+        face_path: Path
+        segment_path: Path
+        start: int  # First output frame of the segment
+        mel_chunks: List[np.ndarray]
+        boxes: np.ndarray
+        frame_cnt: int  # Source frames used, the output loops over them
+        fps: float
+        settings: Wav2LipWorker.Settings
+        frame_cache_dir: Optional[Path] = None
+        frame_cache_size: int = 0
+        frame_range: Optional[Tuple[int, int]] = None  # Source frames the clip uses, None for the whole video
+
+    @dataclass
+    class Output:
+        segment_path: Path
+        frame_cnt: int = 0
+        infer: float = 0.0
+        encode: float = 0.0
+
+    # Per process state, set up by _init_process
+    _model: Optional[Union[Wav2Lip, Wav2LipOnnx]] = None
+    _device: str = "cpu"
+    _frame_caches: Dict[str, FrameCache] = {}
+
+    def __init__(self, checkpoint_path: Path, processes: int, device: str = "cpu", backend: str = "torch"):
+        '''
+        Initialize a SegmentRenderer, starting its worker processes. Each loads the model once and keeps it
+
+        Args:
+            checkpoint_path (Path): Wav2Lip checkpoint, an exported .onnx model for the onnx backend
+            processes (int): worker processes, the most segments rendered at once
+            device (str, optional): torch device
+            backend (str, optional): one of Wav2LipWorker.BACKENDS
+        '''
+        self._processes: int = max(1, processes)
+        # Split the cores between the processes rather than have each one try to use all of them
+        threads = max(1, (os.cpu_count() or 1) // self._processes)
+        # Forking a process which has loaded torch and started threads is unsafe
+        self._pool: ProcessPoolExecutor = ProcessPoolExecutor(max_workers=self._processes, mp_context=multiprocessing.get_context("spawn"),
+                                                              initializer=SegmentRenderer._init_process,
+                                                              initargs=(checkpoint_path, device, backend, threads))
+
+    @property
+    def processes(self) -> int:
+        return self._processes
+
+    @classmethod
+    def split(cls, frame_cnt: int, segments: int, min_frames: int) -> List[Tuple[int, int]]:
+        '''
+        Splits frames [0, frame_cnt) into up to segments even ranges of at least min_frames
+
+        Returns:
+            List[Tuple[int, int]]: (start, end) of each segment
+        '''
+        segments = max(1, min(segments, frame_cnt // max(1, min_frames)))
+        bounds = np.linspace(0, frame_cnt, segments + 1).round().astype(int)
+        return [(int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:])]
+
+    def render(self, face_path: Path, audio_path: Path, output_path: Path, mel_chunks: List[np.ndarray], boxes: np.ndarray,
+               frame_cnt: int, fps: float, settings: Wav2LipWorker.Settings, frame_cache: Optional[FrameCache] = None,
+               result: Wav2LipWorker.Result = None, start_frame: int = 0,
+               frame_range: Optional[Tuple[int, int]] = None) -> Wav2LipWorker.Result:
+        '''
+        Renders a clip in segments and joins them
+
+        Args:
+            face_path (Path): video or still image of the face
+            audio_path (Path): speech the mel windows were made from, muxed into the output
+            output_path (Path): video to write
+            mel_chunks (List[np.ndarray]): mel window of every output frame
+            boxes (np.ndarray): face box of each of the first frame_cnt source frames
+            frame_cnt (int): source frames used
+            fps (float): frame rate
+            settings (Wav2LipWorker.Settings): render settings
+            frame_cache (Optional[FrameCache], optional): cache the source frames are in, the processes map them from it
+            result (Wav2LipWorker.Result, optional): result to add the frame count and timings to
+            start_frame (int, optional): face video frame the clip starts from
+            frame_range (Optional[Tuple[int, int]], optional): face video frames the clip uses, None for the whole video
+
+        Returns:
+            Wav2LipWorker.Result: the result
+        '''
+        result = result or Wav2LipWorker.Result(output_path=Path(output_path))
+        ranges = SegmentRenderer.split(len(mel_chunks), settings.segments, int(settings.min_segment_seconds * fps))
+        segment_dir = Path(output_path).with_name(f".{Path(output_path).stem}.segments.{uuid.uuid4().hex}")
+        os.makedirs(segment_dir)
+        try:
+            start_time = time.time()
+            tasks = [SegmentRenderer.Task(face_path=Path(face_path), segment_path=segment_dir / f"{idx:04d}.mp4", start=start_frame + start,
+                                          mel_chunks=mel_chunks[start:end], boxes=boxes, frame_cnt=frame_cnt, fps=fps, settings=settings,
+                                          frame_cache_dir=frame_cache.cache_dir if frame_cache is not None else None,
+                                          frame_cache_size=frame_cache.max_bytes if frame_cache is not None else 0,
+                                          frame_range=frame_range)
+                     for idx, (start, end) in enumerate(ranges)]
+            outputs: List[SegmentRenderer.Output] = list(self._pool.map(SegmentRenderer._render_segment, tasks))
+            result.timings.infer += time.time() - start_time
+            result.frame_cnt += sum(output.frame_cnt for output in outputs)
+            logger.info(f"Rendered {len(outputs)} segments of {output_path}: infer {sum(output.infer for output in outputs):.2f}s, "
+                        f"encode {sum(output.encode for output in outputs):.2f}s across processes")
+
+            start_time = time.time()
+            VideoWriter.concat([output.segment_path for output in outputs], output_path, audio_path=audio_path, settings=settings.encode)
+            result.timings.encode += time.time() - start_time
+        finally:
+            shutil.rmtree(segment_dir, ignore_errors=True)
+        return result
+
+    def shutdown(self):
+        ''' Stops the worker processes '''
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    @classmethod
+    def _init_process(cls, checkpoint_path: Path, device: str, backend: str, threads: int):
+        ''' Loads the model in a worker process '''
+        torch.set_num_threads(threads)
+        if backend == "onnx":
+            SegmentRenderer._model = Wav2LipOnnx(onnx_path=checkpoint_path, intra_op_threads=threads)
+        else:
+            SegmentRenderer._model = Wav2LipWorker.load_torch_model(checkpoint_path, device)
+        SegmentRenderer._device = device
+
+    @classmethod
+    def _render_segment(cls, task: SegmentRenderer.Task) -> SegmentRenderer.Output:
+        ''' Renders one segment, without audio, in a worker process '''
+        output = SegmentRenderer.Output(segment_path=task.segment_path)
+        frame_cache = None
+        if task.frame_cache_dir is not None:
+            key = str(task.frame_cache_dir)
+            if key not in SegmentRenderer._frame_caches:
+                SegmentRenderer._frame_caches[key] = FrameCache(cache_dir=task.frame_cache_dir, max_bytes=task.frame_cache_size)
+            frame_cache = SegmentRenderer._frame_caches[key]
+        # The parent read the frames first, so with a frame cache this maps them rather than decoding
+        frames, _ = Wav2LipWorker._load_frames(task.face_path, task.settings, frame_cache, task.frame_range)
+        frames = frames[:task.frame_cnt]
+
+        if len(frames) == 1:
+            batches = Wav2LipWorker._static_batches(frames[0], task.boxes[0], task.mel_chunks, task.settings)
+        else:
+            batches = Wav2LipWorker._batches(frames, task.boxes, None, task.mel_chunks, task.settings, start=task.start)
+
+        frame_h, frame_w = frames[0].shape[:2]
+        with VideoWriter(task.segment_path, width=frame_w, height=frame_h, fps=task.fps, settings=task.settings.encode) as writer:
+            for img_batch, mel_batch, frame_batch, box_batch in batches:
+                start_time = time.time()
+                pred = Wav2LipWorker._infer(SegmentRenderer._model, img_batch, mel_batch, SegmentRenderer._device)
+                for face, frame, box in zip(pred, frame_batch, box_batch):
+                    Wav2LipWorker._paste_face(face, frame, box, task.settings)
+                output.infer += time.time() - start_time
+
+                start_time = time.time()
+                for frame in frame_batch:
+                    writer.write(frame)
+                output.encode += time.time() - start_time
+                output.frame_cnt += len(frame_batch)
+            start_time = time.time()
+        output.encode += time.time() - start_time
+        return output
@@ -0,0 +1,679 @@
+''' Long-lived Wav2Lip renderer which keeps the model and face detector loaded between jobs '''
+from __future__ import annotations
+
+import json
+import logging
+import os
+import queue
+import time
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from pathlib import Path
+from threading import Lock, Thread
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import cv2
+import numpy as np
+import torch
+from wav2lip.wav2lip import audio as wav2lip_audio
+from wav2lip.wav2lip import face_detection
+from wav2lip.wav2lip.models import Wav2Lip
+
+from avatar.face_box_cache import FaceBoxCache
+from avatar.frame_cache import FrameCache
+from avatar.wav2lip_onnx import Wav2LipOnnx
+from avatar.wav2lip_scheduler import InferenceScheduler
+from utils.file_utils import FileUtils
+from utils.video_io import VideoReader, VideoWriter
+
+logger = logging.getLogger(__file__)
+
+
+class Wav2LipWorker:
+    '''
+    Renders lip sync jobs from a queue on background threads. The Wav2Lip checkpoint and the S3FD face detector are loaded
+    once and stay resident, so a job only pays for its own frames. Jobs render concurrently but share one model through an
+    InferenceScheduler, which merges their batches into larger ones
+    '''
+    IMG_SIZE = 96
+    MEL_STEP_SIZE = 16
+    SAMPLE_RATE = 16000
+    IMAGE_EXTENSIONS = [".jpg", ".jpeg", ".png", ".bmp", ".webp"]
+    BACKENDS = ["torch", "onnx"]
+
+    @dataclass
+    class Settings:
+        fps: float = 25.0  # Only used for still images
+        pads: Tuple[int, int, int, int] = (0, 10, 0, 0)  # top, bottom, left, right
+        face_det_batch_size: int = 16
+        wav2lip_batch_size: int = 128
+        resize_factor: int = 1
+        smooth: bool = True
+        cache_boxes: bool = True  # Keep a video's face boxes in a sidecar file, see FaceBoxCache
+        mouth_only: bool = False  # Only paste the lower half of the face back, blended in with a feathered edge
+        feather: float = 0.15  # Width of the blended edge as a fraction of the pasted region
+        detect_interval: int = 1  # Detect faces in every Nth frame, interpolating (and checking) the boxes in between
+        track_threshold: float = 0.5  # Interpolated faces matching the last detected face worse than this are detected
+        encode: VideoWriter.Settings = field(default_factory=VideoWriter.Settings)
+        segments: int = 1  # Render clips in up to this many segments at once in worker processes, see SegmentRenderer
+        min_segment_seconds: float = 4.0  # Clips are only split into segments at least this long
+
+    @dataclass
+    class Timings:
+        load: float = 0.0
+        detect: float = 0.0
+        infer: float = 0.0
+        encode: float = 0.0
+        queued: float = 0.0
+        model_wait: float = 0.0  # Part of infer spent waiting for the shared model
+
+        @property
+        def total(self) -> float:
+            return self.load + self.detect + self.infer + self.encode
+
+        def __str__(self) -> str:
+            return (f"load {self.load:.2f}s, detect {self.detect:.2f}s, infer {self.infer:.2f}s (model wait {self.model_wait:.2f}s), "
+                    f"encode {self.encode:.2f}s (total {self.total:.2f}s, queued {self.queued:.2f}s)")
+
+    @dataclass
+    class Result:
+        output_path: Path
+        frame_cnt: int = 0
+        timings: Wav2LipWorker.Timings = field(default_factory=lambda: Wav2LipWorker.Timings())
+
+    @dataclass
+    class Job:
+        face_path: Path
+        audio_path: Path
+        output_path: Path
+        settings: Wav2LipWorker.Settings
+        start_frame: int = 0
+        hls_dir: Optional[Path] = None
+        frame_range: Optional[Tuple[int, int]] = None
+        future: Future = field(default_factory=Future)
+        submitted: float = field(default_factory=time.time)
+
+    _instances: Dict[Tuple[str, str], Wav2LipWorker] = {}
+    _instances_lock: Lock = Lock()
+    _feather_masks: Dict[Tuple[int, int, float], np.ndarray] = {}
+
+    @classmethod
+    def get_worker(cls, checkpoint_path: Path, device: str = None, frame_cache: FrameCache = None, backend: str = "torch",
+                   intra_op_threads: int = 0, job_threads: int = 2, max_batch_size: int = 256, batch_wait: float = 0.02) -> Wav2LipWorker:
+        '''
+        Returns the shared worker for a checkpoint, starting it on first use
+
+        Args:
+            checkpoint_path (Path): Wav2Lip checkpoint, an exported .onnx model for the onnx backend
+            device (str, optional): torch device, defaults to cuda when available
+            frame_cache (FrameCache, optional): cache for decoded video frames, used when the worker is started
+            backend (str, optional): one of BACKENDS, runs Wav2Lip with torch or onnxruntime (CPU)
+            intra_op_threads (int, optional): onnxruntime threads per operator, 0 for one per physical core
+            job_threads (int, optional): jobs rendered at once, used when the worker is started
+            max_batch_size (int, optional): most frames per model call across jobs, used when the worker is started
+            batch_wait (float, optional): seconds a part-filled batch waits for other jobs' frames, used when the worker is started
+
+        Returns:
+            Wav2LipWorker: the worker
+        '''
+        device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        key = (str(checkpoint_path), device, backend)
+        with cls._instances_lock:
+            if key not in cls._instances:
+                cls._instances[key] = Wav2LipWorker(checkpoint_path=checkpoint_path, device=device, frame_cache=frame_cache,
+                                                    backend=backend, intra_op_threads=intra_op_threads, job_threads=job_threads,
+                                                    max_batch_size=max_batch_size, batch_wait=batch_wait)
+            return cls._instances[key]
+
+    @classmethod
+    def is_image(cls, face_path: Path) -> bool:
+        ''' Returns true if the face is a still image rather than a video '''
+        return Path(face_path).suffix.lower() in Wav2LipWorker.IMAGE_EXTENSIONS
+
+    @classmethod
+    def load_torch_model(cls, checkpoint_path: Path, device: str = "cpu") -> Wav2Lip:
+        ''' Loads a Wav2Lip checkpoint, ready for inference '''
+        checkpoint = torch.load(checkpoint_path, map_location=lambda storage, loc: storage)
+        state_dict = {key.replace("module.", ""): value for key, value in checkpoint["state_dict"].items()}
+        model = Wav2Lip()
+        model.load_state_dict(state_dict)
+        return model.to(device).eval()
+
+    def __init__(self, checkpoint_path: Path, device: str = "cpu", queue_size: int = 16, frame_cache: FrameCache = None,
+                 backend: str = "torch", intra_op_threads: int = 0, job_threads: int = 2, max_batch_size: int = 256, batch_wait: float = 0.02):
+        '''
+        Initialize a Wav2LipWorker. The model is loaded by the worker thread, see warm_up
+
+        Args:
+            checkpoint_path (Path): Wav2Lip checkpoint, an exported .onnx model for the onnx backend
+            device (str, optional): torch device (face detection always uses it)
+            queue_size (int, optional): max jobs waiting to render
+            frame_cache (FrameCache, optional): keeps decoded frames and face crops of videos memory mapped on disk
+            backend (str, optional): one of BACKENDS
+            intra_op_threads (int, optional): onnxruntime threads per operator, 0 for one per physical core
+            job_threads (int, optional): jobs rendered at once
+            max_batch_size (int, optional): most frames per model call, merged across jobs
+            batch_wait (float, optional): seconds a part-filled batch waits for other jobs' frames
+        '''
+        if backend not in Wav2LipWorker.BACKENDS:
+            raise ValueError(f"Unsupported Wav2Lip backend: {backend}")
+        self._checkpoint_path: Path = checkpoint_path
+        self._device: str = device
+        self._backend: str = backend
+        self._intra_op_threads: int = intra_op_threads
+        self._frame_cache: Optional[FrameCache] = frame_cache
+        self._model: Optional[Union[Wav2Lip, Wav2LipOnnx]] = None
+        self._detector: Optional[face_detection.FaceAlignment] = None
+        self._load_lock: Lock = Lock()
+        self._detect_lock: Lock = Lock()
+        self._segment_renderer = None
+        self._scheduler: InferenceScheduler = InferenceScheduler(infer_func=self._scheduled_infer, max_batch_size=max_batch_size,
+                                                                 max_wait=batch_wait, name="Wav2LipScheduler")
+        self._queue: queue.Queue[Wav2LipWorker.Job] = queue.Queue(maxsize=queue_size)
+        self._threads: List[Thread] = [Thread(target=self._worker_func, name=f"Wav2LipWorker{idx}", daemon=True) for idx in range(max(1, job_threads))]
+        for thread in self._threads:
+            thread.start()
+
+    def warm_up(self) -> float:
+        '''
+        Loads the model and detector and runs each once, so the first real job does not pay for CUDA/cuDNN initialization
+
+        Returns:
+            float: seconds taken
+        '''
+        start_time = time.time()
+        _, detector = self._load()
+        self._scheduler.submit(np.zeros((1, Wav2LipWorker.IMG_SIZE, Wav2LipWorker.IMG_SIZE, 6)), np.zeros((1, 80, Wav2LipWorker.MEL_STEP_SIZE, 1))).result()
+        with self._detect_lock:
+            detector.get_detections_for_batch(np.zeros((1, 256, 256, 3), dtype=np.uint8))
+        elapsed = time.time() - start_time
+        logger.info(f"Wav2Lip ({self._backend}) warmed up on {self._device} in {elapsed:.2f}s")
+        return elapsed
+
+    def submit(self, face_path: Path, audio_path: Path, output_path: Path, settings: Wav2LipWorker.Settings = None,
+               start_frame: int = 0, hls_dir: Path = None, frame_range: Tuple[int, int] = None) -> Future:
+        '''
+        Queues a render
+
+        Args:
+            face_path (Path): video or still image of the face
+            audio_path (Path): speech to sync to
+            output_path (Path): video to write
+            settings (Wav2LipWorker.Settings, optional): render settings
+            start_frame (int, optional): face video frame to start from, for continuing an earlier render
+            hls_dir (Path, optional): also write the video as an HLS playlist here while rendering, see VideoWriter
+            frame_range (Tuple[int, int], optional): (start, end) face video frames to use, looping over them, see VideoInfo.fit.
+                start_frame counts from start. Defaults to the whole video
+
+        Returns:
+            Future: resolves to a Wav2LipWorker.Result
+        '''
+        job = Wav2LipWorker.Job(face_path=Path(face_path), audio_path=Path(audio_path), output_path=Path(output_path),
+                                settings=settings or Wav2LipWorker.Settings(), start_frame=start_frame,
+                                hls_dir=Path(hls_dir) if hls_dir is not None else None,
+                                frame_range=tuple(frame_range) if frame_range is not None else None)
+        self._queue.put(job)
+        return job.future
+
+    def render(self, face_path: Path, audio_path: Path, output_path: Path, settings: Wav2LipWorker.Settings = None,
+               start_frame: int = 0, hls_dir: Path = None, frame_range: Tuple[int, int] = None) -> Wav2LipWorker.Result:
+        ''' Queues a render and waits for it, see submit '''
+        return self.submit(face_path=face_path, audio_path=audio_path, output_path=output_path, settings=settings,
+                           start_frame=start_frame, hls_dir=hls_dir, frame_range=frame_range).result()
+
+    def get_stats(self) -> Dict[str, float]:
+        ''' Returns the shared model's frame count, throughput (frames/s) and mean batch size and queue wait '''
+        return self._scheduler.get_stats()
+
+    def _worker_func(self):
+        while True:
+            job = self._queue.get()
+            if not job.future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = self._render(job)
+                stats = self._scheduler.get_stats()
+                logger.info(f"Lip synced {job.output_path.name}: {result.frame_cnt} frames, {result.timings}. "
+                            f"Model: {stats['frames_per_s']:.1f} frames/s, mean batch {stats['mean_batch']:.1f}")
+                job.future.set_result(result)
+            except Exception as e:
+                logger.exception(f"Lip sync of {job.face_path} failed")
+                job.future.set_exception(e)
+
+    def _load(self) -> Tuple[Union[Wav2Lip, Wav2LipOnnx], face_detection.FaceAlignment]:
+        ''' Loads the model and detector if they are not already loaded '''
+        with self._load_lock:
+            if self._model is None:
+                if self._backend == "onnx":
+                    self._model = Wav2LipOnnx(onnx_path=self._checkpoint_path, intra_op_threads=self._intra_op_threads)
+                else:
+                    self._model = Wav2LipWorker.load_torch_model(self._checkpoint_path, self._device)
+            if self._detector is None:
+                self._detector = face_detection.FaceAlignment(face_detection.LandmarksType._2D, flip_input=False, device=self._device)
+            return self._model, self._detector
+
+    def _render(self, job: Wav2LipWorker.Job) -> Wav2LipWorker.Result:
+        result = Wav2LipWorker.Result(output_path=job.output_path)
+        timings = result.timings
+        timings.queued = time.time() - job.submitted
+        settings = job.settings
+
+        start_time = time.time()
+        _, detector = self._load()
+        decode_range = self._get_decode_range(job.face_path, job.frame_range, settings)
+        frames, fps = self._read_frames(job.face_path, settings, decode_range)
+        mel_chunks = self._load_mel_chunks(job.audio_path, fps)
+        timings.load = time.time() - start_time
+
+        start_time = time.time()
+        # Frames past the end of the output are never shown
+        end_frame = job.start_frame + len(mel_chunks)
+        if job.frame_range is not None and decode_range is None:
+            # The whole video was read, keep the frames of the range
+            range_start, range_end = job.frame_range
+            boxes = self._get_boxes(detector, job.face_path, frames, min(range_end, range_start + end_frame), settings)
+            crops = self._get_crops(job.face_path, frames, boxes, settings)
+            frames, boxes = frames[range_start:range_end], boxes[range_start:range_end]
+            crops = crops[range_start:range_end] if crops is not None else None
+            if len(frames) == 0:
+                raise ValueError(f"Frames {job.frame_range} are past the end of {job.face_path}")
+        else:
+            boxes = self._get_boxes(detector, job.face_path, frames, end_frame, settings, frame_range=decode_range)
+            crops = self._get_crops(job.face_path, frames, boxes, settings) if decode_range is None else None
+        frames, boxes = frames[:end_frame], boxes[:end_frame]
+        timings.detect = time.time() - start_time
+
+        # Segments are only joined at the end, which would hold back the playlist
+        if settings.segments > 1 and job.hls_dir is None and len(mel_chunks) >= 2 * settings.min_segment_seconds * fps:
+            return self._get_segment_renderer(settings.segments).render(
+                face_path=job.face_path, audio_path=job.audio_path, output_path=job.output_path, mel_chunks=mel_chunks, boxes=boxes,
+                frame_cnt=len(frames), fps=fps, settings=settings, frame_cache=self._frame_cache, result=result, start_frame=job.start_frame,
+                frame_range=job.frame_range)
+
+        # A still image, or a video of one, only needs its face prepared once
+        if len(frames) == 1:
+            batches = self._static_batches(frames[0], boxes[0], mel_chunks, settings)
+        else:
+            batches = self._batches(frames, boxes, crops, mel_chunks, settings, start=job.start_frame)
+
+        # Frames go straight to ffmpeg, which muxes in the audio as it encodes
+        frame_h, frame_w = frames[0].shape[:2]
+        with VideoWriter(job.output_path, width=frame_w, height=frame_h, fps=fps, audio_path=job.audio_path, settings=settings.encode,
+                         hls_dir=job.hls_dir) as writer:
+            # Keep the next batch queued for the model while this job composites and encodes the previous one
+            in_flight = deque()
+            for img_batch, mel_batch, frame_batch, box_batch in batches:
+                in_flight.append((self._scheduler.submit(img_batch, mel_batch), frame_batch, box_batch))
+                if len(in_flight) > 1:
+                    self._write_batch(*in_flight.popleft(), writer=writer, settings=settings, result=result)
+            while in_flight:
+                self._write_batch(*in_flight.popleft(), writer=writer, settings=settings, result=result)
+            # Leaving the block waits for ffmpeg to finish the file
+            start_time = time.time()
+        timings.encode += time.time() - start_time
+        return result
+
+    def _get_segment_renderer(self, processes: int):
+        ''' Returns the SegmentRenderer, starting its processes the first time (or when the process count changes) '''
+        from avatar.wav2lip_segments import SegmentRenderer
+        with self._load_lock:
+            if self._segment_renderer is not None and self._segment_renderer.processes != processes:
+                self._segment_renderer.shutdown()
+                self._segment_renderer = None
+            if self._segment_renderer is None:
+                self._segment_renderer = SegmentRenderer(checkpoint_path=self._checkpoint_path, processes=processes, device=self._device,
+                                                         backend=self._backend)
+            return self._segment_renderer
+
+    def _write_batch(self, future: Future, frame_batch: List[np.ndarray], box_batch: List[Tuple[int, int, int, int]], writer: VideoWriter,
+                     settings: Wav2LipWorker.Settings, result: Wav2LipWorker.Result):
+        ''' Waits for a batch's generated faces, pastes them into their frames and encodes them '''
+        start_time = time.time()
+        output: InferenceScheduler.Output = future.result()
+        for face, frame, box in zip(output.pred, frame_batch, box_batch):
+            self._paste_face(face, frame, box, settings)
+        result.timings.infer += time.time() - start_time
+        result.timings.model_wait += output.queue_wait
+
+        start_time = time.time()
+        for frame in frame_batch:
+            writer.write(frame)
+        result.timings.encode += time.time() - start_time
+        result.frame_cnt += len(frame_batch)
+
+    def _scheduled_infer(self, img_batch: np.ndarray, mel_batch: np.ndarray) -> np.ndarray:
+        ''' Runs the model for the scheduler '''
+        model, _ = self._load()
+        return self._infer(model, img_batch, mel_batch, self._device)
+
+    @classmethod
+    def _infer(cls, model: Union[Wav2Lip, Wav2LipOnnx], img_batch: np.ndarray, mel_batch: np.ndarray, device: str) -> np.ndarray:
+        ''' Runs the model on NHWC batches, returning NHWC faces in the range [0, 255] '''
+        img_batch = np.transpose(img_batch, (0, 3, 1, 2)).astype(np.float32)
+        mel_batch = np.transpose(mel_batch, (0, 3, 1, 2)).astype(np.float32)
+        if isinstance(model, Wav2LipOnnx):
+            pred = model(mel_batch, img_batch)
+        else:
+            with torch.no_grad():
+                pred = model(torch.from_numpy(mel_batch).to(device), torch.from_numpy(img_batch).to(device)).cpu().numpy()
+        return pred.transpose(0, 2, 3, 1) * 255.
+
+    def _read_frames(self, face_path: Path, settings: Wav2LipWorker.Settings,
+                     frame_range: Optional[Tuple[int, int]] = None) -> Tuple[np.ndarray, float]:
+        return self._load_frames(face_path, settings, self._frame_cache, frame_range)
+
+    def _get_decode_range(self, face_path: Path, frame_range: Optional[Tuple[int, int]],
+                          settings: Wav2LipWorker.Settings) -> Optional[Tuple[int, int]]:
+        '''
+        Returns the frames of a job's range to decode, or None to read the whole video: frames in the frame cache are
+        mapped rather than decoded, and a video without stored face boxes is detected whole once so later ranges find them
+        '''
+        if frame_range is None or self._frame_cache is not None or Wav2LipWorker.is_image(face_path):
+            return None
+        if settings.cache_boxes:
+            boxes = FaceBoxCache.load(face_path, self._box_params(settings))
+            if boxes is None or len(boxes) < frame_range[1]:
+                return None
+        return frame_range
+
+    @classmethod
+    def _load_frames(cls, face_path: Path, settings: Wav2LipWorker.Settings, frame_cache: Optional[FrameCache],
+                     frame_range: Optional[Tuple[int, int]] = None) -> Tuple[np.ndarray, float]:
+        ''' Returns the BGR frames of a video (or the one frame of an image) and their rate, only frame_range if given '''
+        if not os.path.isfile(face_path):
+            raise ValueError(f"Face video or image not found: {face_path}")
+        if Wav2LipWorker.is_image(face_path):
+            return np.asarray([cv2.imread(str(face_path))]), settings.fps
+        if frame_cache is not None:
+            frames, fps = frame_cache.get_frames(face_path, tag=f"resize{settings.resize_factor}",
+                                                 decoder=lambda: cls._decode_video(face_path, settings))
+            return (frames[frame_range[0]:frame_range[1]] if frame_range is not None else frames), fps
+        return cls._decode_video(face_path, settings, frame_range)
+
+    @classmethod
+    def _decode_video(cls, face_path: Path, settings: Wav2LipWorker.Settings,
+                      frame_range: Optional[Tuple[int, int]] = None) -> Tuple[np.ndarray, float]:
+        reader = VideoReader(face_path, default_fps=settings.fps)
+        frames = []
+        for frame in reader.frames(*(frame_range or (0, None))):
+            if settings.resize_factor > 1:
+                frame = cv2.resize(frame, (frame.shape[1] // settings.resize_factor, frame.shape[0] // settings.resize_factor))
+            frames.append(frame)
+        if not frames:
+            raise ValueError(f"No frames read from {face_path}")
+        return np.asarray(frames), reader.fps
+
+    def _load_mel_chunks(self, audio_path: Path, fps: float) -> List[np.ndarray]:
+        ''' Splits the audio's mel spectrogram into one window per video frame '''
+        mel = wav2lip_audio.melspectrogram(wav2lip_audio.load_wav(str(audio_path), Wav2LipWorker.SAMPLE_RATE))
+        if np.isnan(mel.reshape(-1)).sum() > 0:
+            raise ValueError("Mel spectrogram contains NaN, try adding a little noise to the audio")
+
+        mel_chunks = []
+        mel_idx_multiplier = 80. / fps
+        step_size = Wav2LipWorker.MEL_STEP_SIZE
+        idx = 0
+        while True:
+            start_idx = int(idx * mel_idx_multiplier)
+            if start_idx + step_size > len(mel[0]):
+                mel_chunks.append(mel[:, len(mel[0]) - step_size:])
+                break
+            mel_chunks.append(mel[:, start_idx: start_idx + step_size])
+            idx += 1
+        return mel_chunks
+
+    def _get_boxes(self, detector: face_detection.FaceAlignment, face_path: Path, frames: np.ndarray, frame_cnt: int,
+                   settings: Wav2LipWorker.Settings, frame_range: Optional[Tuple[int, int]] = None) -> np.ndarray:
+        '''
+        Returns the face boxes of at least the first frame_cnt frames. The boxes of a whole video are stored alongside it,
+        so rendering the same video again skips detection. With a frame_range, frames are only that range of the video and
+        their stored boxes are used if there are any
+
+        Returns:
+            np.ndarray: (frames, 4) array of x1, y1, x2, y2
+        '''
+        if not settings.cache_boxes or Wav2LipWorker.is_image(face_path):
+            return self._detect_faces(detector, frames[:frame_cnt], settings)
+
+        params = self._box_params(settings)
+        boxes = FaceBoxCache.load(face_path, params)
+        if frame_range is not None:
+            if boxes is not None and len(boxes) >= frame_range[1]:
+                return boxes[frame_range[0]:frame_range[1]]
+            return self._detect_faces(detector, frames[:frame_cnt], settings)
+        if boxes is None or len(boxes) != len(frames):
+            boxes = self._detect_faces(detector, frames, settings)
+            FaceBoxCache.save(face_path, params, boxes)
+        else:
+            logger.info(f"Using stored face boxes for {face_path}")
+        return boxes
+
+    @classmethod
+    def _box_params(cls, settings: Wav2LipWorker.Settings) -> Dict[str, Any]:
+        ''' Returns the settings which affect face boxes '''
+        return {"pads": list(settings.pads), "resize_factor": settings.resize_factor, "smooth": settings.smooth,
+                "detect_interval": settings.detect_interval, "track_threshold": settings.track_threshold}
+
+    def _get_crops(self, face_path: Path, frames: np.ndarray, boxes: np.ndarray, settings: Wav2LipWorker.Settings) -> Optional[np.ndarray]:
+        ''' Returns the model sized face crop of every boxed frame from the frame cache, None if they are not cached '''
+        if self._frame_cache is None or not settings.cache_boxes or Wav2LipWorker.is_image(face_path):
+            return None
+        # The boxes were stored with these parameters, so the crops are the same while they are
+        tag = FileUtils.text_hash(json.dumps(self._box_params(settings), sort_keys=True))[:12]
+        return self._frame_cache.get_crops(face_path, tag=f"{tag}_{Wav2LipWorker.IMG_SIZE}",
+                                           cropper=lambda: np.asarray([self._crop_face(frame, box) for frame, box in zip(frames, boxes)]))
+
+    @classmethod
+    def _crop_face(cls, frame: np.ndarray, box: np.ndarray) -> np.ndarray:
+        x1, y1, x2, y2 = box
+        return cv2.resize(np.asarray(frame[y1:y2, x1:x2]), (Wav2LipWorker.IMG_SIZE, Wav2LipWorker.IMG_SIZE))
+
+    def _detect_faces(self, detector: face_detection.FaceAlignment, frames: np.ndarray,
+                      settings: Wav2LipWorker.Settings) -> np.ndarray:
+        '''
+        Finds the padded face box of every frame. With a detect interval above 1 only every Nth frame is detected and the
+        boxes in between are interpolated, re-detecting any frame where the face no longer matches the last detected one
+
+        Returns:
+            np.ndarray: (frames, 4) array of x1, y1, x2, y2
+        '''
+        interval = max(1, settings.detect_interval)
+        key_idxs = list(range(0, len(frames), interval))
+        if key_idxs[-1] != len(frames) - 1:
+            key_idxs.append(len(frames) - 1)
+        rects = np.zeros((len(frames), 4), dtype=np.float64)
+        detected = np.zeros(len(frames), dtype=bool)
+        self._detect_rects(detector, frames, key_idxs, rects, detected, settings)
+
+        if not detected.all():
+            rects = self._interpolate_rects(rects, detected)
+            lost_idxs = self._find_lost_faces(frames, rects, detected, settings)
+            if lost_idxs:
+                logger.info(f"Face tracking lost in {len(lost_idxs)} of {len(frames)} frames, detecting them")
+                self._detect_rects(detector, frames, lost_idxs, rects, detected, settings)
+                rects = self._interpolate_rects(rects, detected)
+
+        pad_top, pad_bottom, pad_left, pad_right = settings.pads
+        frame_h, frame_w = frames[0].shape[:2]
+        boxes = np.stack([np.maximum(0, rects[:, 0] - pad_left), np.maximum(0, rects[:, 1] - pad_top),
+                          np.minimum(frame_w, rects[:, 2] + pad_right), np.minimum(frame_h, rects[:, 3] + pad_bottom)], axis=1)
+        if settings.smooth:
+            boxes = self._smooth_boxes(boxes, window=5)
+        return boxes.astype(int)
+
+    def _detect_rects(self, detector: face_detection.FaceAlignment, frames: np.ndarray, idxs: List[int], rects: np.ndarray,
+                      detected: np.ndarray, settings: Wav2LipWorker.Settings):
+        ''' Runs face detection on frames[idxs], storing the unpadded face rectangles in rects and flagging them in detected '''
+        batch_size = settings.face_det_batch_size
+        while True:
+            try:
+                predictions = []
+                for start in range(0, len(idxs), batch_size):
+                    batch = np.array([frames[idx] for idx in idxs[start:start + batch_size]])
+                    with self._detect_lock:
+                        predictions.extend(detector.get_detections_for_batch(batch))
+                break
+            except RuntimeError:
+                if batch_size == 1:
+                    raise RuntimeError("Image too big to run face detection on the GPU, use a larger resize factor")
+                batch_size //= 2
+                logger.warning(f"Face detection ran out of memory, retrying with batch size {batch_size}")
+
+        for idx, rect in zip(idxs, predictions):
+            if rect is None:
+                raise ValueError(f"Face not detected in frame {idx}, the video must show a face in every frame")
+            rects[idx] = rect[:4]
+            detected[idx] = True
+
+    @classmethod
+    def _interpolate_rects(cls, rects: np.ndarray, detected: np.ndarray) -> np.ndarray:
+        ''' Linearly interpolates the rectangles of undetected frames from the detected ones around them '''
+        frame_idxs = np.arange(len(rects))
+        detected_idxs = np.flatnonzero(detected)
+        return np.stack([np.interp(frame_idxs, detected_idxs, rects[detected_idxs, col]) for col in range(4)], axis=1)
+
+    def _find_lost_faces(self, frames: np.ndarray, rects: np.ndarray, detected: np.ndarray, settings: Wav2LipWorker.Settings) -> List[int]:
+        '''
+        Checks each interpolated frame by matching the face from the last detected frame around its interpolated rectangle
+
+        Returns:
+            List[int]: frames whose best match scores below settings.track_threshold
+        '''
+        template_width = 48
+        templates: Dict[int, Tuple[np.ndarray, float]] = {}
+        lost_idxs = []
+        last_detected = 0
+        for idx in range(len(frames)):
+            if detected[idx]:
+                last_detected = idx
+                continue
+            if last_detected not in templates:
+                templates[last_detected] = self._face_template(frames[last_detected], rects[last_detected], template_width)
+            template, scale = templates[last_detected]
+            if template is None:
+                lost_idxs.append(idx)
+                continue
+
+            # Search a margin around the interpolated face at the template's scale
+            x1, y1, x2, y2 = rects[idx]
+            margin_x, margin_y = (x2 - x1) * 0.25, (y2 - y1) * 0.25
+            frame_h, frame_w = frames[idx].shape[:2]
+            sx1, sy1 = int(max(0, x1 - margin_x)), int(max(0, y1 - margin_y))
+            sx2, sy2 = int(min(frame_w, x2 + margin_x)), int(min(frame_h, y2 + margin_y))
+            search = cv2.cvtColor(np.ascontiguousarray(frames[idx][sy1:sy2, sx1:sx2]), cv2.COLOR_BGR2GRAY)
+            search = cv2.resize(search, (max(1, int((sx2 - sx1) * scale)), max(1, int((sy2 - sy1) * scale))))
+            if search.shape[0] < template.shape[0] or search.shape[1] < template.shape[1]:
+                lost_idxs.append(idx)
+                continue
+            if cv2.matchTemplate(search, template, cv2.TM_CCOEFF_NORMED).max() < settings.track_threshold:
+                lost_idxs.append(idx)
+        return lost_idxs
+
+    @classmethod
+    def _face_template(cls, frame: np.ndarray, rect: np.ndarray, width: int) -> Tuple[Optional[np.ndarray], float]:
+        ''' Returns a small grayscale copy of the face in rect and the scale it was shrunk by '''
+        x1, y1, x2, y2 = [int(val) for val in rect]
+        if x2 - x1 < 2 or y2 - y1 < 2:
+            return None, 1.0
+        scale = width / (x2 - x1)
+        face = cv2.cvtColor(np.ascontiguousarray(frame[y1:y2, x1:x2]), cv2.COLOR_BGR2GRAY)
+        return cv2.resize(face, (width, max(1, int((y2 - y1) * scale)))), scale
+
+    @classmethod
+    def _smooth_boxes(cls, boxes: np.ndarray, window: int) -> np.ndarray:
+        ''' Averages each box with the following ones (the last window boxes at the end) to steady the crop '''
+        if len(boxes) <= window:
+            return np.repeat(boxes.mean(axis=0, keepdims=True), len(boxes), axis=0)
+        sums = np.concatenate([np.zeros((1, boxes.shape[1])), np.cumsum(boxes, axis=0)])
+        starts = np.minimum(np.arange(len(boxes)), len(boxes) - window)
+        return (sums[starts + window] - sums[starts]) / window
+
+    @classmethod
+    def _batches(cls, frames: np.ndarray, boxes: np.ndarray, crops: Optional[np.ndarray], mel_chunks: List[np.ndarray],
+                 settings: Wav2LipWorker.Settings, start: int = 0):
+        '''
+        Yields model inputs (masked+reference faces, mels) with the frames and boxes they are pasted back into.
+        Face crops are made from the frames unless crops are given. start is the output frame mel_chunks begins at,
+        for rendering part of a clip
+        '''
+        img_batch, mel_batch, frame_batch, box_batch = [], [], [], []
+
+        def make_batch():
+            return cls._face_input(np.asarray(img_batch)), cls._mel_input(mel_batch), frame_batch, box_batch
+
+        for idx, mel in enumerate(mel_chunks):
+            frame_idx = (start + idx) % len(frames)
+            img_batch.append(crops[frame_idx] if crops is not None else cls._crop_face(frames[frame_idx], boxes[frame_idx]))
+            mel_batch.append(mel)
+            frame_batch.append(frames[frame_idx].copy())
+            box_batch.append(tuple(boxes[frame_idx]))
+            if len(img_batch) >= settings.wav2lip_batch_size:
+                yield make_batch()
+                img_batch, mel_batch, frame_batch, box_batch = [], [], [], []
+        if img_batch:
+            yield make_batch()
+
+    @classmethod
+    def _static_batches(cls, frame: np.ndarray, box: np.ndarray, mel_chunks: List[np.ndarray], settings: Wav2LipWorker.Settings):
+        '''
+        Like _batches for a still image. The face is cropped and prepared once and only the mel windows change from
+        frame to frame, so each batch repeats the one face input
+        '''
+        face_input = cls._face_input(cls._crop_face(frame, box)[np.newaxis])
+        box = tuple(box)
+        for start in range(0, len(mel_chunks), settings.wav2lip_batch_size):
+            mel_batch = mel_chunks[start:start + settings.wav2lip_batch_size]
+            yield (np.repeat(face_input, len(mel_batch), axis=0), cls._mel_input(mel_batch),
+                   [frame.copy() for _ in mel_batch], [box] * len(mel_batch))
+
+    @classmethod
+    def _face_input(cls, crops: np.ndarray) -> np.ndarray:
+        ''' Returns NHWC model face inputs, the crop with its lower half blanked stacked on the whole crop '''
+        masked = crops.copy()
+        masked[:, Wav2LipWorker.IMG_SIZE // 2:] = 0
+        return np.concatenate((masked, crops), axis=3) / 255.
+
+    @classmethod
+    def _mel_input(cls, mel_batch: List[np.ndarray]) -> np.ndarray:
+        mels = np.asarray(mel_batch)
+        return np.reshape(mels, [len(mels), mels.shape[1], mels.shape[2], 1])
+
+    @classmethod
+    def _paste_face(cls, face: np.ndarray, frame: np.ndarray, box: Tuple[int, int, int, int], settings: Wav2LipWorker.Settings):
+        ''' Writes a generated face into its frame, either the whole box or only the feathered mouth region '''
+        x1, y1, x2, y2 = box
+        if not settings.mouth_only:
+            frame[y1:y2, x1:x2] = cv2.resize(face.astype(np.uint8), (x2 - x1, y2 - y1))
+            return
+
+        # Wav2Lip only generates the lower half of the face (the upper half is given to it), so leave the rest of
+        # the frame exactly as decoded
+        mouth_y1 = y1 + (y2 - y1) // 2
+        width, height = x2 - x1, y2 - mouth_y1
+        if width <= 0 or height <= 0:
+            return
+        mouth = cv2.resize(face[Wav2LipWorker.IMG_SIZE // 2:], (width, height)).astype(np.float32)
+        alpha = cls._get_feather_mask(width, height, settings.feather)
+        region = frame[mouth_y1:y2, x1:x2]
+        region[:] = (alpha * mouth + (1.0 - alpha) * region).round().astype(np.uint8)
+
+    @classmethod
+    def _get_feather_mask(cls, width: int, height: int, feather: float) -> np.ndarray:
+        '''
+        Returns a (height, width, 1) blend mask which is 1 inside and ramps down to 0 at the edges
+
+        Args:
+            width (int): region width
+            height (int): region height
+            feather (float): ramp width as a fraction of the region size
+        '''
+        key = (width, height, feather)
+        mask = Wav2LipWorker._feather_masks.get(key)
+        if mask is None:
+            def ramp(size: int) -> np.ndarray:
+                steps = max(1, int(size * feather))
+                return np.clip(np.minimum(np.arange(size) + 1, np.arange(size)[::-1] + 1) / steps, 0.0, 1.0)
+            mask = np.minimum.outer(ramp(height), ramp(width)).astype(np.float32)[:, :, np.newaxis]
+            Wav2LipWorker._feather_masks[key] = mask
+        return mask
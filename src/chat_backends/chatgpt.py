@@ -34,10 +34,11 @@ class ChatGpt(Chat):
                 self.message = f"{self.role}: {self.message}"
                 self.role = ChatGpt.Roles.USER
 
-    def __init__(self, api_key: str, chat_model: str = "gpt-3.5-turbo", initial_instructions: Optional[str] = None):
+    def __init__(self, api_key: str, chat_model: str = "gpt-3.5-turbo", initial_instructions: Optional[str] = None, api_base: Optional[str] = None):
         super().__init__()
         openai.api_key = api_key
         self._model: str = chat_model
+        self._api_base: Optional[str] = api_base
         self._role: str = Chat.Roles.USER
         self._history: List[ChatGpt.HistoryItem] = []
 
@@ -69,7 +70,7 @@ class ChatGpt(Chat):
         if not has_user:
             return ""
 
-        completion = openai.ChatCompletion.create(model=self._model, messages=converted_msgs)
+        completion = openai.ChatCompletion.create(model=self._model, messages=converted_msgs, api_base=self._api_base)
 
         response = completion.choices[0].message.content
         response = self.preProc(response)
@@ -1,13 +1,24 @@
 ''' Interface for an Image Generator backend '''
 import abc
 from abc import abstractmethod
-from typing import List, Optional, Tuple, Callable
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple, Callable
 
 from PIL import Image
 from webuiapi import ControlNetUnit
 
 
 class ImageGen(abc.ABC):
+    # ControlNet module name meaning 'input image is already preprocessed'
+    CONTROLNET_NO_MODULE: str = "none"
+
+    @dataclass
+    class Progress:
+        progress: float = 0.0
+        eta: float = 0.0
+        preview: Optional[Image.Image] = None
+        queued: bool = False
 
     @abstractmethod
     def gen_image(self, prompt: str, input_image: Image.Image = None, controlnet_units: Optional[List[ControlNetUnit]] = None, **kwargs) -> Optional[str]:
@@ -24,6 +35,72 @@ class ImageGen(abc.ABC):
 
         '''
 
+    def gen_image_async(self, prompt: str, input_image: Image.Image = None, controlnet_units: Optional[List[ControlNetUnit]] = None, **kwargs) -> Future:
+        '''
+        Generate an image without blocking the caller. Backends which queue requests should override this,
+        the default runs gen_image immediately.
+
+        Args:
+            same as gen_image
+
+        Returns:
+            Future: resolves to the result of gen_image
+        '''
+        future = Future()
+        try:
+            future.set_result(self.gen_image(prompt=prompt, input_image=input_image, controlnet_units=controlnet_units, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def get_progress(self, job: Future) -> Optional["ImageGen.Progress"]:
+        '''
+        Returns the progress of a job from gen_image_async. Backends which can report progress should override this
+
+        Args:
+            job (Future): future returned by gen_image_async
+
+        Returns:
+            Optional[ImageGen.Progress]: progress, with a preview of the partially generated image if available. None if unknown
+        '''
+        return None
+
+    def interrupt(self, job: Future) -> None:
+        '''
+        Stops a job from gen_image_async early. A job which has already started may still resolve, to a partial result
+
+        Args:
+            job (Future): future returned by gen_image_async
+        '''
+        job.cancel()
+
+    def get_cache_context(self, **kwargs) -> Dict[str, Any]:
+        '''
+        Returns what, beyond the request itself, decides the image a request would generate, eg the server and the model
+        loaded on it. Cached results are only reused while it is unchanged. Backends with such state should override this
+
+        Args:
+            kwargs: the request's gen_image arguments
+
+        Returns:
+            Dict[str, Any]: JSON serializable context
+        '''
+        return {}
+
+    def get_job_cache_context(self, job: Future, **kwargs) -> Optional[Dict[str, Any]]:
+        '''
+        Returns the cache context a finished job actually ran with, for backends which only know it once the job has run,
+        eg a pool which picks the server when the job starts
+
+        Args:
+            job (Future): finished future returned by gen_image_async
+            kwargs: the request's gen_image arguments
+
+        Returns:
+            Optional[Dict[str, Any]]: JSON serializable context, None if it is the one get_cache_context returned
+        '''
+        return None
+
     @abstractmethod
     def get_txt2img_method(self) -> Callable:
         '''
@@ -47,3 +124,19 @@ class ImageGen(abc.ABC):
         '''
         Returns a list of available ControlNet modules
         '''
+
+    @abstractmethod
+    def detect_controlnet_map(self, module: str, image: Image.Image, processor_res: int = 512, threshold_a: float = 64, threshold_b: float = 64) -> Optional[Image.Image]:
+        '''
+        Runs a ControlNet preprocessor on an image
+
+        Args:
+            module (str): name of the ControlNet module (preprocessor) to run
+            image (Image.Image): image to preprocess
+            processor_res (int, optional): preprocessor resolution
+            threshold_a (float, optional): first preprocessor parameter
+            threshold_b (float, optional): second preprocessor parameter
+
+        Returns:
+            Optional[Image.Image]: the detected map, suitable for a ControlNet unit using CONTROLNET_NO_MODULE
+        '''
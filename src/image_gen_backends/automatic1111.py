@@ -1,45 +1,91 @@
 import webuiapi
 from image_gen import ImageGen
 from typing_extensions import override
-from typing import Optional, Tuple, List, Callable
+from typing import Any, Dict, Optional, Tuple, List, Callable
+from concurrent.futures import Future
 from PIL import Image
 import webuiapi
 from webuiapi import ControlNetUnit
 import inspect
 
+from image_gen_backends.automatic1111_client import Automatic1111Client
+from utils.capability_catalog import CapabilityCatalog
+
 
 class Automatic1111(ImageGen):
     BACKEND_NAME: str = "AUTOMATIC1111"
 
-    def __init__(self, api_host: str, api_port: int):
-        self._api: webuiapi.WebUIApi = webuiapi.WebUIApi(host=api_host, port=api_port)
-        self._model_cache: List[str] = []
-        self._module_cache: List[str] = []
+    def __init__(self, api_host: str, api_port: int, queue_size: int = 16, request_timeout: float = None, connect_timeout: float = None,
+                 catalog: CapabilityCatalog = None):
+        self._client: Automatic1111Client = Automatic1111Client.get_client(
+            api_host=api_host, api_port=api_port, queue_size=queue_size, request_timeout=request_timeout, connect_timeout=connect_timeout,
+            catalog=catalog)
 
     @override
     def gen_image(self, prompt: str, input_image: Image.Image = None, controlnet_units: Optional[List[ControlNetUnit]] = None, **kwargs) -> Optional[str]:
+        return self.gen_image_async(prompt=prompt, input_image=input_image, controlnet_units=controlnet_units, **kwargs).result()
+
+    @override
+    def gen_image_async(self, prompt: str, input_image: Image.Image = None, controlnet_units: Optional[List[ControlNetUnit]] = None, **kwargs) -> Future:
         if input_image:
             kwargs['input_image'] = input_image
-            func = self._api.img2img
+            method = "img2img"
         else:
-            func = self._api.txt2img
+            method = "txt2img"
         kwargs['prompt'] = prompt
         kwargs['controlnet_units'] = controlnet_units
-        return func(**kwargs)
+        return self._client.submit(method, **kwargs)
 
     @override
     def get_controlnet_models(self) -> List[str]:
-        if len(self._model_cache) == 0:
-            ret = self._api.custom_get("controlnet/model_list")
-            self._model_cache = ret["model_list"]
-        return self._model_cache.copy()
+        return self._client.get_controlnet_models()
 
     @override
     def get_controlnet_modules(self) -> List[str]:
-        if len(self._module_cache) == 0:
-            ret = self._api.custom_get("controlnet/module_list")
-            self._module_cache = ret["module_list"]
-        return self._module_cache.copy()
+        return self._client.get_controlnet_modules()
+
+    @override
+    def detect_controlnet_map(self, module: str, image: Image.Image, processor_res: int = 512, threshold_a: float = 64, threshold_b: float = 64) -> Optional[Image.Image]:
+        return self.detect_controlnet_map_async(module=module, image=image, processor_res=processor_res,
+                                                threshold_a=threshold_a, threshold_b=threshold_b).result()
+
+    def detect_controlnet_map_async(self, module: str, image: Image.Image, processor_res: int = 512, threshold_a: float = 64, threshold_b: float = 64) -> Future:
+        ''' Same as detect_controlnet_map, but returns a Future '''
+        payload = {"controlnet_module": module,
+                   "controlnet_input_images": [webuiapi.raw_b64_img(image)],
+                   "controlnet_processor_res": processor_res,
+                   "controlnet_threshold_a": threshold_a,
+                   "controlnet_threshold_b": threshold_b}
+        # Preprocessors run on the GPU too, so queue them with the generation requests
+        result_future = self._client.submit("custom_post", endpoint="controlnet/detect", payload=payload)
+        map_future = Future()
+
+        def set_map(done: Future):
+            if done.cancelled():
+                map_future.cancel()
+            elif done.exception() is not None:
+                map_future.set_exception(done.exception())
+            else:
+                map_future.set_result(done.result().image if done.result().images else None)
+        result_future.add_done_callback(set_map)
+        return map_future
+
+    @override
+    def get_progress(self, job: Future) -> Optional[ImageGen.Progress]:
+        return self._client.get_progress(job)
+
+    @override
+    def interrupt(self, job: Future) -> None:
+        self._client.interrupt(job)
+
+    @override
+    def get_cache_context(self, **kwargs) -> Dict[str, Any]:
+        checkpoint = (kwargs.get("override_settings") or {}).get("sd_model_checkpoint") or self._client.get_current_sd_model()
+        return {"server": self._client.name, "sd_model_checkpoint": checkpoint}
+
+    @property
+    def client(self) -> Automatic1111Client:
+        return self._client
 
     @override
     def get_txt2img_method(self) -> Callable:
@@ -0,0 +1,300 @@
+''' Shared, queued client for an AUTOMATIC1111 webui server '''
+from __future__ import annotations
+
+import logging
+import time
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from queue import Full, Queue
+from threading import Lock, Thread
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+import requests
+import webuiapi
+from requests.adapters import HTTPAdapter
+
+from image_gen import ImageGen
+from image_gen_backends.automatic1111_transport import DeferredDecodeWebUIApi, ImageTransport
+from utils.capability_catalog import CapabilityCatalog
+
+logger = logging.getLogger(__file__)
+
+
+class TimeoutSession(requests.Session):
+    '''
+    A requests Session with a default timeout, since webuiapi does not pass one
+    '''
+
+    def __init__(self, timeout: Union[float, Tuple[Optional[float], Optional[float]]] = None):
+        super().__init__()
+        self.timeout: Union[float, Tuple[Optional[float], Optional[float]]] = timeout
+
+    def request(self, *args, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(*args, **kwargs)
+
+
+class Automatic1111Client:
+    '''
+    One client per webui host. Owns a single pooled HTTP session and a bounded job queue which is
+    drained by a worker thread, so generation requests reach the (single GPU) server one at a time
+    while callers wait on a Future instead of holding a connection open.
+    '''
+    _clients: Dict[Tuple[str, int], Automatic1111Client] = {}
+    _clients_lock: Lock = Lock()
+    # The loaded checkpoint is looked up for every cached request, so it is remembered briefly and never waited on for long
+    CURRENT_SD_MODEL_TTL: float = 30
+    CURRENT_SD_MODEL_TIMEOUT: float = 5
+
+    @dataclass
+    class Job:
+        method: str
+        kwargs: Dict[str, Any] = field(default_factory=dict)
+        future: Future = field(default_factory=Future)
+
+    def __init__(self, api_host: str, api_port: int, queue_size: int = 16, workers: int = 1, http_pool_size: int = 8, decode_workers: int = 2,
+                 request_timeout: float = None, connect_timeout: float = None, catalog: CapabilityCatalog = None):
+        '''
+        Initialize an Automatic1111Client. Prefer get_client, which shares clients per host
+
+        Args:
+            api_host (str): webui host
+            api_port (int): webui port
+            queue_size (int, optional): maximum number of generation jobs waiting for the server
+            workers (int, optional): number of jobs to send to the server at once
+            http_pool_size (int, optional): number of pooled HTTP connections to keep to the server
+            decode_workers (int, optional): number of threads decoding response images
+            request_timeout (float, optional): seconds to wait for the server to respond to a request, None waits forever
+            connect_timeout (float, optional): seconds to wait for a connection to the server, None waits forever
+            catalog (CapabilityCatalog, optional): persists model lists between runs, so they don't have to be fetched at startup
+        '''
+        self._host: str = api_host
+        self._port: int = int(api_port)
+        self._api: webuiapi.WebUIApi = DeferredDecodeWebUIApi(host=api_host, port=api_port)
+        self._api.session = TimeoutSession(timeout=(connect_timeout, request_timeout))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=http_pool_size)
+        self._api.session.mount("http://", adapter)
+        self._api.session.mount("https://", adapter)
+
+        self._queue: Queue = Queue(maxsize=queue_size)
+        self._decode_pool: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=decode_workers, thread_name_prefix=f"a1111_decode_{api_host}:{api_port}")
+        self._outstanding_lock: Lock = Lock()
+        self._outstanding: int = 0
+        self._running_jobs: List[Automatic1111Client.Job] = []
+        self._catalog: CapabilityCatalog = catalog
+        self._capability_cache: Dict[str, Any] = {}
+        # (checkpoint title, time.monotonic() it was read)
+        self._current_sd_model: Tuple[Optional[str], float] = (None, float("-inf"))
+
+        self._workers: List[Thread] = [Thread(target=self._worker_func, name=f"a1111_{api_host}:{api_port}_{idx}", daemon=True)
+                                       for idx in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    @classmethod
+    def get_client(cls, api_host: str, api_port: int, **kwargs) -> Automatic1111Client:
+        '''
+        Returns the shared client for a host, creating it if needed
+
+        Args:
+            api_host (str): webui host
+            api_port (int): webui port
+            kwargs: passed to the constructor if a new client is created
+
+        Returns:
+            Automatic1111Client: the client for the host
+        '''
+        key = (api_host, int(api_port))
+        with cls._clients_lock:
+            if key not in cls._clients:
+                cls._clients[key] = Automatic1111Client(api_host=api_host, api_port=api_port, **kwargs)
+            return cls._clients[key]
+
+    def submit(self, method: str, timeout: float = None, **kwargs) -> Future:
+        '''
+        Queue a call to a webuiapi.WebUIApi method
+
+        Args:
+            method (str): name of the WebUIApi method to call, eg 'txt2img'
+            timeout (float, optional): how long to wait for space in the queue. None waits forever
+            kwargs: arguments for the method
+
+        Returns:
+            Future: resolves to the method's return value
+        '''
+        job = Automatic1111Client.Job(method=method, kwargs=kwargs)
+        with self._outstanding_lock:
+            self._outstanding += 1
+        try:
+            self._queue.put(job, timeout=timeout)
+        except Full:
+            with self._outstanding_lock:
+                self._outstanding -= 1
+            raise Exception(f"Automatic1111 request queue for {self._host}:{self._port} is full")
+        return job.future
+
+    def _worker_func(self):
+        ''' Background worker which sends queued jobs to the server '''
+        while True:
+            job: Automatic1111Client.Job = self._queue.get()
+            try:
+                if not job.future.set_running_or_notify_cancel():
+                    continue
+                with self._outstanding_lock:
+                    self._running_jobs.append(job)
+                try:
+                    result = getattr(self._api, job.method)(**job.kwargs)
+                except Exception as e:
+                    traceback.print_exception(e)
+                    logger.error(f"Automatic1111 {job.method} failed: {e}")
+                    job.future.set_exception(e)
+                    continue
+                finally:
+                    with self._outstanding_lock:
+                        self._running_jobs.remove(job)
+                if isinstance(result, DeferredDecodeWebUIApi.RawResult):
+                    # Hand image decoding to the pool so the next job can go to the server right away
+                    self._decode_pool.submit(self._decode_func, job, result)
+                else:
+                    job.future.set_result(result)
+            finally:
+                with self._outstanding_lock:
+                    self._outstanding -= 1
+                self._queue.task_done()
+
+    def _decode_func(self, job: Automatic1111Client.Job, raw_result: DeferredDecodeWebUIApi.RawResult):
+        try:
+            job.future.set_result(ImageTransport.decode_result(raw_result))
+        except Exception as e:
+            logger.error(f"Failed to decode Automatic1111 {job.method} response: {e}")
+            job.future.set_exception(e)
+
+    def _is_running_on_server(self, future: Future) -> bool:
+        with self._outstanding_lock:
+            return any(job.future is future for job in self._running_jobs)
+
+    def get_progress(self, future: Future) -> Optional[ImageGen.Progress]:
+        '''
+        Returns the progress of a job submitted to this client
+
+        Args:
+            future (Future): future returned by submit
+
+        Returns:
+            Optional[ImageGen.Progress]: the job's progress
+        '''
+        if future.done():
+            return ImageGen.Progress(progress=1.0)
+        if not future.running():
+            return ImageGen.Progress(queued=True)
+        if not self._is_running_on_server(future):
+            # Finished on the server, response is being decoded
+            return ImageGen.Progress(progress=1.0)
+
+        ret = self._api.session.get(url=f"{self._api.baseurl}/progress", params={"skip_current_image": False}).json()
+        preview = ImageTransport.decode_image(ret["current_image"]) if ret.get("current_image") else None
+        return ImageGen.Progress(progress=ret.get("progress", 0.0), eta=ret.get("eta_relative", 0.0), preview=preview)
+
+    def interrupt(self, future: Future) -> None:
+        '''
+        Stops a job. Queued jobs are dropped, running jobs are interrupted on the server and resolve to a partial result
+
+        Args:
+            future (Future): future returned by submit
+        '''
+        if future.cancel():
+            return
+        if self._is_running_on_server(future):
+            logger.info(f"Interrupting image generation on {self.name}")
+            self._api.session.post(url=f"{self._api.baseurl}/interrupt")
+
+    def _get_capability(self, name: str, loader: Callable[[], Any], refresh: bool = False) -> Any:
+        '''
+        Returns a capability list of the server, from the catalog if there is one
+
+        Args:
+            name (str): capability name
+            loader (Callable[[], Any]): fetches the list from the server
+            refresh (bool, optional): fetch the list now, even if it is cataloged
+        '''
+        if refresh:
+            self.update_capability(name, loader())
+        elif self._catalog is not None:
+            return self._catalog.get(self._capability_key(name), loader)
+        elif name not in self._capability_cache:
+            self._capability_cache[name] = loader()
+        return self._capability_cache[name]
+
+    def _capability_key(self, name: str) -> str:
+        return f"automatic1111/{self.name}/{name}"
+
+    def update_capability(self, name: str, value: Any) -> None:
+        '''
+        Records a freshly fetched capability list
+
+        Args:
+            name (str): capability name, eg 'sd_models'
+            value (Any): the list
+        '''
+        self._capability_cache[name] = value
+        if self._catalog is not None:
+            self._catalog.put(self._capability_key(name), value)
+
+    def peek_capability(self, name: str) -> Optional[Any]:
+        ''' Returns a known capability list without contacting the server, None if it is not known '''
+        if name in self._capability_cache:
+            return self._capability_cache[name]
+        return self._catalog.peek(self._capability_key(name)) if self._catalog is not None else None
+
+    def get_controlnet_models(self, refresh: bool = False) -> List[str]:
+        return list(self._get_capability("controlnet_models", lambda: self._api.custom_get("controlnet/model_list")["model_list"], refresh=refresh))
+
+    def get_controlnet_modules(self, refresh: bool = False) -> List[str]:
+        return list(self._get_capability("controlnet_modules", lambda: self._api.custom_get("controlnet/module_list")["module_list"], refresh=refresh))
+
+    def get_current_sd_model(self, max_age: float = CURRENT_SD_MODEL_TTL) -> Optional[str]:
+        '''
+        Returns the title of the checkpoint loaded on the server
+
+        Args:
+            max_age (float, optional): seconds a previously read checkpoint may be reused for
+
+        Returns:
+            Optional[str]: the checkpoint title
+        '''
+        checkpoint, updated = self._current_sd_model
+        if time.monotonic() - updated <= max_age:
+            return checkpoint
+        # Not the request timeout, which allows for slow generations
+        response = self._api.session.get(url=f"{self._api.baseurl}/options", timeout=Automatic1111Client.CURRENT_SD_MODEL_TIMEOUT)
+        response.raise_for_status()
+        checkpoint = response.json().get("sd_model_checkpoint")
+        self.set_current_sd_model(checkpoint)
+        return checkpoint
+
+    def set_current_sd_model(self, checkpoint: Optional[str]) -> None:
+        ''' Records the checkpoint loaded on the server, eg as read by a health check '''
+        self._current_sd_model = (checkpoint, time.monotonic())
+
+    def peek_current_sd_model(self) -> Optional[str]:
+        ''' Returns the last read checkpoint without contacting the server, None if it has not been read '''
+        return self._current_sd_model[0]
+
+    def get_sd_models(self, refresh: bool = False) -> List[str]:
+        ''' Returns the titles of the server's Stable Diffusion checkpoints '''
+        return list(self._get_capability("sd_models", lambda: [model["title"] for model in self._api.get_sd_models()], refresh=refresh))
+
+    @property
+    def api(self) -> webuiapi.WebUIApi:
+        ''' The underlying api, for quick calls which should not wait behind queued generation jobs. Calls which return images give undecoded results '''
+        return self._api
+
+    @property
+    def name(self) -> str:
+        return f"{self._host}:{self._port}"
+
+    @property
+    def outstanding(self) -> int:
+        ''' Number of jobs queued or running '''
+        return self._outstanding
@@ -0,0 +1,314 @@
+''' Load-balanced pool of AUTOMATIC1111 webui servers '''
+from __future__ import annotations
+
+import logging
+import weakref
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from threading import Event, Lock, Thread
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import requests
+import webuiapi
+from PIL import Image
+from typing_extensions import override
+from webuiapi import ControlNetUnit
+
+from image_gen import ImageGen
+from image_gen_backends.automatic1111 import Automatic1111
+from utils.capability_catalog import CapabilityCatalog
+
+logger = logging.getLogger(__file__)
+
+
+class Automatic1111Pool(ImageGen):
+    '''
+    Routes requests across several webui servers. Each request goes to the healthy server with the fewest
+    outstanding requests among those which have the models it needs, and is retried on another server if
+    the chosen one times out or cannot be reached.
+    '''
+    BACKEND_NAME: str = "AUTOMATIC1111_POOL"
+    FAILOVER_ERRORS: Tuple[type] = (requests.exceptions.Timeout, requests.exceptions.ConnectionError)
+
+    @dataclass
+    class Endpoint:
+        backend: Automatic1111
+        healthy: bool = False
+        sd_models: Set[str] = field(default_factory=set)
+        controlnet_models: Set[str] = field(default_factory=set)
+        controlnet_modules: Set[str] = field(default_factory=set)
+
+        @property
+        def name(self) -> str:
+            return self.backend.client.name
+
+    def __init__(self, endpoints: List[Tuple[str, int]], queue_size: int = 16, request_timeout: float = None, connect_timeout: float = None,
+                 health_check_interval: float = 30, health_check_timeout: float = 5, catalog: CapabilityCatalog = None):
+        '''
+        Initialize an Automatic1111Pool
+
+        Args:
+            endpoints (List[Tuple[str, int]]): (host, port) of each webui server
+            queue_size (int, optional): maximum number of requests waiting on each server
+            request_timeout (float, optional): seconds to wait on a server before failing over to another
+            connect_timeout (float, optional): seconds to wait for a connection to a server before failing over to another
+            health_check_interval (float, optional): seconds between health and capability checks
+            health_check_timeout (float, optional): seconds to wait for a health check response
+            catalog (CapabilityCatalog, optional): servers with cataloged models start out healthy, instead of waiting for the first check
+        '''
+        self._endpoints: List[Automatic1111Pool.Endpoint] = [
+            Automatic1111Pool.Endpoint(backend=Automatic1111(api_host=host, api_port=port, queue_size=queue_size, request_timeout=request_timeout,
+                                                             connect_timeout=connect_timeout, catalog=catalog))
+            for host, port in endpoints]
+        self._lock: Lock = Lock()
+        self._health_check_interval: float = health_check_interval
+        self._health_check_timeout: float = health_check_timeout
+        self._stop_event: Event = Event()
+        self._first_check_event: Event = Event()
+        # Pool future -> (server, that server's future) for the attempt currently in flight
+        self._attempts: Dict[Future, Tuple[Automatic1111Pool.Endpoint, Future]] = {}
+        # Pool future -> server which completed it
+        self._completed_on: weakref.WeakKeyDictionary[Future, Automatic1111Pool.Endpoint] = weakref.WeakKeyDictionary()
+
+        for endpoint in self._endpoints:
+            self._seed_endpoint(endpoint)
+        # The first check runs on the health thread too, so startup doesn't wait on the servers
+        self._health_thread: Thread = Thread(target=self._health_worker_func, name="a1111_pool_health", daemon=True)
+        self._health_thread.start()
+
+    def check_health(self):
+        ''' Checks every server's health and refreshes what models it has '''
+        for endpoint in self._endpoints:
+            self._check_endpoint(endpoint)
+
+    def _seed_endpoint(self, endpoint: Automatic1111Pool.Endpoint):
+        ''' Fills in an endpoint's models from the catalog, assuming it is healthy until the first check says otherwise '''
+        client = endpoint.backend.client
+        sd_models = client.peek_capability("sd_models")
+        if sd_models is None:
+            return
+        endpoint.sd_models = set(sd_models)
+        endpoint.controlnet_models = set(client.peek_capability("controlnet_models") or [])
+        endpoint.controlnet_modules = set(client.peek_capability("controlnet_modules") or [])
+        endpoint.healthy = True
+
+    def _check_endpoint(self, endpoint: Automatic1111Pool.Endpoint):
+        client = endpoint.backend.client
+        session = client.api.session
+        was_healthy = endpoint.healthy
+        try:
+            response = session.get(url=f"{client.api.baseurl}/progress", timeout=self._health_check_timeout)
+            response.raise_for_status()
+            response = session.get(url=f"{client.api.baseurl}/sd-models", timeout=self._health_check_timeout)
+            response.raise_for_status()
+            sd_models = set()
+            for model in response.json():
+                sd_models.update([model.get("title"), model.get("model_name")])
+            client.update_capability("sd_models", sorted(name for name in sd_models if name))
+            response = session.get(url=f"{client.api.baseurl}/options", timeout=self._health_check_timeout)
+            response.raise_for_status()
+            client.set_current_sd_model(response.json().get("sd_model_checkpoint"))
+            try:
+                # The client's own calls use the request timeout, which allows for slow generations
+                response = session.get(url=client.api.get_endpoint("controlnet/model_list", False), timeout=self._health_check_timeout)
+                response.raise_for_status()
+                model_list = response.json()["model_list"]
+                response = session.get(url=client.api.get_endpoint("controlnet/module_list", False), timeout=self._health_check_timeout)
+                response.raise_for_status()
+                module_list = response.json()["module_list"]
+                client.update_capability("controlnet_models", model_list)
+                client.update_capability("controlnet_modules", module_list)
+                controlnet_models, controlnet_modules = set(model_list), set(module_list)
+            except Exception as e:
+                logger.info(f"No ControlNet on {endpoint.name}: {e}")
+                controlnet_models, controlnet_modules = set(), set()
+            with self._lock:
+                endpoint.sd_models, endpoint.controlnet_models, endpoint.controlnet_modules = sd_models, controlnet_models, controlnet_modules
+                endpoint.healthy = True
+        except Exception as e:
+            with self._lock:
+                endpoint.healthy = False
+            if was_healthy:
+                logger.warning(f"Image gen server {endpoint.name} is unhealthy: {e}")
+            return
+        if not was_healthy:
+            logger.info(f"Image gen server {endpoint.name} is healthy")
+
+    def _health_worker_func(self):
+        self.check_health()
+        self._first_check_event.set()
+        while not self._stop_event.wait(self._health_check_interval):
+            self.check_health()
+
+    def _pick_endpoint(self, requirements: Dict[str, Set[str]], exclude: List[Automatic1111Pool.Endpoint]) -> Optional[Automatic1111Pool.Endpoint]:
+        '''
+        Returns the least loaded healthy server meeting the requirements
+
+        Args:
+            requirements (Dict[str, Set[str]]): Endpoint capability attribute name -> names which must be in it
+            exclude (List[Automatic1111Pool.Endpoint]): servers which already failed this request
+        '''
+        with self._lock:
+            candidates = [endpoint for endpoint in self._endpoints if endpoint.healthy and endpoint not in exclude and
+                          all(needed <= getattr(endpoint, capability) for capability, needed in requirements.items())]
+            if not candidates:
+                return None
+            return min(candidates, key=lambda endpoint: endpoint.backend.client.outstanding)
+
+    def _submit(self, func: Callable[[Automatic1111], Future], requirements: Dict[str, Set[str]]) -> Future:
+        '''
+        Runs func on a server, failing over to another server on timeouts and connection errors
+
+        Args:
+            func (Callable[[Automatic1111], Future]): starts the request on the given backend
+            requirements (Dict[str, Set[str]]): capabilities the server must have
+
+        Returns:
+            Future: resolves to the result from whichever server completed the request
+        '''
+        pool_future = Future()
+        tried: List[Automatic1111Pool.Endpoint] = []
+
+        def try_next(error: Exception = None):
+            endpoint = self._pick_endpoint(requirements, exclude=tried)
+            if endpoint is None and not self._first_check_event.is_set():
+                # Nothing cataloged for these servers, wait until they have been checked once
+                self._first_check_event.wait()
+                endpoint = self._pick_endpoint(requirements, exclude=tried)
+            if endpoint is None:
+                pool_future.set_exception(error or Exception(f"No healthy image gen server has {requirements}"))
+                return
+            tried.append(endpoint)
+            try:
+                future = func(endpoint.backend)
+            except Exception as e:
+                pool_future.set_exception(e)
+                return
+            with self._lock:
+                self._attempts[pool_future] = (endpoint, future)
+            future.add_done_callback(lambda done: on_done(endpoint, done))
+
+        def on_done(endpoint: Automatic1111Pool.Endpoint, done: Future):
+            with self._lock:
+                self._attempts.pop(pool_future, None)
+            if pool_future.cancelled():
+                return
+            if done.cancelled():
+                pool_future.cancel()
+                return
+            error = done.exception()
+            if error is None:
+                with self._lock:
+                    self._completed_on[pool_future] = endpoint
+                pool_future.set_result(done.result())
+            elif isinstance(error, Automatic1111Pool.FAILOVER_ERRORS):
+                logger.warning(f"Image gen server {endpoint.name} failed, trying another: {error}")
+                with self._lock:
+                    endpoint.healthy = False
+                try_next(error)
+            else:
+                pool_future.set_exception(error)
+
+        try_next()
+        return pool_future
+
+    @classmethod
+    def _get_requirements(cls, controlnet_units: Optional[List[ControlNetUnit]], **kwargs) -> Dict[str, Set[str]]:
+        ''' Returns the models a request needs '''
+        requirements: Dict[str, Set[str]] = {}
+        checkpoint = (kwargs.get("override_settings") or {}).get("sd_model_checkpoint")
+        if checkpoint:
+            requirements["sd_models"] = {checkpoint}
+        units = controlnet_units or []
+        models = {unit.model for unit in units if unit.model and unit.model != "None"}
+        modules = {unit.module for unit in units if unit.module and unit.module != ImageGen.CONTROLNET_NO_MODULE}
+        if models:
+            requirements["controlnet_models"] = models
+        if modules:
+            requirements["controlnet_modules"] = modules
+        return requirements
+
+    @override
+    def gen_image(self, prompt: str, input_image: Image.Image = None, controlnet_units: Optional[List[ControlNetUnit]] = None, **kwargs) -> Optional[str]:
+        return self.gen_image_async(prompt=prompt, input_image=input_image, controlnet_units=controlnet_units, **kwargs).result()
+
+    @override
+    def gen_image_async(self, prompt: str, input_image: Image.Image = None, controlnet_units: Optional[List[ControlNetUnit]] = None, **kwargs) -> Future:
+        return self._submit(lambda backend: backend.gen_image_async(prompt=prompt, input_image=input_image, controlnet_units=controlnet_units, **kwargs),
+                            Automatic1111Pool._get_requirements(controlnet_units, **kwargs))
+
+    @override
+    def detect_controlnet_map(self, module: str, image: Image.Image, processor_res: int = 512, threshold_a: float = 64, threshold_b: float = 64) -> Optional[Image.Image]:
+        return self._submit(lambda backend: backend.detect_controlnet_map_async(module=module, image=image, processor_res=processor_res,
+                                                                                threshold_a=threshold_a, threshold_b=threshold_b),
+                            {"controlnet_modules": {module}}).result()
+
+    @override
+    def get_progress(self, job: Future) -> Optional[ImageGen.Progress]:
+        if job.done():
+            return ImageGen.Progress(progress=1.0)
+        with self._lock:
+            attempt = self._attempts.get(job)
+        if attempt is None:
+            return ImageGen.Progress(queued=True)
+        endpoint, future = attempt
+        return endpoint.backend.get_progress(future)
+
+    @override
+    def interrupt(self, job: Future) -> None:
+        with self._lock:
+            attempt = self._attempts.get(job)
+        if attempt is not None:
+            endpoint, future = attempt
+            endpoint.backend.interrupt(future)
+
+    @override
+    def get_cache_context(self, controlnet_units: Optional[List[ControlNetUnit]] = None, **kwargs) -> Dict[str, Any]:
+        # A request naming a checkpoint gets it on whichever server runs it. Otherwise it is the checkpoint of the server the
+        # request would go to now, as read by the last health check. get_job_cache_context corrects it if another one runs it
+        checkpoint = (kwargs.get("override_settings") or {}).get("sd_model_checkpoint")
+        if checkpoint:
+            return {"sd_model_checkpoint": checkpoint}
+        requirements = Automatic1111Pool._get_requirements(controlnet_units, **kwargs)
+        endpoint = self._pick_endpoint(requirements, exclude=[])
+        if endpoint is None and not self._first_check_event.is_set():
+            self._first_check_event.wait()
+            endpoint = self._pick_endpoint(requirements, exclude=[])
+        if endpoint is None:
+            raise Exception("No healthy image gen server")
+        return {"sd_model_checkpoint": self._get_loaded_checkpoint(endpoint)}
+
+    @override
+    def get_job_cache_context(self, job: Future, **kwargs) -> Optional[Dict[str, Any]]:
+        if (kwargs.get("override_settings") or {}).get("sd_model_checkpoint"):
+            return None
+        with self._lock:
+            endpoint = self._completed_on.get(job)
+        if endpoint is None:
+            raise Exception("Job did not complete on any server")
+        return {"sd_model_checkpoint": self._get_loaded_checkpoint(endpoint)}
+
+    @classmethod
+    def _get_loaded_checkpoint(cls, endpoint: Automatic1111Pool.Endpoint) -> str:
+        checkpoint = endpoint.backend.client.peek_current_sd_model()
+        if checkpoint is None:
+            raise Exception(f"Checkpoint loaded on {endpoint.name} is not known yet")
+        return checkpoint
+
+    @override
+    def get_controlnet_models(self) -> List[str]:
+        with self._lock:
+            return sorted(set().union(*[endpoint.controlnet_models for endpoint in self._endpoints if endpoint.healthy]))
+
+    @override
+    def get_controlnet_modules(self) -> List[str]:
+        with self._lock:
+            return sorted(set().union(*[endpoint.controlnet_modules for endpoint in self._endpoints if endpoint.healthy]))
+
+    @override
+    def get_txt2img_method(self) -> Callable:
+        return webuiapi.WebUIApi.txt2img
+
+    @override
+    def get_img2img_method(self) -> Callable:
+        return webuiapi.WebUIApi.img2img
@@ -0,0 +1,154 @@
+''' Image encoding/decoding for requests to and from an AUTOMATIC1111 webui server '''
+from __future__ import annotations
+
+import base64
+import io
+import json
+import logging
+import weakref
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Dict, Tuple
+
+import webuiapi
+import webuiapi.webuiapi
+from PIL import Image
+
+logger = logging.getLogger(__file__)
+
+
+class ImageTransport:
+    '''
+    Encodes request images in a configurable wire format, memoizing the encoded payload per image object
+    so the same thumbnail sent to several ControlNet units (or several requests) is only encoded once.
+    '''
+    WIRE_FORMATS = ["png", "webp", "jpeg"]
+
+    _wire_format: str = "png"
+    _quality: int = 90
+    _memo_size: int = 32
+    _memo: OrderedDict[Tuple[int, bool], Tuple[weakref.ref, str]] = OrderedDict()
+    _memo_lock: Lock = Lock()
+    _stats: Dict[str, int] = {"hits": 0, "misses": 0}
+
+    @classmethod
+    def install(cls, wire_format: str = "png", quality: int = 90, memo_size: int = 32):
+        '''
+        Configures the transport and routes webuiapi's image encoding through it
+
+        Args:
+            wire_format (str, optional): 'png', lossless 'webp' or 'jpeg' (lossy, best for previews)
+            quality (int, optional): JPEG quality
+            memo_size (int, optional): number of encoded images to remember
+        '''
+        if wire_format not in ImageTransport.WIRE_FORMATS:
+            raise Exception(f"Unsupported image wire format: {wire_format}")
+        cls._wire_format = wire_format
+        cls._quality = quality
+        cls._memo_size = memo_size
+        with cls._memo_lock:
+            cls._memo.clear()
+
+        # webuiapi looks these up as module globals when building payloads (including ControlNetUnit.to_dict)
+        webuiapi.webuiapi.b64_img = lambda image: ImageTransport.encode(image, data_url=True)
+        webuiapi.webuiapi.raw_b64_img = lambda image: ImageTransport.encode(image, data_url=False)
+        webuiapi.b64_img = webuiapi.webuiapi.b64_img
+        webuiapi.raw_b64_img = webuiapi.webuiapi.raw_b64_img
+
+    @classmethod
+    def encode(cls, image: Image.Image, data_url: bool = False) -> str:
+        '''
+        Base64 encode an image in the configured wire format
+
+        Args:
+            image (Image.Image): image to encode. Must not be modified in place after being encoded
+            data_url (bool, optional): if True prefix the payload with a data URL header
+
+        Returns:
+            str: the encoded image
+        '''
+        key = (id(image), data_url)
+        with cls._memo_lock:
+            entry = cls._memo.get(key)
+            if entry is not None and entry[0]() is image:
+                cls._memo.move_to_end(key)
+                cls._stats["hits"] += 1
+                return entry[1]
+            cls._stats["misses"] += 1
+
+        buffered = io.BytesIO()
+        if cls._wire_format == "jpeg":
+            image.convert("RGB").save(buffered, format="JPEG", quality=cls._quality)
+        elif cls._wire_format == "webp":
+            image.save(buffered, format="WEBP", lossless=True)
+        else:
+            image.save(buffered, format="PNG")
+        payload = str(base64.b64encode(buffered.getvalue()), 'utf-8')
+        if data_url:
+            payload = f"data:image/{cls._wire_format};base64,{payload}"
+
+        with cls._memo_lock:
+            cls._memo[key] = (weakref.ref(image), payload)
+            cls._memo.move_to_end(key)
+            while len(cls._memo) > cls._memo_size:
+                cls._memo.popitem(last=False)
+        return payload
+
+    @classmethod
+    def decode_result(cls, response: Dict[str, Any]) -> webuiapi.WebUIApiResult:
+        '''
+        Decodes a webui JSON response into a WebUIApiResult, fully loading the images
+
+        Args:
+            response (Dict[str, Any]): decoded JSON body of a generation response
+
+        Returns:
+            webuiapi.WebUIApiResult: the result
+        '''
+        encoded = response.get("images", [response["image"]] if "image" in response else [])
+        images = [ImageTransport.decode_image(data) for data in encoded]
+
+        info = response.get("info", response.get("html_info", ""))
+        if "info" in response:
+            try:
+                info = json.loads(info)
+            except Exception:
+                pass
+        return webuiapi.WebUIApiResult(images, response.get("parameters", ""), info)
+
+    @classmethod
+    def decode_image(cls, data: str) -> Image.Image:
+        '''
+        Decodes a base64 image (with or without a data URL header), fully loading it
+
+        Args:
+            data (str): encoded image
+
+        Returns:
+            Image.Image: decoded image
+        '''
+        if data.startswith("data:"):
+            data = data.split(",", 1)[1]
+        image = Image.open(io.BytesIO(base64.b64decode(data)))
+        # Force decompression now rather than on whichever thread first touches the pixels
+        image.load()
+        return image
+
+    @classmethod
+    def get_stats(cls) -> Dict[str, int]:
+        ''' Returns encode memo hit/miss counts '''
+        return cls._stats.copy()
+
+
+class DeferredDecodeWebUIApi(webuiapi.WebUIApi):
+    '''
+    A WebUIApi whose generation calls return the undecoded JSON response (as a RawResult), so that
+    decoding can be done off the thread which talks to the server
+    '''
+    class RawResult(dict):
+        pass
+
+    def _to_api_result(self, response):
+        if response.status_code != 200:
+            raise RuntimeError(response.status_code, response.text)
+        return DeferredDecodeWebUIApi.RawResult(response.json())
@@ -7,8 +7,11 @@ from io import BytesIO
 from typing import List, Optional, Tuple, Dict, Any
 import wave
 import re
+from dataclasses import asdict, dataclass, field
+from threading import Lock
 from tts import Tts
 from typing_extensions import override
+from utils.capability_catalog import CapabilityCatalog
 
 import logging
 logger = logging.getLogger(__file__)
@@ -18,27 +21,95 @@ class AzureTts(Tts):
     DEFAULT_STYLE: str = "general"
     BACKEND_NAME: str = "azure_tts"
 
-    def __init__(self, api_key: str, api_region: str, voice_locale: str = "en-US"):
+    @dataclass
+    class VoiceData:
+        ''' The parts of a speechsdk.VoiceInfo which are used, in a form which can be cataloged '''
+        local_name: str
+        short_name: str
+        locale: str
+        style_list: List[str] = field(default_factory=list)
+
+        @classmethod
+        def from_voice_info(cls, voice_info: speechsdk.VoiceInfo) -> AzureTts.VoiceData:
+            return AzureTts.VoiceData(local_name=voice_info.local_name, short_name=voice_info.short_name,
+                                      locale=voice_info.locale, style_list=list(voice_info.style_list))
+
+    def __init__(self, api_key: str, api_region: str, voice_locale: str = "en-US", catalog: CapabilityCatalog = None):
+        '''
+        Initialize AzureTts. Voices are loaded per locale on first use
+
+        Args:
+            api_key (str): Azure speech API key
+            api_region (str): Azure region
+            voice_locale (str, optional): locale of the voices returned by get_voice_list
+            catalog (CapabilityCatalog, optional): persists voice lists between runs, so they don't have to be fetched at startup
+        '''
         # Create configuration
         self._speech_config: speechsdk.SpeechConfig = speechsdk.SpeechConfig(subscription=api_key, region=api_region)
         self._speech_config.set_speech_synthesis_output_format(
             speechsdk.SpeechSynthesisOutputFormat.Riff44100Hz16BitMonoPcm)
 
         self._locale: str = voice_locale
+        self._region: str = api_region
         self._pitch: str = None
         self._rate: str = None
-
-        synthesizer = self._get_synthesizer()
-        voices = synthesizer.get_voices_async(locale=voice_locale).get().voices
-        self._voices: List[AzureTts.Voice] = [AzureTts.Voice(tts_inst=self, voice_info=voice) for voice in voices]
+        self._catalog: CapabilityCatalog = catalog
+        self._voices_lock: Lock = Lock()
+        self._locale_voices: Dict[str, List[AzureTts.Voice]] = {}
+        if self._catalog is not None:
+            self._catalog.add_refresh_listener(self._on_catalog_refresh)
 
     @override
     def get_voice_list(self) -> List[Tts.Voice]:
-        return self._voices.copy()
+        return self.get_locale_voice_list(self._locale)
+
+    def get_locale_voice_list(self, locale: str) -> List[Tts.Voice]:
+        '''
+        Returns the voices of a locale, loading them on first use
+
+        Args:
+            locale (str): locale, eg 'en-US'
+
+        Returns:
+            List[Tts.Voice]: the voices
+        '''
+        # Looked up on every call so stale entries get refreshed, and not under the lock: a first load waits on the
+        # catalog's refresh, whose listener takes the lock
+        voice_data = None
+        if self._catalog is not None:
+            voice_data = self._catalog.get(self._catalog_key(locale), lambda: self._fetch_voice_data(locale))
+        with self._voices_lock:
+            voices = self._locale_voices.get(locale)
+        if voices is None:
+            if voice_data is None:
+                voice_data = self._fetch_voice_data(locale)
+            voices = [AzureTts.Voice(tts_inst=self, voice_info=AzureTts.VoiceData(**data)) for data in voice_data]
+            with self._voices_lock:
+                voices = self._locale_voices.setdefault(locale, voices)
+        return voices.copy()
+
+    def _catalog_key(self, locale: str) -> str:
+        return f"azure_tts/{self._region}/voices/{locale}"
+
+    def _on_catalog_refresh(self, key: str) -> None:
+        ''' Drops the voices of a locale once its catalog entry has been refreshed, they are rebuilt on next use '''
+        with self._voices_lock:
+            for locale in [locale for locale in self._locale_voices if self._catalog_key(locale) == key]:
+                del self._locale_voices[locale]
+
+    def _fetch_voice_data(self, locale: str) -> List[Dict[str, Any]]:
+        ''' Fetches the voice list of a locale from Azure '''
+        result = self._get_synthesizer().get_voices_async(locale=locale).get()
+        if result.reason != speechsdk.ResultReason.VoicesListRetrieved:
+            raise Exception(f"Failed to get Azure voices for [{locale}]: {result.error_details}")
+        return [asdict(AzureTts.VoiceData.from_voice_info(voice)) for voice in result.voices]
 
     @override
     def get_voice(self, name: str) -> Optional[Tts.Voice]:
-        matches = [voice for voice in self._voices if voice.get_name() == name]
+        self.get_voice_list()
+        with self._voices_lock:
+            loaded_voices = [voice for voices in self._locale_voices.values() for voice in voices]
+        matches = [voice for voice in loaded_voices if voice.get_name() == name]
         if matches:
             return matches[0]
         return None
@@ -54,8 +125,8 @@ class AzureTts(Tts):
 
     class Voice(Tts.Voice):
 
-        def __init__(self, tts_inst: AzureTts, voice_info: speechsdk.VoiceInfo):
-            self._voice_info: speechsdk.VoiceInfo = voice_info
+        def __init__(self, tts_inst: AzureTts, voice_info: AzureTts.VoiceData):
+            self._voice_info: AzureTts.VoiceData = voice_info
             self._cur_style: str = self.get_styles_available()[0]
             self._pitch: str = None
             self._rate: str = None
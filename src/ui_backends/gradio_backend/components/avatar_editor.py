@@ -3,6 +3,7 @@ from __future__ import annotations
 import logging
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from typing import Any, Dict, List, Tuple
 
@@ -10,9 +11,11 @@ import gradio as gr
 from gradio.components import Component
 from PIL import Image
 from typing_extensions import override
+from webuiapi import ControlNetUnit
 
 from avatar.profile import Profile
 from avatar.video_info import VideoInfo
+from image_gen import ImageGen
 from tts import Tts
 from ui_backends.gradio_backend.component import GradioComponent
 from ui_backends.gradio_backend.components.controlnet_settings import \
@@ -33,6 +36,9 @@ logger = logging.getLogger(__file__)
 
 
 class AvatarEditor(GradioComponent):
+    # ControlNet maps are detected here rather than in the gallery select handler
+    _detect_pool: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="controlnet_detect")
+
     @dataclass
     class StateData:
         profile: Profile = None
@@ -121,8 +127,11 @@ class AvatarEditor(GradioComponent):
         self._ui_save_video_btn.click(fn=self._handle_save_video_clicked, inputs=[
                                       self._ui_motion_matcher.output_video, self._ui_out_video_name, self.instance_data])
 
-        self._ui_new_driving_src_imagegen.output_image.change(
-            fn=lambda x: x, inputs=[self._ui_new_driving_src_imagegen.output_image], outputs=[self._ui_motion_matcher.input_image])
+        # Hand the selected image to the motion matcher on the server, rather than round tripping it through the browser
+        self._ui_new_driving_src_imagegen.selection_relay.change(
+            fn=lambda imagegen_data, matcher_data: self._ui_motion_matcher.set_source_image(matcher_data, imagegen_data.selected_image),
+            inputs=[self._ui_new_driving_src_imagegen.instance_data, self._ui_motion_matcher.instance_data],
+            outputs=[self._ui_motion_matcher.input_image])
 
         controlnet_settings = self._ui_new_driving_src_imagegen.controlnet_settings
         self._ui_new_driving_vid_gallery.select_event_relay.change(fn=self._handle_driving_vid_select,
@@ -195,11 +204,30 @@ class AvatarEditor(GradioComponent):
         return
 
     def _handle_driving_vid_select(self, gallery_data: VideoGallery.StateData, controlnet_data: ControlNetSettings.StateData, imggen_restore_relay: bool) -> [gr.Image, gr.Video, gr.Textbox, EventRelay]:
+        image_gen: ImageGen = ImageGenFactory.get_default_image_gen()
         for unit in controlnet_data.controlnet_items:
-            unit.func_params_state.init_args["input_image"] = gallery_data.selected_video.thumbnail
+            self._set_controlnet_input(unit, gallery_data.selected_video, image_gen)
 
         return (gallery_data.selected_video.thumbnail, gallery_data.selected_video.path, os.path.basename(gallery_data.selected_video.path), not imggen_restore_relay)
 
+    def _set_controlnet_input(self, unit: ControlNetSettings.MultiControlNetItem, video: VideoInfo, image_gen: ImageGen):
+        '''
+        Gives a ControlNet unit the video's thumbnail, and starts detecting its preprocessed map so the server does not re-run
+        the preprocessor on every generation. The map is only sent once ready, and while the unit's preprocessor settings match it
+        '''
+        init_args = unit.func_params_state.init_args
+        module = init_args.get("module", ImageGen.CONTROLNET_NO_MODULE)
+        init_args["input_image"] = video.thumbnail
+        unit.set_preprocessed_map(None)
+        if not unit.enabled or not module or module == ImageGen.CONTROLNET_NO_MODULE:
+            return
+
+        # Use the unit's preprocessor settings, falling back to ControlNetUnit defaults
+        settings = ControlNetUnit(**{key: value for key, value in init_args.items() if key != "input_image"})
+        unit.set_preprocessed_map_async(AvatarEditor._detect_pool.submit(
+            video.get_controlnet_map, module=module, detector=image_gen.detect_controlnet_map, processor_res=int(settings.processor_res),
+            threshold_a=settings.threshold_a, threshold_b=settings.threshold_b))
+
     def _handle_save_video_clicked(self, input_video_path: str, output_video_name: str, editor_state_data: AvatarEditor.StateData):
         output_path = os.path.join(editor_state_data.profile.motion_matched_video_directory, output_video_name)
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
@@ -3,6 +3,7 @@
 from __future__ import annotations
 
 import logging
+from concurrent.futures import Future
 from dataclasses import dataclass, field
 from typing import Any, Callable, Dict, List, Optional, Union
 
@@ -11,6 +12,7 @@ from gradio.components import Component
 from PIL import Image
 from webuiapi import ControlNetUnit
 
+from image_gen import ImageGen
 from ui_backends.gradio_backend.component import GradioComponent
 from ui_backends.gradio_backend.components.func_param_settings import \
     FuncParamSettings
@@ -29,6 +31,68 @@ class ControlNetSettings(GradioComponent):
     class MultiControlNetItem:
         enabled: bool = False
         func_params_state: FuncParamSettings.StateData = field(default_factory=FuncParamSettings.StateData)
+        # Precomputed preprocessor output for the unit's input image, sent instead while the unit's preprocessor settings
+        # and input image are still the ones it was made with
+        preprocessed_map: Optional[Image.Image] = None
+        preprocessed_settings: Optional[Dict[str, Any]] = None
+        # Detection of the map still running, see set_preprocessed_map_async
+        pending_map: Optional[Future] = None
+
+        def set_preprocessed_map(self, detected_map: Optional[Image.Image]):
+            ''' Stores the preprocessor output for the unit's current input image and settings, None to clear it '''
+            self.pending_map = None
+            # Settings first, to_unit only looks at them once there is a map
+            self.preprocessed_settings = self.get_preprocessor_settings() if detected_map is not None else None
+            self.preprocessed_map = detected_map
+
+        def set_preprocessed_map_async(self, detection: Future):
+            '''
+            Stores the preprocessor output for the unit's current input image and settings once it has been detected.
+            Until then, or if detection fails, the server preprocesses the input image itself
+
+            Args:
+                detection (Future): resolves to the detected map
+            '''
+            self.set_preprocessed_map(None)
+            settings = self.get_preprocessor_settings()
+            self.pending_map = detection
+
+            def set_map(done: Future):
+                # Superseded by a newer map or input image
+                if self.pending_map is not done:
+                    return
+                self.pending_map = None
+                if done.cancelled():
+                    return
+                if done.exception() is not None:
+                    logger.warning(f"ControlNet preprocessing with [{settings['module']}] failed, server will preprocess instead: {done.exception()}")
+                    return
+                if done.result() is not None:
+                    self.preprocessed_settings = settings
+                    self.preprocessed_map = done.result()
+            detection.add_done_callback(set_map)
+
+        def get_preprocessor_settings(self) -> Dict[str, Any]:
+            ''' Returns what the preprocessor output depends on, falling back to ControlNetUnit defaults '''
+            init_args = self.func_params_state.init_args
+            settings = ControlNetUnit(**{key: value for key, value in init_args.items() if key != "input_image"})
+            return {"input_image": init_args.get("input_image"), "module": settings.module, "processor_res": int(settings.processor_res),
+                    "threshold_a": settings.threshold_a, "threshold_b": settings.threshold_b}
+
+        def to_unit(self) -> ControlNetUnit:
+            ''' Returns the unit to send, with the precomputed map in place of the input image if it is still valid '''
+            unit_args = dict(self.func_params_state.init_args)
+            # The map may be set by a detection thread, read it once
+            preprocessed_map, preprocessed_settings = self.preprocessed_map, self.preprocessed_settings
+            if preprocessed_map is not None and preprocessed_settings is not None and self._matches_preprocessed(preprocessed_settings):
+                unit_args.update(input_image=preprocessed_map, module=ImageGen.CONTROLNET_NO_MODULE)
+            return ControlNetUnit(**unit_args)
+
+        def _matches_preprocessed(self, preprocessed_settings: Dict[str, Any]) -> bool:
+            current = self.get_preprocessor_settings()
+            # Compare the input image by identity, it is the thumbnail object the map was made from
+            return (current.pop("input_image") is preprocessed_settings["input_image"] and
+                    current == {key: value for key, value in preprocessed_settings.items() if key != "input_image"})
 
     @dataclass
     class StateData:
@@ -1,14 +1,14 @@
 from __future__ import annotations
 
 import logging
+from concurrent.futures import CancelledError, Future, TimeoutError
 from dataclasses import dataclass
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, Generator, List, Optional, Tuple
 
 import gradio as gr
 import numpy as np
 from gradio.components import Component
 from PIL import Image
-from webuiapi import ControlNetUnit
 
 from image_gen import ImageGen
 from ui_backends.gradio_backend.component import GradioComponent
@@ -24,9 +24,22 @@ logger = logging.getLogger(__file__)
 
 
 class ImageGenerator(GradioComponent):
+    PROGRESS_POLL_INTERVAL: float = 1.0
+    MAX_VARIANTS: int = 8
+
     @dataclass
     class StateData:
         image_gen: ImageGen = None
+        job: Future = None
+        images: List[Image.Image] = None
+        seeds: List[int] = None
+        selected_idx: int = 0
+
+        @property
+        def selected_image(self) -> Optional[Image.Image]:
+            if not self.images or self.selected_idx >= len(self.images):
+                return None
+            return self.images[self.selected_idx]
 
     def __init__(self):
         self._ui_image_in: gr.Image = None
@@ -35,6 +48,11 @@ class ImageGenerator(GradioComponent):
         self._ui_prompt_neg: gr.Textbox = None
         self._ui_txt2img_btn: gr.Button = None
         self._ui_img2img_btn: gr.Button = None
+        self._ui_interrupt_btn: gr.Button = None
+        self._ui_progress: gr.Markdown = None
+        self._ui_variants: gr.Slider = None
+        self._ui_variant_gallery: gr.Gallery = None
+        self._ui_selection_relay: Component = None
         self._ui_controlnet_settings: ControlNetSettings = None
         self._ui_txt2img_settings: FuncParamSettings = None
         self._ui_img2img_settings: FuncParamSettings = None
@@ -55,8 +73,15 @@ class ImageGenerator(GradioComponent):
             self._ui_image_out = gr.Image(label="Output", interactive=False).style(height=256, width=256)
         self._ui_prompt = gr.Textbox(label="Prompt")
         self._ui_prompt_neg = gr.Textbox(label="Negative Prompt")
+        # Variants are generated together in one batch (one GPU pass) with consecutive seeds
+        self._ui_variants = gr.Slider(label="Variants", minimum=1, maximum=ImageGenerator.MAX_VARIANTS, step=1, value=1)
         self._ui_txt2img_btn = gr.Button("Txt2Img", variant="primary")
         self._ui_img2img_btn = gr.Button("Img2Img", variant="primary")
+        self._ui_interrupt_btn = gr.Button("Interrupt")
+        self._ui_progress = gr.Markdown("")
+        self._ui_variant_gallery = gr.Gallery(label="Variants", visible=False).style(grid=4)
+        # Toggled whenever the selected image changes, with the image itself left in instance_data
+        self._ui_selection_relay = EventRelay.create_relay(name="Image Selected")
 
         # These Accordions must start Open to trigger proper gradio load events
         with gr.Accordion(label="ControlNet Parameters", open=False) as controlnet_accordion:
@@ -94,17 +119,22 @@ class ImageGenerator(GradioComponent):
                             "post_inputs": [enable_buttons_relay],
                             "post_outputs": [enable_buttons_relay]}
 
+        stream_outputs = [self._ui_image_out, self._ui_progress, self._ui_variant_gallery, self._ui_selection_relay]
         txt2img_wrapper = EventWrapper.create_wrapper(fn=self._handle_txt2img_click,
                                                       inputs=[self.instance_data, self._ui_controlnet_settings.instance_data, self._ui_txt2img_settings.instance_data,
-                                                              self._ui_prompt, self._ui_prompt_neg],
-                                                      outputs=self._ui_image_out, **disable_btn_args)
+                                                              self._ui_prompt, self._ui_prompt_neg, self._ui_variants, self._ui_selection_relay],
+                                                      outputs=stream_outputs, **disable_btn_args)
         img2img_wrapper = EventWrapper.create_wrapper(fn=self._handle_img2img_click,
                                                       inputs=[self.instance_data, self._ui_controlnet_settings.instance_data, self._ui_img2img_settings.instance_data,
-                                                              self._ui_image_in, self._ui_prompt, self._ui_prompt_neg],
-                                                      outputs=self._ui_image_out, **disable_btn_args)
+                                                              self._ui_image_in, self._ui_prompt, self._ui_prompt_neg, self._ui_variants, self._ui_selection_relay],
+                                                      outputs=stream_outputs, **disable_btn_args)
 
         self._ui_txt2img_btn.click(**EventWrapper.get_event_args(txt2img_wrapper))
         self._ui_img2img_btn.click(**EventWrapper.get_event_args(img2img_wrapper))
+        # Not queued, so it runs while the generation event is still holding its queue slot
+        self._ui_interrupt_btn.click(fn=self._handle_interrupt_click, inputs=[self.instance_data], queue=False)
+        self._ui_variant_gallery.select(fn=self._handle_variant_select, inputs=[self.instance_data, self._ui_selection_relay],
+                                        outputs=[self._ui_image_out, self._ui_progress, self._ui_selection_relay])
 
     def _restore_state(self, inst_data: ImageGenerator.StateData, controlnet_data: ControlNetSettings.StateData, controlnet_refresh_relay: bool,
                        txt2img_data: FuncParamSettings.StateData, txt2img_refresh_relay: bool, img2img_data: FuncParamSettings.StateData, img2img_refresh_relay: bool):
@@ -122,28 +152,116 @@ class ImageGenerator(GradioComponent):
         return (controlnet_refresh_relay, txt2img_refresh_relay, img2img_refresh_relay)
 
     def _handle_txt2img_click(self, inst_data: ImageGenerator.StateData, controlnet_inst_data: ControlNetSettings.StateData,
-                              txt2img_inst_data: FuncParamSettings.StateData, prompt: str, negative_prompt: str) -> Tuple[np.array]:
+                              txt2img_inst_data: FuncParamSettings.StateData, prompt: str, negative_prompt: str, variants: int,
+                              selection_relay: bool) -> Generator[Tuple[Any, ...], None, None]:
         if not inst_data.image_gen:
             inst_data.image_gen = ImageGenFactory.get_default_image_gen()
 
-        controlnet_units = [ControlNetUnit(**info.func_params_state.init_args)
-                            for info in controlnet_inst_data.controlnet_items if info.enabled]
-        result = inst_data.image_gen.gen_image(
-            prompt=prompt, negative_prompt=negative_prompt, controlnet_units=controlnet_units, **txt2img_inst_data.init_args)
-        return (result.image)
+        controlnet_units = [info.to_unit() for info in controlnet_inst_data.controlnet_items if info.enabled]
+        job = inst_data.image_gen.gen_image_async(
+            prompt=prompt, negative_prompt=negative_prompt, controlnet_units=controlnet_units,
+            **ImageGenerator._with_variants(txt2img_inst_data.init_args, variants))
+        yield from self._stream_job(inst_data, job, selection_relay)
 
     def _handle_img2img_click(self, inst_data: ImageGenerator.StateData, controlnet_inst_data: ControlNetSettings.StateData,
-                              img2img_inst_data: FuncParamSettings.StateData, input_image: np.ndarray, prompt: str, negative_prompt: str) -> Tuple[np.array]:
+                              img2img_inst_data: FuncParamSettings.StateData, input_image: np.ndarray, prompt: str, negative_prompt: str, variants: int,
+                              selection_relay: bool) -> Generator[Tuple[Any, ...], None, None]:
         if not inst_data.image_gen:
             inst_data.image_gen = ImageGenFactory.get_default_image_gen()
 
-        controlnet_units = [ControlNetUnit(**info.func_params_state.init_args)
-                            for info in controlnet_inst_data.controlnet_items if info.enabled]
+        controlnet_units = [info.to_unit() for info in controlnet_inst_data.controlnet_items if info.enabled]
 
         image = Image.fromarray(input_image)
-        result = inst_data.image_gen.gen_image(
-            prompt=prompt, negative_prompt=negative_prompt, input_image=image, controlnet_units=controlnet_units, **img2img_inst_data.init_args)
-        return (result.image)
+        job = inst_data.image_gen.gen_image_async(
+            prompt=prompt, negative_prompt=negative_prompt, input_image=image, controlnet_units=controlnet_units,
+            **ImageGenerator._with_variants(img2img_inst_data.init_args, variants))
+        yield from self._stream_job(inst_data, job, selection_relay)
+
+    @classmethod
+    def _with_variants(cls, init_args: Dict[str, Any], variants: int) -> Dict[str, Any]:
+        ''' Returns the generation arguments with batch_size set to generate the requested number of variants in one pass '''
+        kwargs = dict(init_args)
+        if int(variants) > 1:
+            kwargs["batch_size"] = int(variants)
+        return kwargs
+
+    @classmethod
+    def _get_seeds(cls, result: Any) -> List[Optional[int]]:
+        ''' Returns the seed of each image in a result. The webui increments the seed for each image of a batch '''
+        info = result.info if isinstance(result.info, dict) else {}
+        seeds = info.get("all_seeds") or []
+        if not seeds and "seed" in info:
+            seeds = [info["seed"] + idx for idx in range(len(result.images))]
+        return (list(seeds) + [None]*len(result.images))[:len(result.images)]
+
+    def _stream_job(self, inst_data: ImageGenerator.StateData, job: Future, selection_relay: bool) -> Generator[Tuple[Any, ...], None, None]:
+        '''
+        Yields previews and progress of a generation job until it completes, then the final images
+
+        Args:
+            inst_data (ImageGenerator.StateData): instance data, the job is recorded so it can be interrupted
+            job (Future): job from gen_image_async
+            selection_relay (bool): current value of the selection relay, toggled when the results are in
+        '''
+        # A newer request from the same session supersedes the old one
+        old_job = inst_data.job
+        if old_job is not None and old_job is not job and not old_job.done():
+            inst_data.image_gen.interrupt(old_job)
+        inst_data.job = job
+        try:
+            while not job.done():
+                try:
+                    progress = inst_data.image_gen.get_progress(job)
+                except Exception as e:
+                    logger.warning(f"Failed to get image generation progress: {e}")
+                    progress = None
+                if progress is None:
+                    yield (gr.update(), "Generating...", gr.update(), selection_relay)
+                elif progress.queued:
+                    yield (gr.update(), "Queued...", gr.update(), selection_relay)
+                else:
+                    yield (progress.preview if progress.preview is not None else gr.update(),
+                           f"Generating... {progress.progress:.0%}, ETA {progress.eta:.1f}s", gr.update(), selection_relay)
+                try:
+                    job.exception(timeout=ImageGenerator.PROGRESS_POLL_INTERVAL)
+                except (TimeoutError, CancelledError):
+                    pass
+
+            if job.cancelled() or inst_data.job is not job:
+                # Superseded jobs may still finish with partial images, they must not replace the newer request's
+                yield (gr.update(), "Interrupted", gr.update(), selection_relay)
+                return
+            result = job.result()
+            inst_data.images = list(result.images)
+            inst_data.seeds = ImageGenerator._get_seeds(result)
+            inst_data.selected_idx = 0
+            gallery = [(image, f"Seed {seed}" if seed is not None else "") for image, seed in zip(inst_data.images, inst_data.seeds)]
+            yield (inst_data.selected_image, self._describe_selection(inst_data), gr.Gallery.update(value=gallery, visible=len(gallery) > 1),
+                   not selection_relay)
+        finally:
+            # The client went away (or the event was cancelled) before the image was done, don't leave it on the GPU
+            if not job.done():
+                inst_data.image_gen.interrupt(job)
+            if inst_data.job is job:
+                inst_data.job = None
+
+    def _describe_selection(self, inst_data: ImageGenerator.StateData) -> str:
+        if not inst_data.images:
+            return ""
+        seed = inst_data.seeds[inst_data.selected_idx] if inst_data.seeds else None
+        return f"Image {inst_data.selected_idx + 1} of {len(inst_data.images)}" + (f", seed {seed}" if seed is not None else "")
+
+    def _handle_variant_select(self, event_data: gr.SelectData, inst_data: ImageGenerator.StateData, selection_relay: bool):
+        ''' Handles a variant being picked from the gallery. The image is already on the server, so only its index comes from the browser '''
+        if not inst_data.images or event_data.index >= len(inst_data.images):
+            return gr.update(), gr.update(), selection_relay
+        inst_data.selected_idx = event_data.index
+        return inst_data.selected_image, self._describe_selection(inst_data), not selection_relay
+
+    def _handle_interrupt_click(self, inst_data: ImageGenerator.StateData) -> None:
+        job = inst_data.job
+        if job is not None and not job.done():
+            inst_data.image_gen.interrupt(job)
 
     @property
     def input_image(self) -> gr.Image:
@@ -157,6 +275,11 @@ class ImageGenerator(GradioComponent):
     def instance_data(self) -> gr.State:
         return self._ui_state
 
+    @property
+    def selection_relay(self) -> Component:
+        ''' Fires when a generated image is selected, read it from instance_data.selected_image '''
+        return self._ui_selection_relay
+
     @property
     def restore_state_relay(self) -> Component:
         return self._ui_restore_state_relay
@@ -1,11 +1,14 @@
+from __future__ import annotations
+
 import os
 import uuid
 from dataclasses import dataclass
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Union
 
 import gradio as gr
 import numpy as np
 from gradio.components import Component
+from PIL import Image
 
 from avatar.motion_match import MotionMatch
 from ui_backends.gradio_backend.component import GradioComponent
@@ -21,7 +24,8 @@ class MotionMatcher(GradioComponent):
 
     @dataclass
     class StateData:
-        pass
+        # Kept server side, so images generated on the server never need to be uploaded back from the browser
+        source_image: Union[np.ndarray, Image.Image] = None
 
     def __init__(self):
         self._ui_image_in: gr.Image = None
@@ -33,6 +37,7 @@ class MotionMatcher(GradioComponent):
         self._build_component()
 
     def _build_component(self):
+        self._ui_state = gr.State(value=MotionMatcher.StateData)
         with gr.Row():
             self._ui_image_in = gr.Image(label="Input Image", interactive=True).style(height=256, width=256)
             self._ui_video_in = gr.Video(label="Input Video", interactive=True).style(height=256, width=256)
@@ -45,14 +50,42 @@ class MotionMatcher(GradioComponent):
                 EventWrapper.WrappedFunc(fn=lambda: [gr.Button.update(
                     interactive=False, variant="secondary")], outputs=[self._ui_generate_btn]),
                 EventWrapper.WrappedFunc(fn=self._handle_generate_click,
-                                         inputs=[self._ui_image_in, self._ui_video_in],
+                                         inputs=[self.instance_data, self._ui_video_in],
                                          outputs=[self._ui_video_out])
             ],
             finally_func=EventWrapper.WrappedFunc(fn=lambda: [gr.Button.update(interactive=True, variant="primary")], outputs=[self._ui_generate_btn]))
 
         self._ui_generate_btn.click(**EventWrapper.get_event_args(generate_wrapper))
+        # Only user actions, a change listener would also upload back every image shown by set_source_image
+        self._ui_image_in.upload(fn=self._handle_image_upload, inputs=[self._ui_image_in, self.instance_data])
+        self._ui_image_in.edit(fn=self._handle_image_upload, inputs=[self._ui_image_in, self.instance_data])
+        self._ui_image_in.clear(fn=self._handle_image_clear, inputs=[self.instance_data])
+
+    def _handle_image_upload(self, image_in: np.ndarray, inst_data: MotionMatcher.StateData) -> None:
+        inst_data.source_image = image_in
+
+    def _handle_image_clear(self, inst_data: MotionMatcher.StateData) -> None:
+        inst_data.source_image = None
+
+    def set_source_image(self, inst_data: MotionMatcher.StateData, image: Union[np.ndarray, Image.Image]) -> Image.Image:
+        '''
+        Sets the source image from server side data. Call from an event handler with this component's instance data as an input
+        and input_image as an output
+
+        Args:
+            inst_data (MotionMatcher.StateData): this component's instance data
+            image (Union[np.ndarray, Image.Image]): the source image
+
+        Returns:
+            Image.Image: the image, for displaying in input_image
+        '''
+        inst_data.source_image = image
+        return image
 
-    def _handle_generate_click(self, image_in: np.ndarray, video_path_in: str) -> None:
+    def _handle_generate_click(self, inst_data: MotionMatcher.StateData, video_path_in: str) -> None:
+        image_in = inst_data.source_image
+        if image_in is None:
+            raise Exception("No input image")
         # Must save image_in to filesystem
         tmpdir = Shared.getInstance().args.temp_dir
         unique_id: str = uuid.uuid4().hex
@@ -46,6 +46,66 @@ function start_audio_streamer(search_value, ...theArgs) {
 }
 
 
+function start_video_streamer_drop2(...theArgs) {
+    start_video_streamer(...theArgs.slice(2));
+    return theArgs
+}
+
+function start_video_streamer(search_value, ...theArgs) {
+    search_uuid = search_value.match(/id='(.*)'/)[1]
+    streaming_video = find_relation(search_uuid, "#streaming_video")?.[0]?.getElementsByTagName("VIDEO")?.[0];
+    if (streaming_video) {
+        refresh_toggle = find_relation(search_uuid, "#refresh_streaming_video")?.[0]?.querySelectorAll('input[type=checkbox')?.[0];
+        // Gradio may re-use the element for the next segment, only ask for it once per segment
+        streaming_video.addEventListener('ended', function () { refresh_toggle.click(); }, { once: true });
+        if (streaming_video.readyState == 4) { // Ready to play?
+            streaming_video.play();
+        } else {
+            streaming_video.addEventListener('canplay', function () { streaming_video.play(); }, { once: true });
+        }
+    }
+}
+
+function start_hls_player_drop2(...theArgs) {
+    start_hls_player(...theArgs.slice(2));
+    return theArgs
+}
+
+function start_hls_player(search_value, playlist_url, ...theArgs) {
+    search_uuid = search_value.match(/id='(.*)'/)[1]
+    hls_video = find_relation(search_uuid, "#hls_player")?.[0]?.getElementsByTagName("VIDEO")?.[0];
+    if (!hls_video || !playlist_url) {
+        return;
+    }
+    if (hls_video.canPlayType('application/vnd.apple.mpegurl')) { // Safari plays HLS itself
+        hls_video.src = playlist_url;
+        hls_video.play();
+        return;
+    }
+    load_hls_js(function () {
+        if (hls_video.hls_player) {
+            hls_video.hls_player.destroy();
+        }
+        // The playlist grows while the video renders, play it from the start rather than from its newest segment
+        hls_video.hls_player = new Hls({ startPosition: 0 });
+        hls_video.hls_player.loadSource(playlist_url);
+        hls_video.hls_player.attachMedia(hls_video);
+        hls_video.hls_player.on(Hls.Events.MANIFEST_PARSED, function () { hls_video.play(); });
+    });
+}
+
+function load_hls_js(callback) {
+    if (window.Hls) {
+        callback();
+        return;
+    }
+    script = document.createElement("script");
+    script.src = "/media/hls.js/hls.min.js"; // Pinned copy served by the app, see HlsJs
+    script.onload = callback;
+    script.onerror = function () { console.warn("hls.js is not available, progressive playback needs native HLS"); };
+    document.head.appendChild(script);
+}
+
 // Copied from AUTOMATIC1111 stable-diffusion-webui
 function gradioApp() {
     const elems = document.getElementsByTagName('gradio-app');
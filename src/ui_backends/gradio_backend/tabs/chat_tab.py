@@ -1,31 +1,48 @@
 ''' Chat interface tab '''
 import logging
+import uuid
 from dataclasses import dataclass
 from typing import Tuple, List
 import numpy as np
 import gradio as gr
-import random
 from typing_extensions import override
 from functools import partial
+from threading import Timer
 
 from avatar.manager import Manager, Profile
+from avatar.video_info import VideoInfo
 from ui_backends.gradio_backend.components.chat_box import ChatBox
 from ui_backends.gradio_backend.components.tts_settings import TtsSettings
 from ui_backends.gradio_backend.components.tts_speaker import TtsSpeaker
 from ui_backends.gradio_backend.tab import GradioTab
 from ui_backends.gradio_backend.utils.app_data import AppData
+from ui_backends.gradio_backend.utils.event_relay import EventRelay
 from ui_backends.gradio_backend.utils.event_wrapper import EventWrapper
 from ui_backends.gradio_backend.components.lip_sync_ui import LipSyncUi
 from ui_backends.gradio_backend.utils.helpers import audio_to_file_event
+from ui_backends.gradio_backend.utils.media_routes import MediaRoutes
 from utils.shared import Shared
+from utils.video_io import VideoWriter
 
 logger = logging.getLogger(__file__)
 
 
 class ChatTab(GradioTab):
+    GEN_VIDEO_LABEL = "Generate Video From Last Speech"
+
+    class Delivery:
+        CHUNKS = "Stream Chunks"  # Lip sync each chunk of speech as it is synthesized
+        HLS = "Progressive (HLS)"  # Lip sync the whole speech, playing it while it renders
+        WHOLE = "Whole Clip"
+        ALL = [CHUNKS, HLS, WHOLE]
+
     @dataclass
     class StateData:
         profile: Profile = None
+        lipsync_stream: object = None  # LipSyncStream
+        hls_render: object = None  # Future of the HLS render
+        hls_url: str = None  # Published directory of the HLS render
+        hls_duration: float = 0.0
 
     def __init__(self):
         self._ui_voice_settings: TtsSettings = None
@@ -36,13 +53,20 @@ class ChatTab(GradioTab):
         self._ui_state: gr.State = None
         self._ui_speaker_name_box: gr.Textbox = None
         self._ui_video: gr.Video = None
+        self._ui_delivery_radio: gr.Radio = None
+        self._ui_hls_player: gr.HTML = None
+        self._ui_hls_url: gr.Textbox = None
+        self._ui_instance_id: gr.Markdown = None
+        self._ui_play_video_relay: EventWrapper = None
+        self._ui_stream_video_relay: EventWrapper = None
+        self._ui_play_hls_relay: EventWrapper = None
         self._lip_sync_ui: LipSyncUi = None
 
     @override
     def build_ui(self):
         self._ui_state = gr.State(value=ChatTab.StateData)
 
-        gen_lipsync_label: str = "Generate Video From Last Speech"
+        gen_lipsync_label: str = ChatTab.GEN_VIDEO_LABEL
 
         with gr.Box():
             self. _ui_chatbox = ChatBox()
@@ -61,8 +85,14 @@ class ChatTab(GradioTab):
                         label="Selected Avatar", placeholder="No avatar selected", interactive=False)
                     self._tts_speaker = TtsSpeaker(tts_settings=self._ui_voice_settings)
             with gr.Column(scale=1):
-                self._ui_video = gr.Video()
+                self._ui_video = gr.Video(elem_id="streaming_video")
+                self._ui_hls_player = gr.HTML(value="<video controls playsinline style='width: 100%'></video>", elem_id="hls_player",
+                                              visible=False)
+                self._ui_hls_url = gr.Textbox(visible=False)
                 gen_video_btn = gr.Button(gen_lipsync_label)
+                self._ui_delivery_radio = gr.Radio(choices=ChatTab.Delivery.ALL, value=ChatTab.Delivery.CHUNKS, label="Video Delivery")
+        self._ui_instance_id = gr.Markdown(
+            value=lambda: f"<div id='{uuid.uuid4().hex}'>Search Target!</div>", visible=False)
 
         self._refresh_gallery_relay = EventWrapper.create_wrapper(
             fn=self._handle_refresh, outputs=[self._avatar_gallery])
@@ -89,7 +119,34 @@ class ChatTab(GradioTab):
         self._lip_sync_ui.job_done_event.change(
             fn=lambda x: (x, gr.Button.update(value=gen_lipsync_label, interactive=True)), inputs=[self._lip_sync_ui.output_video], outputs=[self._ui_video, gen_video_btn])
 
-        gen_video_btn.click(**EventWrapper.get_event_args(sync_lipsync_relay))
+        # Streamed video is pulled a segment at a time, the player asks for the next one when the current one ends
+        self._ui_play_video_relay = EventWrapper.create_wrapper(fn_delay=1, _js="start_video_streamer_drop2", inputs=[
+                                                                self._ui_instance_id], name="Video Autoplayer Relay")
+        self._ui_stream_video_relay = EventRelay.create_relay(
+            fn=self._streaming_video_handler, inputs=[self.instance_data, self._ui_play_video_relay],
+            outputs=[self._ui_video, self._ui_play_video_relay, gen_video_btn], elem_id="refresh_streaming_video",
+            name="Stream Video Relay")
+
+        self._ui_play_hls_relay = EventWrapper.create_wrapper(fn_delay=1, _js="start_hls_player_drop2", inputs=[
+                                                              self._ui_instance_id, self._ui_hls_url], name="HLS Player Relay")
+        hls_lipsync_relay = EventWrapper.create_wrapper_list(
+            wrapped_func_list=[
+                EventWrapper.WrappedFunc(fn=self._start_hls_lipsync, inputs=[self.instance_data, self._tts_speaker.instance_data],
+                                         outputs=[self._ui_hls_url]),
+                EventWrapper.WrappedFunc(**EventWrapper.get_event_args(self._ui_play_hls_relay)),
+                EventWrapper.WrappedFunc(fn=self._finish_hls_lipsync, inputs=[self.instance_data], outputs=[self._ui_video])
+            ],
+            finally_func=EventWrapper.WrappedFunc(fn=partial(set_lipsync_buttons_state, True), outputs=[gen_video_btn])
+        )
+
+        gen_video_btn.click(fn=self._handle_gen_video,
+                            inputs=[self.instance_data, self._tts_speaker.instance_data, self._ui_delivery_radio,
+                                    sync_lipsync_relay, self._ui_stream_video_relay, hls_lipsync_relay],
+                            outputs=[sync_lipsync_relay, self._ui_stream_video_relay, hls_lipsync_relay, gen_video_btn])
+
+        self._ui_delivery_radio.change(fn=lambda delivery: (gr.update(visible=delivery != ChatTab.Delivery.HLS),
+                                                            gr.update(visible=delivery == ChatTab.Delivery.HLS)),
+                                       inputs=[self._ui_delivery_radio], outputs=[self._ui_video, self._ui_hls_player])
 
         self._ui_chatbox.chat_response.change(
             fn=lambda x: x, inputs=[self._ui_chatbox.chat_response], outputs=[self._tts_speaker.prompt])
@@ -102,15 +159,89 @@ class ChatTab(GradioTab):
 
     def _run_lipsync(self, inst_data: StateData, audio_data: Tuple[int, np.ndarray]) -> Tuple[gr.Audio, gr.Video]:
         audio_filename: str = audio_to_file_event(audio_data)
-        motion_videos = inst_data.profile._get_matched_videos()
-        if len(motion_videos) > 0:
-            video_path = random.choice(motion_videos).path
-        else:
-            video_path = None
-        return (audio_filename, video_path)
-
-    def _handle_gen_video(self, inst_data: StateData, audio, *args):
-        pass
+        sampling_rate, audio_buffer = audio_data
+        return (audio_filename, self._choose_video(inst_data, duration=len(audio_buffer) / sampling_rate))
+
+    def _choose_video(self, inst_data: StateData, duration: float = None) -> str:
+        '''
+        Returns the avatar video to lip sync, None if the avatar has none
+
+        Args:
+            inst_data (StateData): chat tab instance data
+            duration (float, optional): seconds of speech, None if not known yet
+
+        Returns:
+            str: path of the video which best fits the speech, see VideoInfo.best_fit
+        '''
+        video = VideoInfo.best_fit(inst_data.profile._get_matched_videos(), duration)
+        return video.path if video is not None else None
+
+    def _handle_gen_video(self, inst_data: StateData, speaker_data: TtsSpeaker.StateData, delivery: str,
+                          sync_relay: bool, stream_relay: bool, hls_relay: bool) -> Tuple[bool, bool, bool, gr.Button]:
+        '''
+        Handles the Generate Video button. When streaming chunks, each chunk of the speech is lip synced as soon as TTS has
+        made it. Otherwise the whole speech is lip synced at once, played while it renders with HLS delivery
+
+        Args:
+            inst_data (StateData): chat tab instance data
+            speaker_data (TtsSpeaker.StateData): tts speaker instance data, for the chunker making the speech
+            delivery (str): one of ChatTab.Delivery.ALL
+            sync_relay (bool): relay to toggle to lip sync the whole speech
+            stream_relay (bool): relay to toggle to start streaming
+            hls_relay (bool): relay to toggle to lip sync the whole speech as HLS
+
+        Returns:
+            Tuple[bool, bool, bool, gr.Button]: relay states and the button update
+        '''
+        # The video is chosen once the length of the speech is known, only check there is one
+        has_video = inst_data.profile is not None and len(inst_data.profile._get_matched_videos()) > 0
+        if delivery == ChatTab.Delivery.WHOLE or speaker_data.chunker is None or not has_video:
+            return (not sync_relay, stream_relay, hls_relay, gr.update())
+        generating = gr.Button.update(interactive=False, value="Generating Video...")
+        if delivery == ChatTab.Delivery.HLS:
+            return (sync_relay, stream_relay, not hls_relay, generating)
+
+        from avatar.lip_sync import LipSync
+        if inst_data.lipsync_stream is not None:
+            inst_data.lipsync_stream.cancel()
+        inst_data.lipsync_stream = LipSync.render_stream(self._choose_video(inst_data), speaker_data.chunker)
+        return (sync_relay, not stream_relay, hls_relay, generating)
+
+    def _start_hls_lipsync(self, inst_data: StateData, speaker_data: TtsSpeaker.StateData) -> str:
+        ''' Starts lip syncing the whole speech, returning the url of the playlist it is written to '''
+        from avatar.lip_sync import LipSync
+        speaker_data.chunker.wait_for_audio_complete()
+        audio_buffer, sampling_rate = speaker_data.chunker.get_all_audio()
+        audio_filename: str = audio_to_file_event((sampling_rate, audio_buffer))
+        output_prefix = Shared.getInstance().unique_file_prefix
+        hls_dir = f"{output_prefix}_hls"
+        inst_data.hls_duration = len(audio_buffer) / sampling_rate
+        video_path = self._choose_video(inst_data, duration=inst_data.hls_duration)
+        inst_data.hls_render = LipSync.render_hls(video_path, audio_filename, f"{output_prefix}_synced_video.mp4", hls_dir)
+        inst_data.hls_url = MediaRoutes.publish(hls_dir)
+        return f"{inst_data.hls_url}/{VideoWriter.Filenames.PLAYLIST}"
+
+    def _finish_hls_lipsync(self, inst_data: StateData) -> str:
+        ''' Waits for the HLS render, returning the finished video. Its playlist stays published while it is still playing '''
+        hls_render, hls_url = inst_data.hls_render, inst_data.hls_url
+        inst_data.hls_render, inst_data.hls_url = None, None
+        try:
+            if hls_render is None:
+                # Starting the render failed
+                return gr.update()
+            return str(hls_render.result().output_path)
+        finally:
+            if hls_url is not None:
+                unpublish_timer = Timer(inst_data.hls_duration + 10, MediaRoutes.unpublish, args=[hls_url])
+                unpublish_timer.daemon = True
+                unpublish_timer.start()
+
+    def _streaming_video_handler(self, inst_data: StateData, play_video_relay: bool):
+        ''' Shows the next streamed segment, or re-enables the button once there are no more '''
+        segment = inst_data.lipsync_stream.next_segment() if inst_data.lipsync_stream else None
+        if segment is not None:
+            return [gr.Video.update(value=str(segment.video_path)), not play_video_relay, gr.update()]
+        return [gr.update(), play_video_relay, gr.Button.update(interactive=True, value=ChatTab.GEN_VIDEO_LABEL)]
 
     def _handle_refresh(self) -> Tuple[gr.Gallery]:
         ''' Refresh the gallery '''
@@ -66,8 +66,9 @@ class ToolsTab(GradioTab):
                 """)
             self._ui_lip_sync_ui: LipSyncUi = LipSyncUi()
 
-        send_image_to_motion_match_btn.click(fn=lambda x: x, inputs=[self._ui_image_gen.output_image], outputs=[
-                                             self._ui_motion_matcher.input_image])
+        send_image_to_motion_match_btn.click(fn=lambda imagegen_data, matcher_data: self._ui_motion_matcher.set_source_image(matcher_data, imagegen_data.selected_image),
+                                             inputs=[self._ui_image_gen.instance_data, self._ui_motion_matcher.instance_data],
+                                             outputs=[self._ui_motion_matcher.input_image])
         send_vid_to_lipsync.click(fn=lambda x: x, inputs=[self._ui_motion_matcher.output_video], outputs=[
             self._ui_lip_sync_ui.input_video])
         send_audio_to_lipsync.click(fn=lambda filename, toggle: (audio_to_file_event(filename), not toggle),
@@ -60,6 +60,19 @@ class EventRelay():
                 ret = [None]*len(outputs)
             return EventRelay.as_list(ret)
 
+        def wrapped_gen_func(*wrapped_inputs):
+            try:
+                capture_caller_info = caller_info
+                for ret in fn(*wrapped_inputs):
+                    yield EventRelay.as_list(ret)
+            except Exception as e:
+                logger.error(e)
+                yield [None]*len(outputs)
+
+        if fn and inspect.isgeneratorfunction(fn):
+            # Generators stream each yielded value to the outputs (requires the queue)
+            wrapped_func = wrapped_gen_func
+
         trigger_checkbox.change(fn=wrapped_func if fn else None, inputs=inputs, outputs=outputs, **kwargs)
 
         return trigger_checkbox
@@ -1,6 +1,7 @@
 ''' Wraps a Gradio event with pre- and post- events '''
 from __future__ import annotations
 
+import inspect
 import logging
 import traceback
 from dataclasses import dataclass
@@ -110,11 +111,28 @@ class EventWrapper():
                 return [error_msg, relay_toggle] + [gr.update() for _ in func.outputs]
             return [error_relay, not relay_toggle] + EventRelay.as_list(wrapped_func_outputs)
 
+        def gen_func_wrapper(func: EventWrapper.WrappedFunc, error_relay: str, relay_toggle: bool, *wrapped_inputs):
+            # Streams every yielded value to the outputs, then toggles the next relay once the generator is exhausted
+            error_relay = ""
+            wrapped_inputs = list(wrapped_inputs)
+            try:
+                for wrapped_func_outputs in func.fn(*wrapped_inputs):
+                    yield [error_relay, relay_toggle] + EventRelay.as_list(wrapped_func_outputs)
+            except Exception as e:
+                traceback.print_exception(e)
+                EventWrapper.error_cnt += 1  # This ensures repeat errors have unique messages
+                error_msg: str = f"{EventWrapper.error_cnt} - {name}: {e}"
+                logger.error(error_msg)
+                yield [error_msg, relay_toggle] + [gr.update() for _ in func.outputs]
+                return
+            yield [error_relay, not relay_toggle] + [gr.update() for _ in func.outputs]
+
         for idx, func in enumerate(reversed(wrapped_func_list)):
             func_inputs = [error_txt_relay, next_relay] + EventRelay.as_list(func.inputs)
             func_outputs = [error_txt_relay, next_relay] + EventRelay.as_list(func.outputs)
 
-            func_relay: Component = EventRelay.create_relay(fn=partial(func_wrapper, func), inputs=func_inputs,
+            wrapper_func = gen_func_wrapper if inspect.isgeneratorfunction(func.fn) else func_wrapper
+            func_relay: Component = EventRelay.create_relay(fn=partial(wrapper_func, func), inputs=func_inputs,
                                                             outputs=func_outputs, name=f"{name}_func{len(wrapped_func_list)-idx}", **func.kwargs)
             next_relay = func_relay
 
@@ -138,7 +156,7 @@ class EventWrapper():
         This can be used to, for example, disable and re-enable the Submit button before and after an actual event
 
         Args:
-            fn (Callable, optional): primary event function call to wrap
+            fn (Callable, optional): primary event function call to wrap. If it is a generator function each yielded value is streamed to the outputs
             inputs (List[Component], optional): list of inputs for primary function call
             outputs (List[Component], optional): list of outputs for primary function call
             pre_fn (Callable, optional): Function to call before calling primary function
@@ -0,0 +1,85 @@
+''' Provides a pinned copy of hls.js, served by the app rather than loaded from a CDN '''
+from __future__ import annotations
+
+import base64
+import hashlib
+import io
+import logging
+import os
+import tarfile
+import uuid
+from pathlib import Path
+from threading import Lock, Thread
+from typing import Optional
+
+import requests
+
+from ui_backends.gradio_backend.utils.media_routes import MediaRoutes
+from utils.shared import Shared
+
+logger = logging.getLogger(__file__)
+
+
+class HlsJs:
+    '''
+    Downloads one exact release of hls.js from the npm registry, checks the package against the integrity hash pinned
+    here and keeps the player script in the data directory. It is served at URL, so browsers never load a third party
+    script and playback keeps working offline once it has been fetched
+    '''
+    VERSION = "1.5.17"
+    TARBALL_URL = f"https://registry.npmjs.org/hls.js/-/hls.js-{VERSION}.tgz"
+    # The package's npm 'dist.integrity' ("sha512-<base64 digest>"). Nothing is downloaded until it is set, a hash read
+    # from the registry along with the package would not catch a replaced package
+    INTEGRITY: Optional[str] = None
+    PACKAGE_PATH = "package/dist/hls.min.js"
+    FILENAME = "hls.min.js"
+    MEDIA_ID = "hls.js"
+    URL = f"{MediaRoutes.PREFIX}/{MEDIA_ID}/{FILENAME}"
+    TIMEOUT = 30
+
+    _lock: Lock = Lock()
+
+    @classmethod
+    def get_dir(cls) -> Path:
+        return Path(os.path.join(Shared.getInstance().data_dir, "hls.js", HlsJs.VERSION))
+
+    @classmethod
+    def check_in_background(cls):
+        ''' Makes hls.js available without holding up launch or a request. Call once the media routes are registered '''
+        Thread(target=cls.check, name="HlsJsCheck", daemon=True).start()
+
+    @classmethod
+    def check(cls) -> bool:
+        ''' Downloads hls.js if it has not been yet and publishes it at URL. Returns true if it is available '''
+        script_path = HlsJs.get_dir().joinpath(HlsJs.FILENAME)
+        with HlsJs._lock:
+            if not os.path.isfile(script_path):
+                try:
+                    cls._download(script_path)
+                except Exception as e:
+                    logger.warning(f"Failed to download hls.js {HlsJs.VERSION}, progressive playback needs a browser with native HLS: {e}")
+                    return False
+            MediaRoutes.publish(script_path.parent, media_id=HlsJs.MEDIA_ID)
+        return True
+
+    @classmethod
+    def _download(cls, script_path: Path):
+        ''' Fetches the release's package, verifies it against INTEGRITY and extracts the script '''
+        if HlsJs.INTEGRITY is None:
+            raise ValueError("no integrity hash is pinned in HlsJs.INTEGRITY")
+        algorithm, expected = HlsJs.INTEGRITY.split("-", 1)
+        if algorithm != "sha512":
+            raise ValueError(f"Unsupported integrity algorithm: {algorithm}")
+        response = requests.get(HlsJs.TARBALL_URL, timeout=HlsJs.TIMEOUT)
+        response.raise_for_status()
+        if base64.b64encode(hashlib.sha512(response.content).digest()).decode() != expected:
+            raise ValueError("Package does not match the pinned integrity hash")
+
+        with tarfile.open(fileobj=io.BytesIO(response.content), mode="r:gz") as tar:
+            script = tar.extractfile(HlsJs.PACKAGE_PATH).read()
+        os.makedirs(script_path.parent, exist_ok=True)
+        scratch_path = script_path.with_name(f".{script_path.name}.{uuid.uuid4().hex}")
+        with open(scratch_path, "wb") as fhndl:
+            fhndl.write(script)
+        os.replace(scratch_path, script_path)
+        logger.info(f"Downloaded hls.js {HlsJs.VERSION} to {script_path}")
@@ -0,0 +1,131 @@
+''' Serves growing media, like HLS playlists still being rendered, from the Gradio server '''
+from __future__ import annotations
+
+import logging
+import os
+import re
+import time
+import uuid
+from email.utils import formatdate
+from pathlib import Path
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+from fastapi import FastAPI, Request
+from fastapi.responses import Response
+
+logger = logging.getLogger(__file__)
+
+
+class MediaRoutes:
+    '''
+    Serves files from published directories at {PREFIX}/{media_id}/{filename}, with byte range requests and validators.
+    Gradio's own file route caches nothing and cannot serve a playlist which changes while it is played, so these routes
+    are added to its server once it is running. Only directories passed to publish can be read
+    '''
+    PREFIX = "/media"
+    CONTENT_TYPES = {".m3u8": "application/vnd.apple.mpegurl", ".m4s": "video/iso.segment", ".mp4": "video/mp4", ".wav": "audio/wav",
+                     ".js": "application/javascript"}
+    # Playlists change as segments are added. Segments are renamed into place once complete and never change after
+    PLAYLIST_CACHE_CONTROL = "no-cache"
+    SEGMENT_CACHE_CONTROL = "public, max-age=86400, immutable"
+    # How long a request for a published file waits for the renderer to write it
+    FILE_WAIT = 30.0
+
+    _dirs: Dict[str, Path] = {}
+    _lock: Lock = Lock()
+
+    @classmethod
+    def register(cls, app: FastAPI):
+        ''' Adds the routes to a running server, ahead of the server's own routes '''
+        app.add_api_route(f"{MediaRoutes.PREFIX}/{{media_id}}/{{filename}}", MediaRoutes._handle_get, methods=["GET", "HEAD"])
+        # add_api_route appends, move the new route in front of any catch-all
+        app.router.routes.insert(0, app.router.routes.pop())
+        logger.info(f"Serving published media at {MediaRoutes.PREFIX}")
+
+    @classmethod
+    def publish(cls, directory: Path, media_id: Optional[str] = None) -> str:
+        '''
+        Makes the files in a directory servable. The directory may not exist yet
+
+        Args:
+            directory (Path): directory to serve
+            media_id (Optional[str], optional): fixed name to serve it under, for files with a well known url. Defaults to a
+                random one
+
+        Returns:
+            str: url path of the directory, without a trailing slash
+        '''
+        media_id = media_id or uuid.uuid4().hex
+        with MediaRoutes._lock:
+            MediaRoutes._dirs[media_id] = Path(directory).resolve()
+        return f"{MediaRoutes.PREFIX}/{media_id}"
+
+    @classmethod
+    def unpublish(cls, url: str):
+        ''' Stops serving a directory given the url publish returned '''
+        with MediaRoutes._lock:
+            MediaRoutes._dirs.pop(url.rstrip("/").rsplit("/", 1)[-1], None)
+
+    @classmethod
+    def _handle_get(cls, media_id: str, filename: str, request: Request) -> Response:
+        with MediaRoutes._lock:
+            directory = MediaRoutes._dirs.get(media_id)
+        path = (directory / filename).resolve() if directory is not None else None
+        if path is None or path.parent != directory:
+            return Response(status_code=404)
+
+        # The first request for a playlist can arrive before the first segment is written
+        deadline = time.time() + MediaRoutes.FILE_WAIT
+        while not os.path.isfile(path) and time.time() < deadline:
+            time.sleep(0.1)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return Response(status_code=404)
+
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        headers = {"Accept-Ranges": "bytes", "ETag": etag, "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+                   "Cache-Control": MediaRoutes.PLAYLIST_CACHE_CONTROL if path.suffix == ".m3u8" else MediaRoutes.SEGMENT_CACHE_CONTROL}
+        media_type = MediaRoutes.CONTENT_TYPES.get(path.suffix, "application/octet-stream")
+        if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+            return Response(status_code=304, headers=headers)
+
+        byte_range = MediaRoutes._parse_range(request.headers.get("range"), stat.st_size)
+        if byte_range is None:
+            headers["Content-Range"] = f"bytes */{stat.st_size}"
+            return Response(status_code=416, headers=headers)
+        start, end = byte_range
+        status_code = 200
+        if request.headers.get("range") and (start, end) != (0, stat.st_size - 1):
+            status_code = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+
+        headers["Content-Length"] = str(end - start + 1)
+        if request.method == "HEAD":
+            return Response(status_code=status_code, headers=headers, media_type=media_type)
+        with open(path, "rb") as fhndl:
+            fhndl.seek(start)
+            content = fhndl.read(end - start + 1)
+        return Response(content=content, status_code=status_code, headers=headers, media_type=media_type)
+
+    @classmethod
+    def _parse_range(cls, range_header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+        '''
+        Parses a single range 'Range' header. Multiple ranges are answered with the whole file
+
+        Returns:
+            Optional[Tuple[int, int]]: first and last byte to send, None if the range cannot be satisfied
+        '''
+        match = re.fullmatch(r"bytes=(\d*)-(\d*)", (range_header or "").strip())
+        if match is None or (not match.group(1) and not match.group(2)):
+            return (0, size - 1) if size > 0 else (0, -1)
+        if not match.group(1):
+            # Suffix range, the last N bytes
+            start, end = max(0, size - int(match.group(2))), size - 1
+        else:
+            start = int(match.group(1))
+            end = min(size - 1, int(match.group(2))) if match.group(2) else size - 1
+        if start >= size or start > end:
+            return None
+        return start, end
@@ -14,6 +14,8 @@ from tts import Tts
 from ui import Ui
 from utils.shared import Shared
 from ui_backends.gradio_backend.utils.app_data import AppData
+from ui_backends.gradio_backend.utils.hls_js import HlsJs
+from ui_backends.gradio_backend.utils.media_routes import MediaRoutes
 from ui_backends.gradio_backend.tab import GradioTab
 from ui_backends.gradio_backend.tabs.chat_tab import ChatTab
 from ui_backends.gradio_backend.tabs.avatar_tab import AvatarTab
@@ -53,11 +55,16 @@ class GradioUi(Ui):
     @override
     def launch(self, listen: bool, port: int):
         ''' Launches the UI and blocks until complete '''
-        if self._job_cnt_arg > 1:
-            self._app.queue(concurrency_count=self._job_cnt_arg)
+        # Always queue, streaming (generator) event handlers only work with the queue enabled
+        self._app.queue(concurrency_count=max(1, int(self._job_cnt_arg)))
 
         server_name = "0.0.0.0" if listen else None
-        self._app.launch(server_name=server_name, server_port=port)
+        self._app.launch(server_name=server_name, server_port=port, prevent_thread_lock=True)
+        # The server only exists once launched
+        MediaRoutes.register(self._app.server_app)
+        # Browsers without native HLS play progressive lip sync with the app's copy of hls.js
+        HlsJs.check_in_background()
+        self._app.block_thread()
 
     def _injectScripts(self, pathList: List[str]):
         # Taken from AUTOMATIC1111 stable-diffusion-webui
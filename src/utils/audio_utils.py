@@ -1,6 +1,6 @@
 ''' Utilities for audiol '''
 
-from typing import Tuple
+from typing import Optional, Tuple
 import numpy as np
 from pathlib import Path
 import wave
@@ -12,3 +12,12 @@ def save_audio_to_file(sampling_rate: int, audio_data: np.ndarray, output_path:
         wav.setsampwidth(2)
         wav.setframerate(sampling_rate)
         wav.writeframesraw(audio_data)
+
+
+def get_audio_duration(audio_path: str) -> Optional[float]:
+    ''' Returns the length of a WAV file in seconds, None if it is not a WAV file '''
+    try:
+        with wave.open(str(audio_path), 'rb') as wav:
+            return wav.getnframes() / wav.getframerate()
+    except (wave.Error, EOFError):
+        return None
@@ -0,0 +1,150 @@
+''' On-disk catalog of backend capabilities (voices, models, ...) which are slow to fetch and rarely change '''
+from __future__ import annotations
+
+import json
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from threading import Lock
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__file__)
+
+
+class CapabilityCatalog:
+    '''
+    Serves capability lists from disk immediately, refreshing entries older than the TTL in the background.
+    Only the very first lookup of an entry (nothing on disk yet) waits on the loader.
+    '''
+    @dataclass
+    class Entry:
+        value: Any = None
+        updated: float = 0.0
+
+    def __init__(self, path: Path, ttl: float = 24 * 60 * 60):
+        '''
+        Initialize a CapabilityCatalog
+
+        Args:
+            path (Path): JSON file to persist the catalog in
+            ttl (float, optional): seconds before an entry is refreshed in the background
+        '''
+        self._path: Path = Path(path)
+        self._ttl: float = ttl
+        self._lock: Lock = Lock()
+        self._entries: Dict[str, CapabilityCatalog.Entry] = self._load()
+        self._refreshing: Dict[str, Future] = {}
+        self._refresh_pool: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="capability_catalog")
+        self._listeners: List[Callable[[str], None]] = []
+
+    def _load(self) -> Dict[str, CapabilityCatalog.Entry]:
+        if not os.path.isfile(self._path):
+            return {}
+        try:
+            with open(self._path, "r", encoding="utf8") as fhndl:
+                data = json.load(fhndl)
+            return {key: CapabilityCatalog.Entry(**entry) for key, entry in data.items()}
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable capability catalog {self._path}: {e}")
+            return {}
+
+    def _save(self) -> None:
+        ''' Writes the catalog. Must hold the lock '''
+        scratch_path = self._path.with_name(f".{self._path.name}.{uuid.uuid4().hex}")
+        try:
+            os.makedirs(self._path.parent, exist_ok=True)
+            with open(scratch_path, "w", encoding="utf8") as fhndl:
+                json.dump({key: asdict(entry) for key, entry in self._entries.items()}, fhndl, indent=1)
+            os.replace(scratch_path, self._path)
+        except Exception as e:
+            logger.warning(f"Failed to save capability catalog {self._path}: {e}")
+            if os.path.isfile(scratch_path):
+                os.remove(scratch_path)
+
+    def get(self, key: str, loader: Callable[[], Any]) -> Any:
+        '''
+        Returns the cataloged value, loading it now only if it has never been loaded
+
+        Args:
+            key (str): entry name, eg 'automatic1111/localhost:7860/controlnet_models'
+            loader (Callable[[], Any]): fetches the current value from the backend. Must return something JSON serializable
+
+        Returns:
+            Any: the value
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return self.refresh(key, loader).result()
+        if time.time() - entry.updated > self._ttl:
+            self.refresh(key, loader)
+        return entry.value
+
+    def refresh(self, key: str, loader: Callable[[], Any]) -> Future:
+        '''
+        Reloads an entry in the background. Refreshes of an entry already being refreshed are joined
+
+        Args:
+            key (str): entry name
+            loader (Callable[[], Any]): fetches the current value from the backend
+
+        Returns:
+            Future: resolves to the new value
+        '''
+        with self._lock:
+            future = self._refreshing.get(key)
+            if future is None:
+                future = self._refresh_pool.submit(self._refresh_func, key, loader)
+                self._refreshing[key] = future
+        return future
+
+    def _refresh_func(self, key: str, loader: Callable[[], Any]) -> Any:
+        try:
+            value = loader()
+            self.put(key, value)
+        except Exception as e:
+            logger.warning(f"Failed to refresh capability [{key}]: {e}")
+            raise
+        finally:
+            with self._lock:
+                self._refreshing.pop(key, None)
+        with self._lock:
+            listeners = self._listeners.copy()
+        for listener in listeners:
+            try:
+                listener(key)
+            except Exception as e:
+                logger.warning(f"Capability refresh listener failed for [{key}]: {e}")
+        return value
+
+    def add_refresh_listener(self, listener: Callable[[str], None]) -> None:
+        '''
+        Registers a callback run after an entry has been refreshed, so values derived from it can be dropped
+
+        Args:
+            listener (Callable[[str], None]): called with the key of the refreshed entry, on the refresh thread
+        '''
+        with self._lock:
+            self._listeners.append(listener)
+
+    def put(self, key: str, value: Any) -> None:
+        '''
+        Stores a freshly loaded value
+
+        Args:
+            key (str): entry name
+            value (Any): JSON serializable value
+        '''
+        with self._lock:
+            self._entries[key] = CapabilityCatalog.Entry(value=value, updated=time.time())
+            self._save()
+
+    def peek(self, key: str) -> Optional[Any]:
+        ''' Returns the cataloged value without loading or refreshing it, None if there is none '''
+        with self._lock:
+            entry = self._entries.get(key)
+        return entry.value if entry is not None else None
@@ -0,0 +1,124 @@
+''' Directory of keyed entries with least recently used eviction, shared by the on-disk caches '''
+from __future__ import annotations
+
+import logging
+import os
+import shutil
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock
+from typing import Any, Callable, Optional
+
+logger = logging.getLogger(__file__)
+
+
+class DiskLru:
+    '''
+    Keeps one subdirectory per key under root_dir and removes the least recently used beyond max_entries. Entries are
+    written to a scratch directory and renamed into place, so readers never see a partial entry. Recency survives
+    restarts through the entry directories' modification times.
+    '''
+
+    def __init__(self, root_dir: Path, max_entries: int, name: str = "cache"):
+        '''
+        Initialize a DiskLru
+
+        Args:
+            root_dir (Path): directory to keep the entries in
+            max_entries (int): maximum number of entries to keep
+            name (str, optional): what the entries are, for log messages
+        '''
+        self._root_dir: Path = Path(root_dir)
+        self._max_entries: int = max_entries
+        self._name: str = name
+        self._lock: Lock = Lock()
+        self._entries: OrderedDict[str, None] = None
+
+    def read(self, key: str, reader: Callable[[Path], Any]) -> Optional[Any]:
+        '''
+        Reads an entry, marking it as recently used. Entries which fail to read are removed
+
+        Args:
+            key (str): entry key
+            reader (Callable[[Path], Any]): reads the entry from its directory, raises if it is incomplete
+
+        Returns:
+            Optional[Any]: what reader returned, None if there is no such entry
+        '''
+        with self._lock:
+            entries = self._get_entries()
+            if key not in entries:
+                return None
+            entries.move_to_end(key)
+
+        entry_dir = self._root_dir.joinpath(key)
+        try:
+            value = reader(entry_dir)
+            os.utime(entry_dir)
+        except Exception as e:
+            logger.warning(f"Dropping unreadable {self._name} entry [{key}]: {e}")
+            with self._lock:
+                self._get_entries().pop(key, None)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return None
+        return value
+
+    def write(self, key: str, writer: Callable[[Path], None]) -> Optional[Path]:
+        '''
+        Adds an entry, evicting the least recently used ones if there are too many
+
+        Args:
+            key (str): entry key
+            writer (Callable[[Path], None]): writes the entry's files into the (empty) directory it is given
+
+        Returns:
+            Optional[Path]: the entry's directory, None if it could not be written
+        '''
+        scratch_dir = self.scratch_path(key)
+        entry_dir = self._root_dir.joinpath(key)
+        try:
+            os.makedirs(scratch_dir)
+            writer(scratch_dir)
+            try:
+                os.rename(scratch_dir, entry_dir)
+            except OSError:
+                if not os.path.isdir(entry_dir):
+                    raise
+                # Another writer stored the same key first. Its entry is just as good, and replacing it would pull it
+                # out from under anyone reading it
+                shutil.rmtree(scratch_dir, ignore_errors=True)
+        except Exception as e:
+            logger.warning(f"Failed to store {self._name} entry [{key}]: {e}")
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+            return None
+
+        with self._lock:
+            entries = self._get_entries()
+            entries[key] = None
+            entries.move_to_end(key)
+            while len(entries) > self._max_entries:
+                old_key, _ = entries.popitem(last=False)
+                shutil.rmtree(self._root_dir.joinpath(old_key), ignore_errors=True)
+        return entry_dir
+
+    def scratch_path(self, key: str, suffix: str = "") -> Path:
+        '''
+        Returns a unique path in the root directory which is not taken for an entry, eg to render a file to before it is written
+
+        Args:
+            key (str): entry key the path is for
+            suffix (str, optional): file extension
+        '''
+        os.makedirs(self._root_dir, exist_ok=True)
+        return self._root_dir.joinpath(f".{key}.{uuid.uuid4().hex}{suffix}")
+
+    def _get_entries(self) -> OrderedDict[str, None]:
+        ''' Returns the LRU index, building it from the root directory on first use. Must hold the lock '''
+        if self._entries is None:
+            self._entries = OrderedDict()
+            if os.path.isdir(self._root_dir):
+                entry_dirs = [entry for entry in os.scandir(self._root_dir) if entry.is_dir() and not entry.name.startswith(".")]
+                for entry in sorted(entry_dirs, key=lambda entry: entry.stat().st_mtime):
+                    self._entries[entry.name] = None
+        return self._entries
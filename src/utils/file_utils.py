@@ -0,0 +1,46 @@
+''' Utilities for files '''
+
+import hashlib
+import os
+import shutil
+from pathlib import Path
+
+
+class FileUtils:
+    @classmethod
+    def file_hash(cls, path: Path, block_size: int = 1 << 20) -> str:
+        '''
+        Returns a hash of a file's contents
+
+        Args:
+            path (Path): file to hash
+            block_size (int, optional): bytes read at a time
+
+        Returns:
+            str: hex digest of the file contents
+        '''
+        hasher = hashlib.sha1()
+        with open(path, "rb") as fhndl:
+            for block in iter(lambda: fhndl.read(block_size), b""):
+                hasher.update(block)
+        return hasher.hexdigest()
+
+    @classmethod
+    def text_hash(cls, text: str) -> str:
+        ''' Returns a hash of a string '''
+        return cls.bytes_hash(text.encode("utf-8"))
+
+    @classmethod
+    def bytes_hash(cls, data: bytes) -> str:
+        ''' Returns a hash of a buffer '''
+        return hashlib.sha1(data).hexdigest()
+
+    @classmethod
+    def link_or_copy(cls, src: Path, dst: Path):
+        ''' Hard links src to dst, replacing dst, and copies it instead where linking is not possible '''
+        if os.path.lexists(dst):
+            os.remove(dst)
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copyfile(src, dst)
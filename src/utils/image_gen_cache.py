@@ -0,0 +1,204 @@
+''' On-disk cache of deterministic image generation results '''
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import weakref
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+from PIL import Image
+from typing_extensions import override
+from webuiapi import ControlNetUnit, WebUIApiResult
+
+from image_gen import ImageGen
+from utils.disk_lru import DiskLru
+from utils.image_utils import ImageUtils
+
+logger = logging.getLogger(__file__)
+
+
+class ImageGenCache:
+    '''
+    Stores generation results on disk, keyed by a hash of every parameter which affects the output,
+    and evicts the least recently used entries beyond max_entries.
+    '''
+    class Filenames:
+        RESULT = "result.json"
+        IMAGE = "image_{idx}.png"
+
+    def __init__(self, cache_dir: Path, max_entries: int = 256):
+        '''
+        Initialize an ImageGenCache
+
+        Args:
+            cache_dir (Path): directory to store results in
+            max_entries (int, optional): maximum number of results to keep
+        '''
+        self._lru: DiskLru = DiskLru(root_dir=cache_dir, max_entries=max_entries, name="image cache")
+
+    @classmethod
+    def make_key(cls, **params) -> str:
+        '''
+        Returns a stable hash of the parameters. Images are hashed by content and objects by their attributes.
+
+        Args:
+            params: generation parameters
+
+        Returns:
+            str: hex digest identifying the parameters
+        '''
+        canonical = json.dumps(ImageGenCache._canonicalize(params), sort_keys=True)
+        return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def _canonicalize(cls, value: Any) -> Any:
+        ''' Converts value into something JSON serializable which compares equal for equivalent parameters '''
+        if isinstance(value, (Image.Image, np.ndarray)):
+            return {"image": ImageUtils.image_hash(value)}
+        if isinstance(value, dict):
+            return {str(key): ImageGenCache._canonicalize(val) for key, val in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [ImageGenCache._canonicalize(val) for val in value]
+        if isinstance(value, bool) or value is None:
+            return value
+        if isinstance(value, float) and value.is_integer():
+            # Gradio number boxes hand back floats, treat 7.0 and 7 the same
+            return int(value)
+        if isinstance(value, (str, int, float)):
+            return value
+        if hasattr(value, "__dict__"):
+            return {"type": type(value).__name__, "attrs": ImageGenCache._canonicalize(vars(value))}
+        return repr(value)
+
+    def get(self, key: str) -> Optional[WebUIApiResult]:
+        '''
+        Look up a result
+
+        Args:
+            key (str): key from make_key
+
+        Returns:
+            Optional[WebUIApiResult]: the cached result, or None
+        '''
+        def read(entry_dir: Path) -> WebUIApiResult:
+            with open(entry_dir.joinpath(ImageGenCache.Filenames.RESULT), "r") as fhndl:
+                data = json.load(fhndl)
+            images: List[Image.Image] = []
+            for idx in range(data["image_cnt"]):
+                image = Image.open(entry_dir.joinpath(ImageGenCache.Filenames.IMAGE.format(idx=idx)))
+                image.load()
+                images.append(image)
+            return WebUIApiResult(images=images, parameters=data["parameters"], info=data["info"])
+        return self._lru.read(key, read)
+
+    def put(self, key: str, result: WebUIApiResult) -> None:
+        '''
+        Store a result, evicting old results if the cache is full
+
+        Args:
+            key (str): key from make_key
+            result (WebUIApiResult): generation result to store
+        '''
+        def write(entry_dir: Path):
+            for idx, image in enumerate(result.images):
+                image.save(entry_dir.joinpath(ImageGenCache.Filenames.IMAGE.format(idx=idx)))
+            with open(entry_dir.joinpath(ImageGenCache.Filenames.RESULT), "w") as fhndl:
+                json.dump({"image_cnt": len(result.images), "parameters": result.parameters, "info": result.info}, fhndl)
+        self._lru.write(key, write)
+
+
+class CachedImageGen(ImageGen):
+    '''
+    ImageGen wrapper which serves repeat requests with a fixed seed from an ImageGenCache
+    '''
+    # Interrupted jobs resolve to partial images, which must not be served as the real result later.
+    # Shared by all instances, since a job may be interrupted through a different wrapper than the one which started it
+    _interrupted: weakref.WeakSet[Future] = weakref.WeakSet()
+
+    def __init__(self, image_gen: ImageGen, cache: ImageGenCache):
+        self._image_gen: ImageGen = image_gen
+        self._cache: ImageGenCache = cache
+
+    @override
+    def gen_image(self, prompt: str, input_image: Image.Image = None, controlnet_units: Optional[List[ControlNetUnit]] = None, **kwargs) -> Optional[str]:
+        return self.gen_image_async(prompt=prompt, input_image=input_image, controlnet_units=controlnet_units, **kwargs).result()
+
+    @override
+    def gen_image_async(self, prompt: str, input_image: Image.Image = None, controlnet_units: Optional[List[ControlNetUnit]] = None, **kwargs) -> Future:
+        # A random seed means the caller wants a new image every time
+        seed = kwargs.get("seed", -1)
+        if seed is None or int(seed) == -1:
+            return self._image_gen.gen_image_async(prompt=prompt, input_image=input_image, controlnet_units=controlnet_units, **kwargs)
+
+        try:
+            context = self._image_gen.get_cache_context(controlnet_units=controlnet_units, **kwargs)
+        except Exception as e:
+            logger.warning(f"Not caching image, the backend's model could not be determined: {e}")
+            return self._image_gen.gen_image_async(prompt=prompt, input_image=input_image, controlnet_units=controlnet_units, **kwargs)
+        def make_key(context: Dict[str, Any]) -> str:
+            return ImageGenCache.make_key(backend=type(self._image_gen).__name__, backend_context=context, prompt=prompt, input_image=input_image,
+                                          controlnet_units=controlnet_units or [], **kwargs)
+        key = make_key(context)
+        result = self._cache.get(key)
+        if result is not None:
+            logger.info(f"Image cache hit [{key}]")
+            future = Future()
+            future.set_result(result)
+            return future
+
+        future = self._image_gen.gen_image_async(prompt=prompt, input_image=input_image, controlnet_units=controlnet_units, **kwargs)
+
+        def store_result(done: Future):
+            if done in CachedImageGen._interrupted:
+                return
+            if not done.cancelled() and done.exception() is None and done.result() is not None:
+                try:
+                    job_context = self._image_gen.get_job_cache_context(done, controlnet_units=controlnet_units, **kwargs)
+                except Exception as e:
+                    logger.warning(f"Not caching image, the model it was generated with could not be determined: {e}")
+                    return
+                self._cache.put(key if job_context is None else make_key(job_context), done.result())
+        future.add_done_callback(store_result)
+        return future
+
+    @override
+    def detect_controlnet_map(self, module: str, image: Image.Image, processor_res: int = 512, threshold_a: float = 64, threshold_b: float = 64) -> Optional[Image.Image]:
+        return self._image_gen.detect_controlnet_map(module=module, image=image, processor_res=processor_res,
+                                                     threshold_a=threshold_a, threshold_b=threshold_b)
+
+    @override
+    def get_progress(self, job: Future) -> Optional[ImageGen.Progress]:
+        return self._image_gen.get_progress(job)
+
+    @override
+    def interrupt(self, job: Future) -> None:
+        CachedImageGen._interrupted.add(job)
+        self._image_gen.interrupt(job)
+
+    @override
+    def get_cache_context(self, **kwargs) -> Dict[str, Any]:
+        return self._image_gen.get_cache_context(**kwargs)
+
+    @override
+    def get_job_cache_context(self, job: Future, **kwargs) -> Optional[Dict[str, Any]]:
+        return self._image_gen.get_job_cache_context(job, **kwargs)
+
+    @override
+    def get_txt2img_method(self) -> Callable:
+        return self._image_gen.get_txt2img_method()
+
+    @override
+    def get_img2img_method(self) -> Callable:
+        return self._image_gen.get_img2img_method()
+
+    @override
+    def get_controlnet_models(self) -> List[str]:
+        return self._image_gen.get_controlnet_models()
+
+    @override
+    def get_controlnet_modules(self) -> List[str]:
+        return self._image_gen.get_controlnet_modules()
@@ -0,0 +1,114 @@
+''' Shares one backend call between identical concurrent image generation requests '''
+from __future__ import annotations
+
+import logging
+import weakref
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional
+
+from PIL import Image
+from typing_extensions import override
+from webuiapi import ControlNetUnit
+
+from image_gen import ImageGen
+from utils.image_gen_cache import ImageGenCache
+from utils.single_flight import SingleFlight
+
+logger = logging.getLogger(__file__)
+
+
+class CoalescingImageGen(ImageGen):
+    '''
+    ImageGen wrapper which joins a request to an identical one already in flight (same ImageGenCache.make_key hash),
+    so only one of them becomes a job on the server and all of them receive its result
+    '''
+
+    def __init__(self, image_gen: ImageGen, single_flight: SingleFlight = None, random_seeds: bool = True):
+        '''
+        Initialize a CoalescingImageGen
+
+        Args:
+            image_gen (ImageGen): image generator to wrap
+            single_flight (SingleFlight, optional): in-flight requests, share one between every wrapper of the same backend
+            random_seeds (bool, optional): also coalesce requests with a random seed (-1). They then share one random image
+        '''
+        self._image_gen: ImageGen = image_gen
+        self._random_seeds: bool = random_seeds
+        self._single_flight: SingleFlight = single_flight or SingleFlight(name=f"Coalescing{type(image_gen).__name__}")
+        # Jobs passed straight to the backend, they are not SingleFlight waiters
+        self._direct_jobs: weakref.WeakSet[Future] = weakref.WeakSet()
+
+    @override
+    def gen_image(self, prompt: str, input_image: Image.Image = None, controlnet_units: Optional[List[ControlNetUnit]] = None, **kwargs) -> Optional[str]:
+        return self.gen_image_async(prompt=prompt, input_image=input_image, controlnet_units=controlnet_units, **kwargs).result()
+
+    @override
+    def gen_image_async(self, prompt: str, input_image: Image.Image = None, controlnet_units: Optional[List[ControlNetUnit]] = None, **kwargs) -> Future:
+        seed = kwargs.get("seed", -1)
+        if not self._random_seeds and (seed is None or int(seed) == -1):
+            job = self._image_gen.gen_image_async(prompt=prompt, input_image=input_image, controlnet_units=controlnet_units, **kwargs)
+            self._direct_jobs.add(job)
+            return job
+
+        key = ImageGenCache.make_key(backend=type(self._image_gen).__name__, prompt=prompt, input_image=input_image,
+                                     controlnet_units=controlnet_units or [], **kwargs)
+        return self._single_flight.submit(key, lambda: self._image_gen.gen_image_async(
+            prompt=prompt, input_image=input_image, controlnet_units=controlnet_units, **kwargs))
+
+    @override
+    def get_progress(self, job: Future) -> Optional[ImageGen.Progress]:
+        if job.done():
+            return ImageGen.Progress(progress=1.0)
+        if job in self._direct_jobs:
+            return self._image_gen.get_progress(job)
+        shared = self._single_flight.get_shared(job)
+        return self._image_gen.get_progress(shared) if shared is not None else None
+
+    @override
+    def interrupt(self, job: Future) -> None:
+        if job in self._direct_jobs:
+            self._image_gen.interrupt(job)
+            return
+        # Only stop the backend job once every request sharing it has given up
+        shared = self._single_flight.detach(job)
+        if shared is not None:
+            self._image_gen.interrupt(shared)
+
+    @override
+    def get_cache_context(self, **kwargs) -> Dict[str, Any]:
+        return self._image_gen.get_cache_context(**kwargs)
+
+    def get_stats(self) -> Dict[str, int]:
+        ''' Returns request counts, 'suppressed' requests were served by another identical request's job '''
+        return self._single_flight.get_stats()
+
+    @override
+    def detect_controlnet_map(self, module: str, image: Image.Image, processor_res: int = 512, threshold_a: float = 64, threshold_b: float = 64) -> Optional[Image.Image]:
+        key = ImageGenCache.make_key(method="detect_controlnet_map", module=module, image=image, processor_res=processor_res,
+                                     threshold_a=threshold_a, threshold_b=threshold_b)
+        return self._single_flight.submit(key, lambda: self._detect_async(module=module, image=image, processor_res=processor_res,
+                                                                          threshold_a=threshold_a, threshold_b=threshold_b)).result()
+
+    def _detect_async(self, **kwargs) -> Future:
+        future = Future()
+        try:
+            future.set_result(self._image_gen.detect_controlnet_map(**kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    @override
+    def get_txt2img_method(self) -> Callable:
+        return self._image_gen.get_txt2img_method()
+
+    @override
+    def get_img2img_method(self) -> Callable:
+        return self._image_gen.get_img2img_method()
+
+    @override
+    def get_controlnet_models(self) -> List[str]:
+        return self._image_gen.get_controlnet_models()
+
+    @override
+    def get_controlnet_modules(self) -> List[str]:
+        return self._image_gen.get_controlnet_modules()
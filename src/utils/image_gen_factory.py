@@ -25,6 +25,17 @@ class ImageGenFactory:
         '''
         cls._image_gen_map.setdefault(name, ImageGenFactory.ImageGenInfo()).factory = factory_func
 
+    @classmethod
+    def wrap_image_gens(cls, wrapper_func: Callable[[ImageGen], ImageGen]):
+        '''
+        Wraps every registered image generator, eg to add caching in front of the backends
+
+        Args:
+            wrapper_func (Callable[[ImageGen], ImageGen]): a Callable which takes a new Image Gen instance and returns its replacement
+        '''
+        for info in cls._image_gen_map.values():
+            info.factory = lambda factory=info.factory: wrapper_func(factory())
+
     @classmethod
     def get_image_gen_list(cls):
         return sorted(cls._image_gen_map.keys())
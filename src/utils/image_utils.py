@@ -1,5 +1,6 @@
 ''' Utilities for images '''
 
+import hashlib
 from pathlib import Path
 from typing import Callable, Tuple, Union
 
@@ -46,3 +47,19 @@ class ImageUtils:
             return image
         image = Path(image)
         return Image.open(image)
+
+    @classmethod
+    def image_hash(cls, image: Union[np.ndarray, Image.Image]) -> str:
+        '''
+        Returns a hash of the image's pixel data, independent of how it was loaded
+
+        Args:
+            image (Union[np.ndarray, Image.Image]): image to hash
+
+        Returns:
+            str: hex digest of the image contents
+        '''
+        image = ImageUtils.image_data(image)
+        hasher = hashlib.sha1(f"{image.mode}:{image.size}".encode("utf-8"))
+        hasher.update(image.tobytes())
+        return hasher.hexdigest()
@@ -28,26 +28,62 @@ class Shared:
 
     def _init_from_settings(self, args: argparse.Namespace):
         ''' Load backends for items specified in params'''
+        # Backend capabilities (voices, models) are served from disk and refreshed in the background
+        catalog = None
+        if args.capability_catalog:
+            from utils.capability_catalog import CapabilityCatalog
+            catalog = CapabilityCatalog(path=args.capability_catalog, ttl=args.capability_catalog_ttl * 60 * 60)
+
         # Select Image Generator backend
         if args.image_gen_backend == "automatic1111":
             from image_gen_backends.automatic1111 import Automatic1111
-            ImageGenFactory.register_image_gen(Automatic1111.BACKEND_NAME, lambda: Automatic1111(
-                api_host=args.image_gen_webui_host, api_port=args.image_gen_webui_port))
+            from image_gen_backends.automatic1111_transport import ImageTransport
+            ImageTransport.install(wire_format=args.image_gen_wire_format, quality=args.image_gen_wire_quality)
+            # 0 waits forever
+            request_timeout = args.image_gen_request_timeout or None
+            connect_timeout = args.image_gen_connect_timeout or None
+            if args.image_gen_webui_endpoints:
+                # Several servers share one pool, which routes each request
+                from image_gen_backends.automatic1111_pool import Automatic1111Pool
+                endpoints = [(endpoint.rsplit(":", 1)[0], int(endpoint.rsplit(":", 1)[1])) for endpoint in args.image_gen_webui_endpoints]
+                pool = Automatic1111Pool(endpoints=endpoints, queue_size=args.image_gen_queue_size,
+                                         request_timeout=request_timeout, connect_timeout=connect_timeout, catalog=catalog)
+                ImageGenFactory.register_image_gen(Automatic1111Pool.BACKEND_NAME, lambda: pool)
+            else:
+                ImageGenFactory.register_image_gen(Automatic1111.BACKEND_NAME, lambda: Automatic1111(
+                    api_host=args.image_gen_webui_host, api_port=args.image_gen_webui_port, queue_size=args.image_gen_queue_size,
+                    request_timeout=request_timeout, connect_timeout=connect_timeout, catalog=catalog))
         else:
             raise Exception(f"Unsupported ImageGen backend: {args.image_gen_backend}")
 
+        # Serve repeated fixed-seed generations from disk
+        if args.image_gen_cache_size > 0:
+            from utils.image_gen_cache import CachedImageGen, ImageGenCache
+            image_gen_cache = ImageGenCache(cache_dir=args.image_gen_cache_dir, max_entries=args.image_gen_cache_size)
+            ImageGenFactory.wrap_image_gens(lambda image_gen: CachedImageGen(image_gen=image_gen, cache=image_gen_cache))
+
+        # Share one backend call between identical requests in flight at the same time
+        if args.image_gen_coalesce != "off":
+            from utils.image_gen_coalescer import CoalescingImageGen
+            from utils.single_flight import SingleFlight
+
+            # Factories hand out a new wrapper per session, so they must all share the in-flight requests
+            image_gen_flights = SingleFlight(name="ImageGen")
+            ImageGenFactory.wrap_image_gens(lambda image_gen: CoalescingImageGen(
+                image_gen=image_gen, single_flight=image_gen_flights, random_seeds=args.image_gen_coalesce == "all"))
+
         # Select Chat backend
         if args.chat_backend == "chatgpt":
             from chat_backends.chatgpt import ChatGpt
             ChatFactory.register_chat(ChatGpt.BACKEND_NAME, lambda: ChatGpt(
-                api_key=args.openai_api_key, initial_instructions=args.chat_instructions))
+                api_key=args.openai_api_key, initial_instructions=args.chat_instructions, api_base=args.openai_api_base))
         else:
             raise Exception(f"Unsupported chat backend: {args.chat_backend}")
 
         # Select TTS backend (note: these return the same instance)
         if args.tts_backend == "azure":
             from tts_backends.azure_tts import AzureTts
-            tts = AzureTts(api_key=args.azure_api_key, api_region=args.azure_api_region)
+            tts = AzureTts(api_key=args.azure_api_key, api_region=args.azure_api_region, catalog=catalog)
             VoiceFactory.register_tts(AzureTts.BACKEND_NAME, tts)
         elif args.tts_backend == "coqui":
             from tts_backends.coqui_tts import CoquiTts
@@ -67,6 +103,10 @@ class Shared:
         else:
             raise Exception(f"Unsupported UI backend: {args.ui_backend}")
 
+        if not args.no_lipsync_warm_up:
+            from avatar.lip_sync import LipSync
+            LipSync.warm_up()
+
         if args.clear_temp_on_launch:
             shutil.rmtree(args.temp_dir, ignore_errors=True)
         os.makedirs(args.temp_dir, exist_ok=True)
@@ -136,6 +176,8 @@ class Shared:
                             help="Number of times to increment port if port still busy after bind-retry-cnt", default=5)
         parser.add_argument("--openai-api-key", help="OpenAI API key", type=str,
                             default=os.getenv("OPENAI_API_KEY", "No Key Set"))
+        parser.add_argument("--openai-api-base", help="OpenAI API base URL (eg, point at tools/mock_openai_server.py)", type=str,
+                            default=os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1"))
         parser.add_argument("--azure-api-key", help="Azure API key", type=str,
                             default=os.getenv("AZURE_API_KEY", ""))
         parser.add_argument("--azure-api-region", help="Azure API Region",
@@ -147,6 +189,55 @@ class Shared:
         parser.add_argument("--image-gen-backend", choices=["automatic1111"], default="automatic1111")
         parser.add_argument("--image-gen-webui-host", help="Automatic1111 webui host", default="localhost")
         parser.add_argument("--image-gen-webui-port", help="Automatic1111 webui port", default="7860")
+        parser.add_argument("--image-gen-webui-endpoints", nargs="+", metavar="HOST:PORT",
+                            help="Several Automatic1111 webui servers to load balance across. Overrides --image-gen-webui-host/port")
+        parser.add_argument("--image-gen-request-timeout", help="Seconds to wait for the image gen server to respond before failing "
+                            "(or failing over), 0 to wait forever", type=float, default=300)
+        parser.add_argument("--image-gen-connect-timeout", help="Seconds to wait for a connection to the image gen server before failing "
+                            "(or failing over), 0 to wait forever", type=float, default=5)
+        parser.add_argument("--image-gen-queue-size", help="Max image generation requests waiting on the webui server",
+                            type=int, default=16)
+        parser.add_argument("--image-gen-wire-format", help="Image encoding used for requests to the image gen server. jpeg is lossy, best for previews",
+                            choices=["png", "webp", "jpeg"], default="png")
+        parser.add_argument("--image-gen-wire-quality", help="JPEG quality for --image-gen-wire-format=jpeg", type=int, default=90)
+        parser.add_argument("--image-gen-cache-dir", help="Directory to cache fixed-seed image generation results. Defaults to cache/image_gen in the data directory")
+        parser.add_argument("--image-gen-cache-size", help="Max cached image generation results, 0 to disable",
+                            type=int, default=256)
+        parser.add_argument("--image-gen-coalesce", help="Join identical image generation requests in flight at the same time. "
+                            "'fixed-seed' only joins requests with a fixed seed, 'all' also lets random seed requests share one image",
+                            choices=["off", "fixed-seed", "all"], default="fixed-seed")
+        parser.add_argument("--capability-catalog", help="File to keep backend voice and model lists in between runs, empty to always fetch them. "
+                            "Defaults to cache/capabilities.json in the data directory")
+        parser.add_argument("--capability-catalog-ttl", help="Hours before cataloged voice and model lists are refreshed in the background",
+                            type=float, default=24)
+        parser.add_argument("--no-lipsync-warm-up", help="Load Wav2Lip on the first lip sync instead of in the background at launch",
+                            action='store_true', default=False)
+        parser.add_argument("--lipsync-mode", help="How Wav2Lip runs. The onnx modes use onnxruntime on the CPU, exporting the checkpoint on first use",
+                            choices=["torch", "onnx", "onnx-int8"], default="torch")
+        parser.add_argument("--lipsync-onnx-threads", help="onnxruntime threads per operator for the onnx lip sync modes, 0 for one per physical core",
+                            type=int, default=0)
+        parser.add_argument("--lipsync-jobs", help="Lip sync videos rendered at once. They share one model, which batches their frames together",
+                            type=int, default=2)
+        parser.add_argument("--lipsync-max-batch", help="Most frames per lip sync model call, across jobs", type=int, default=256)
+        parser.add_argument("--lipsync-batch-wait", help="Milliseconds a part-filled lip sync batch waits for frames from other jobs",
+                            type=float, default=20)
+        parser.add_argument("--lipsync-segments", help="Split long lip sync clips into up to this many segments rendered at once in worker processes, "
+                            "each with its own copy of the model. 1 to render in one pass", type=int, default=1)
+        parser.add_argument("--lipsync-min-segment-seconds", help="Shortest lip sync segment, shorter clips are split into fewer segments",
+                            type=float, default=4)
+        parser.add_argument("--lipsync-mouth-only", help="Only replace the mouth region of avatar videos, blending its edges, and keep the rest of each frame as is",
+                            action='store_true', default=False)
+        parser.add_argument("--lipsync-detect-interval", help="Detect faces in every Nth frame of a new video and track them in between, 1 to detect every frame",
+                            type=int, default=1)
+        parser.add_argument("--lipsync-frame-cache-dir", help="Directory to keep decoded avatar video frames in, memory mapped by every render. Empty to decode each time. "
+                            "Defaults to cache/frames in the data directory")
+        parser.add_argument("--lipsync-frame-cache-size", help="Max GB of decoded frames to keep", type=float, default=8)
+        parser.add_argument("--lipsync-store-dir", help="Directory to keep finished lip sync videos in, keyed by speech, avatar video and settings. "
+                            "Defaults to cache/lipsync in the data directory")
+        parser.add_argument("--lipsync-store-size", help="Max stored lip sync videos, 0 to disable", type=int, default=64)
+        parser.add_argument("--video-codec", help="ffmpeg encoder for lip sync and motion match videos", default="libx264")
+        parser.add_argument("--video-preset", help="Encoder preset, faster presets make larger files", default="veryfast")
+        parser.add_argument("--video-crf", help="Encoder constant rate factor, lower is higher quality", type=int, default=23)
         parser.add_argument("--jobs", help="Max concurrent Gradio jobs", default=3)
         parser.add_argument("--chat-backend", choices=["chatgpt"], default="chatgpt")
         parser.add_argument("--coqui-use-gpu", help="Use GPU for coqui TTS", action="store_true", default=False)
@@ -156,4 +247,12 @@ class Shared:
         parser.add_argument("--clear-temp-on-launch", help="Cleans the temporary directory each launch",
                             action='store_true', default=False)
 
-        return parser.parse_args()
+        args = parser.parse_args()
+        # Caches live in the data directory rather than wherever the app was started from
+        cache_dir = os.path.join(self._root_dir, args.data_dir, "cache")
+        cache_defaults = {"image_gen_cache_dir": "image_gen", "capability_catalog": "capabilities.json",
+                          "lipsync_frame_cache_dir": "frames", "lipsync_store_dir": "lipsync"}
+        for name, default in cache_defaults.items():
+            if getattr(args, name) is None:
+                setattr(args, name, os.path.join(cache_dir, default))
+        return args
@@ -0,0 +1,129 @@
+''' Coalesces identical concurrent calls into one '''
+from __future__ import annotations
+
+import logging
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from threading import Event, Lock
+from typing import Callable, Dict, Hashable, List, Optional
+
+logger = logging.getLogger(__file__)
+
+
+class SingleFlight:
+    '''
+    While a call for a key is in flight, further calls for the same key join it instead of starting their own.
+    Every caller gets its own Future, so one caller giving up (detach) does not cancel the work for the others.
+    '''
+    @dataclass
+    class Flight:
+        key: Hashable
+        future: Future = None
+        waiters: List[Future] = field(default_factory=list)
+        # Set once future is assigned, the call is started outside the lock
+        started: Event = field(default_factory=Event)
+
+    def __init__(self, name: str = "SingleFlight"):
+        '''
+        Initialize a SingleFlight
+
+        Args:
+            name (str, optional): name used when logging
+        '''
+        self._name: str = name
+        self._lock: Lock = Lock()
+        self._flights: Dict[Hashable, SingleFlight.Flight] = {}
+        self._waiter_flights: Dict[Future, SingleFlight.Flight] = {}
+        self._stats: Dict[str, int] = {"calls": 0, "executed": 0, "suppressed": 0}
+
+    def submit(self, key: Hashable, func: Callable[[], Future]) -> Future:
+        '''
+        Starts func, unless a call with the same key is already in flight in which case that call is joined
+
+        Args:
+            key (Hashable): identifies equivalent calls
+            func (Callable[[], Future]): starts the work, returning a Future for its result
+
+        Returns:
+            Future: this caller's Future, resolved with the shared result
+        '''
+        waiter = Future()
+        with self._lock:
+            self._stats["calls"] += 1
+            flight = self._flights.get(key)
+            if flight is not None:
+                self._stats["suppressed"] += 1
+                flight.waiters.append(waiter)
+                self._waiter_flights[waiter] = flight
+                logger.info(f"{self._name}: joined in-flight call [{key}] ({len(flight.waiters)} waiters, {self._stats['suppressed']} suppressed)")
+                return waiter
+            self._stats["executed"] += 1
+            flight = SingleFlight.Flight(key=key, waiters=[waiter])
+            self._flights[key] = flight
+            self._waiter_flights[waiter] = flight
+
+        try:
+            flight.future = func()
+        except Exception as e:
+            flight.future = Future()
+            flight.future.set_exception(e)
+        finally:
+            flight.started.set()
+        flight.future.add_done_callback(lambda done: self._finish(flight, done))
+        return waiter
+
+    def _finish(self, flight: SingleFlight.Flight, done: Future):
+        ''' Passes the shared outcome on to every waiter still interested '''
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+            waiters, flight.waiters = flight.waiters, []
+            for waiter in waiters:
+                self._waiter_flights.pop(waiter, None)
+
+        for waiter in waiters:
+            if not waiter.set_running_or_notify_cancel():
+                continue
+            if done.cancelled():
+                # Everyone still waiting wanted the result, report it as a failure rather than leave them hanging
+                waiter.set_exception(Exception(f"{self._name}: shared call was cancelled"))
+            elif done.exception() is not None:
+                waiter.set_exception(done.exception())
+            else:
+                waiter.set_result(done.result())
+
+    def detach(self, waiter: Future) -> Optional[Future]:
+        '''
+        Cancels one caller's Future
+
+        Args:
+            waiter (Future): Future returned by submit
+
+        Returns:
+            Optional[Future]: the shared Future if no caller is left waiting on it (so the work can be stopped), else None
+        '''
+        with self._lock:
+            flight = self._waiter_flights.pop(waiter, None)
+            if flight is None:
+                return None
+            waiter.cancel()
+            flight.waiters.remove(waiter)
+            if flight.waiters:
+                return None
+            # Nobody wants this result any more, don't let new callers join it
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+        # The last caller may give up while the call is still being started, wait for its Future so it can still be stopped
+        flight.started.wait()
+        return flight.future
+
+    def get_shared(self, waiter: Future) -> Optional[Future]:
+        ''' Returns the shared Future a caller's Future is waiting on, None once it has resolved '''
+        with self._lock:
+            flight = self._waiter_flights.get(waiter)
+            return flight.future if flight is not None else None
+
+    def get_stats(self) -> Dict[str, int]:
+        ''' Returns call counts. 'suppressed' calls joined another in-flight call instead of doing the work '''
+        with self._lock:
+            return dict(self._stats, in_flight=len(self._flights))
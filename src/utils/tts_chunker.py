@@ -6,10 +6,10 @@ import time
 import traceback
 from dataclasses import dataclass
 from functools import partial
-from multiprocessing.dummy import Event, Lock, Queue
+from multiprocessing.dummy import Condition, Event, Lock, Queue
 from multiprocessing.pool import AsyncResult, ThreadPool
 from queue import Empty
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
 
@@ -72,6 +72,7 @@ class TtsChunker:
         self._worker_chunk_id: int = 0
         self._new_audio_avail_event: Event = Event()
         self._audio_complete_event: Event = Event()
+        self._chunk_cond: Condition = Condition()
 
     def cancel(self):
         '''
@@ -88,6 +89,8 @@ class TtsChunker:
 
             self._new_audio_avail_event.set()
             self._audio_complete_event.set()
+            with self._chunk_cond:
+                self._chunk_cond.notify_all()
 
     def reset(self):
         ''' Resets the Queue to prepare for new audio '''
@@ -183,6 +186,22 @@ class TtsChunker:
     def wait_for_audio_complete(self, timeout: float = None) -> bool:
         return self._audio_complete_event.wait(timeout)
 
+    def wait_for_chunk(self, chunk_id: int, timeout: float = None) -> Optional[TtsChunker.AudioData]:
+        '''
+        Waits for one chunk of audio. Unlike get_new_audio this does not consume anything, so it can be used alongside
+        the audio streaming
+
+        Args:
+            chunk_id (int): chunk to wait for, chunks are numbered from 0 in text order
+            timeout (float, optional): max seconds to wait
+
+        Returns:
+            Optional[TtsChunker.AudioData]: the chunk, or None if synthesis finished without it or the wait timed out
+        '''
+        with self._chunk_cond:
+            self._chunk_cond.wait_for(lambda: chunk_id in self._audio or self.audio_done, timeout=timeout)
+            return self._audio.get(chunk_id)
+
     def _get_chunk_id(self):
         ''' Returns the next chunk id '''
         chunk_id = self._worker_chunk_id
@@ -225,8 +244,10 @@ class TtsChunker:
                     logger.error(f"Synthesize Error: {e}")
                     audio_data, sample_rate = None, 0
 
-                self._audio[chunk_id] = TtsChunker.AudioData(
-                    text=text_to_speak, data=audio_data, sample_rate=sample_rate)
+                with self._chunk_cond:
+                    self._audio[chunk_id] = TtsChunker.AudioData(
+                        text=text_to_speak, data=audio_data, sample_rate=sample_rate)
+                    self._chunk_cond.notify_all()
                 self._new_audio_avail_event.set()
                 params.workq.task_done()
                 elapsed = time.time() - start
@@ -242,6 +263,8 @@ class TtsChunker:
         logger.info("Synthesis complete")
         self._pool_result = None
         self._audio_complete_event.set()
+        with self._chunk_cond:
+            self._chunk_cond.notify_all()
 
     @property
     def audio_done(self) -> bool:
@@ -0,0 +1,270 @@
+''' Frame-at-a-time video reading and writing, so memory use does not grow with clip length '''
+from __future__ import annotations
+
+import logging
+import os
+import subprocess
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator, List, Optional
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__file__)
+
+
+class VideoReader:
+    '''
+    Iterates over the BGR frames of a video, decoding one at a time
+    '''
+
+    def __init__(self, path: Path, default_fps: float = 25.0):
+        '''
+        Initialize a VideoReader
+
+        Args:
+            path (Path): video to read
+            default_fps (float, optional): frame rate to report if the video does not have one
+        '''
+        if not os.path.isfile(path):
+            raise ValueError(f"Video not found: {path}")
+        self._path: Path = Path(path)
+        capture = cv2.VideoCapture(str(path))
+        try:
+            self._fps: float = capture.get(cv2.CAP_PROP_FPS) or default_fps
+            self._width: int = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+            self._height: int = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            self._frame_cnt: int = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        finally:
+            capture.release()
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        return self.frames()
+
+    def frames(self, start: int = 0, end: Optional[int] = None) -> Iterator[np.ndarray]:
+        '''
+        Iterates over frames [start, end), seeking to start rather than decoding the frames before it
+
+        Args:
+            start (int, optional): first frame
+            end (Optional[int], optional): frame to stop before, None for the end of the video
+        '''
+        capture = cv2.VideoCapture(str(self._path))
+        try:
+            if start > 0:
+                capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+            frame_idx = start
+            while end is None or frame_idx < end:
+                still_reading, frame = capture.read()
+                if not still_reading:
+                    break
+                yield frame
+                frame_idx += 1
+        finally:
+            capture.release()
+
+    @property
+    def fps(self) -> float:
+        return self._fps
+
+    @property
+    def width(self) -> int:
+        return self._width
+
+    @property
+    def height(self) -> int:
+        return self._height
+
+    @property
+    def frame_cnt(self) -> int:
+        ''' Frame count from the container, an estimate for some formats '''
+        return self._frame_cnt
+
+
+class VideoWriter:
+    '''
+    Encodes frames by piping them to an ffmpeg process, optionally muxing in an audio track in the same pass.
+    Use as a context manager, the video is complete once it exits.
+
+    With an hls_dir the video is written as an HLS playlist of fragmented MP4 segments instead, each one listed as soon
+    as it is encoded so playback can start while frames are still being written. The playlist is remuxed (not re-encoded)
+    to output_path when the writer is closed
+    '''
+    class Filenames:
+        PLAYLIST = "index.m3u8"
+        INIT = "init.mp4"
+        SEGMENT = "segment_%05d.m4s"
+
+    @dataclass
+    class Settings:
+        codec: str = "libx264"
+        preset: str = "veryfast"
+        crf: int = 23
+        pix_fmt: str = "yuv420p"
+        audio_codec: str = "aac"
+        hls_segment_seconds: float = 2.0
+
+    def __init__(self, output_path: Path, width: int, height: int, fps: float, audio_path: Optional[Path] = None,
+                 settings: VideoWriter.Settings = None, input_pix_fmt: str = "bgr24", hls_dir: Optional[Path] = None):
+        '''
+        Initialize a VideoWriter, starting ffmpeg
+
+        Args:
+            output_path (Path): video to write
+            width (int): frame width
+            height (int): frame height
+            fps (float): frame rate
+            audio_path (Optional[Path], optional): audio to mux in, the video ends with the shorter of the two
+            settings (VideoWriter.Settings, optional): encoder settings
+            input_pix_fmt (str, optional): layout of the frames written, 'bgr24' (OpenCV) or 'rgb24'
+            hls_dir (Optional[Path], optional): directory to write an HLS playlist and its segments to while encoding
+        '''
+        settings = settings or VideoWriter.Settings()
+        self._output_path: Path = Path(output_path)
+        self._hls_dir: Optional[Path] = Path(hls_dir) if hls_dir is not None else None
+        self._frame_size: int = width * height * 3
+        self._frame_cnt: int = 0
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+
+        cmd = ["ffmpeg", "-y", "-loglevel", "error",
+               "-f", "rawvideo", "-pix_fmt", input_pix_fmt, "-s", f"{width}x{height}", "-r", f"{fps}", "-i", "-"]
+        if audio_path is not None:
+            cmd += ["-i", str(audio_path), "-map", "0:v:0", "-map", "1:a:0", "-c:a", settings.audio_codec, "-shortest"]
+        # yuv420p needs even dimensions
+        cmd += ["-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+                "-c:v", settings.codec, "-preset", settings.preset, "-crf", str(settings.crf), "-pix_fmt", settings.pix_fmt]
+        if self._hls_dir is None:
+            cmd += [str(output_path)]
+        else:
+            os.makedirs(self._hls_dir, exist_ok=True)
+            # Segments can only start on a keyframe. An event playlist only grows, so players poll it for new segments
+            cmd += ["-force_key_frames", f"expr:gte(t,n_forced*{settings.hls_segment_seconds})",
+                    "-f", "hls", "-hls_time", f"{settings.hls_segment_seconds}", "-hls_playlist_type", "event",
+                    "-hls_segment_type", "fmp4", "-hls_fmp4_init_filename", VideoWriter.Filenames.INIT,
+                    "-hls_flags", "independent_segments+temp_file",
+                    "-hls_segment_filename", str(self._hls_dir / VideoWriter.Filenames.SEGMENT),
+                    str(self._hls_dir / VideoWriter.Filenames.PLAYLIST)]
+        # ffmpeg only writes errors, but a pipe it could fill would stall it
+        self._stderr = tempfile.TemporaryFile()
+        self._process: subprocess.Popen = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=self._stderr)
+
+    @classmethod
+    def concat(cls, segment_paths: List[Path], output_path: Path, audio_path: Optional[Path] = None, settings: VideoWriter.Settings = None):
+        '''
+        Joins videos written with the same settings end to end with the ffmpeg concat demuxer. The video stream is copied,
+        not re-encoded
+
+        Args:
+            segment_paths (List[Path]): videos to join, in order
+            output_path (Path): video to write
+            audio_path (Optional[Path], optional): audio to mux in, replacing any the segments have
+            settings (VideoWriter.Settings, optional): settings the segments were written with, for the audio codec
+        '''
+        settings = settings or VideoWriter.Settings()
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False, encoding="utf8") as list_file:
+            for segment_path in segment_paths:
+                escaped = os.path.abspath(segment_path).replace("'", "'\\''")
+                list_file.write(f"file '{escaped}'\n")
+        try:
+            cmd = ["ffmpeg", "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_file.name]
+            if audio_path is not None:
+                cmd += ["-i", str(audio_path), "-map", "0:v:0", "-map", "1:a:0", "-c:a", settings.audio_codec, "-shortest"]
+            cmd += ["-c:v", "copy", str(output_path)]
+            process = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            if process.returncode != 0:
+                errors = process.stderr.decode("utf-8", errors="replace").strip()
+                raise Exception(f"ffmpeg failed joining {output_path} ({process.returncode}): {errors}")
+        finally:
+            os.remove(list_file.name)
+
+    @classmethod
+    def write_hls(cls, video_path: Path, hls_dir: Path, settings: VideoWriter.Settings = None):
+        '''
+        Splits a finished video into an HLS playlist like the one written while encoding, without re-encoding it. Segments
+        start on the video's keyframes, so they may be longer than settings.hls_segment_seconds
+
+        Args:
+            video_path (Path): video to split
+            hls_dir (Path): directory to write the playlist and its segments to
+            settings (VideoWriter.Settings, optional): settings for the segment length
+        '''
+        settings = settings or VideoWriter.Settings()
+        hls_dir = Path(hls_dir)
+        os.makedirs(hls_dir, exist_ok=True)
+        cmd = ["ffmpeg", "-y", "-loglevel", "error", "-i", str(video_path), "-c", "copy",
+               "-f", "hls", "-hls_time", f"{settings.hls_segment_seconds}", "-hls_playlist_type", "vod",
+               "-hls_segment_type", "fmp4", "-hls_fmp4_init_filename", VideoWriter.Filenames.INIT,
+               "-hls_flags", "independent_segments+temp_file",
+               "-hls_segment_filename", str(hls_dir / VideoWriter.Filenames.SEGMENT),
+               str(hls_dir / VideoWriter.Filenames.PLAYLIST)]
+        process = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if process.returncode != 0:
+            errors = process.stderr.decode("utf-8", errors="replace").strip()
+            raise Exception(f"ffmpeg failed splitting {video_path} into {hls_dir} ({process.returncode}): {errors}")
+
+    def write(self, frame: np.ndarray):
+        ''' Encodes a frame, which must match the size and pixel format given when the writer was created '''
+        data = np.ascontiguousarray(frame, dtype=np.uint8).tobytes()
+        if len(data) != self._frame_size:
+            raise ValueError(f"Frame is {len(data)} bytes, expected {self._frame_size}")
+        try:
+            self._process.stdin.write(data)
+        except BrokenPipeError:
+            self.close()
+            raise
+        self._frame_cnt += 1
+
+    def close(self):
+        ''' Finishes the video. Raises if ffmpeg failed '''
+        if self._process is None:
+            return
+        process, self._process = self._process, None
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        return_code = process.wait()
+        self._stderr.seek(0)
+        errors = self._stderr.read().decode("utf-8", errors="replace").strip()
+        self._stderr.close()
+        if return_code != 0:
+            raise Exception(f"ffmpeg failed writing {self._output_path} ({return_code}): {errors}")
+        if self._hls_dir is not None:
+            self._remux_hls()
+
+    def _remux_hls(self):
+        ''' Copies the finished HLS segments into one MP4 at output_path '''
+        cmd = ["ffmpeg", "-y", "-loglevel", "error", "-i", str(self._hls_dir / VideoWriter.Filenames.PLAYLIST),
+               "-c", "copy", "-movflags", "+faststart", str(self._output_path)]
+        process = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if process.returncode != 0:
+            errors = process.stderr.decode("utf-8", errors="replace").strip()
+            raise Exception(f"ffmpeg failed remuxing {self._hls_dir} to {self._output_path} ({process.returncode}): {errors}")
+
+    def abort(self):
+        ''' Stops ffmpeg without finishing the video '''
+        if self._process is not None:
+            self._process.kill()
+            self._process.wait()
+            self._process = None
+            self._stderr.close()
+
+    def __enter__(self) -> VideoWriter:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    @property
+    def frame_cnt(self) -> int:
+        return self._frame_cnt
+
+    @property
+    def hls_dir(self) -> Optional[Path]:
+        return self._hls_dir
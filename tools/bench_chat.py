@@ -0,0 +1,64 @@
+''' Load benchmark for the chat path, normally run against tools/mock_openai_server.py '''
+import argparse
+import logging
+import sys
+
+from bench_utils import BenchResult, add_src_to_path, run_sessions, timed_call
+
+#fmt: off
+add_src_to_path()
+from chat_backends.chatgpt import ChatGpt
+from utils.chat_factory import ChatFactory
+#fmt: on
+
+logger = logging.getLogger(__file__)
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description="Chat path load benchmark",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--verbose', '-v', help="Verbose", action='store_true', default=False)
+    parser.add_argument("--sessions", "-n", type=int, default=8, help="Number of concurrent chat sessions")
+    parser.add_argument("--requests", "-r", type=int, default=10, help="Number of prompts sent by each session")
+    parser.add_argument("--target", choices=["chatgpt", "chatbox"], default="chatgpt",
+                        help="Drive ChatGpt.send_text directly, or through ChatBox._submitText")
+    parser.add_argument("--api-base", default="http://127.0.0.1:5990/v1", help="OpenAI API base URL")
+    parser.add_argument("--api-key", default="mock-key", help="OpenAI API key")
+    parser.add_argument("--spawn-mock", action="store_true", default=False,
+                        help="Start an in-process mock server on a free port instead of using --api-base")
+
+    import mock_openai_server
+    mock_openai_server.add_args(parser)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO if args.verbose else logging.WARNING)
+
+    api_base = args.api_base
+    if args.spawn_mock:
+        import mock_openai_server
+        from mock_utils import start_server
+        server, _ = start_server(mock_openai_server.make_handler(mock_openai_server.config_from_args(args)), host="127.0.0.1", port=0)
+        api_base = f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+    ChatFactory.register_chat(ChatGpt.BACKEND_NAME, lambda: ChatGpt(api_key=args.api_key, api_base=api_base,
+                                                                     initial_instructions="You are a benchmark"))
+
+    if args.target == "chatbox":
+        from ui_backends.gradio_backend.components.chat_box import ChatBox
+
+        def session(session_id: int, result: BenchResult):
+            # _submitText only uses its instance data, so skip building the Gradio component
+            state = ChatBox.StateData()
+            for idx in range(args.requests):
+                timed_call(result, ChatBox._submitText, None, f"Session {session_id} prompt {idx}", state)
+    else:
+        def session(session_id: int, result: BenchResult):
+            chat = ChatFactory.get_default_chat()
+            for idx in range(args.requests):
+                timed_call(result, chat.send_text, f"Session {session_id} prompt {idx}")
+
+    result = run_sessions(session, sessions=args.sessions, verbose=args.verbose)
+    result.report(f"{args.target}: {args.sessions} sessions x {args.requests} requests against {api_base}")
@@ -0,0 +1,100 @@
+''' Load benchmark for the image generation path, normally run against tools/mock_a1111_server.py '''
+import argparse
+import logging
+import shutil
+import sys
+import tempfile
+
+from bench_utils import BenchResult, add_src_to_path, run_sessions, timed_call
+
+#fmt: off
+add_src_to_path()
+from image_gen import ImageGen
+from image_gen_backends.automatic1111 import Automatic1111
+from image_gen_backends.automatic1111_transport import ImageTransport
+from webuiapi import ControlNetUnit
+#fmt: on
+
+logger = logging.getLogger(__file__)
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description="Image generation load benchmark",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--verbose', '-v', help="Verbose", action='store_true', default=False)
+    parser.add_argument("--sessions", "-n", type=int, default=4, help="Number of concurrent sessions")
+    parser.add_argument("--requests", "-r", type=int, default=5, help="Number of images requested by each session")
+    parser.add_argument("--host", default="127.0.0.1", help="Automatic1111 webui host")
+    parser.add_argument("--port", type=int, default=7860, help="Automatic1111 webui port")
+    parser.add_argument("--endpoints", nargs="+", metavar="HOST:PORT", default=None,
+                        help="Benchmark an Automatic1111Pool over these servers instead of --host/--port")
+    parser.add_argument("--spawn-mock", type=int, default=0, metavar="N",
+                        help="Start N in-process mock servers on free ports instead of using --host/--port (N > 1 benchmarks the pool)")
+    parser.add_argument("--steps", type=int, default=20, help="Sampling steps per image")
+    parser.add_argument("--size", type=int, default=512, help="Image width and height")
+    parser.add_argument("--seed", type=int, default=-1, help="Fixed seed (exercises the result cache), -1 for random")
+    parser.add_argument("--distinct-prompts", type=int, default=0,
+                        help="Cycle requests through this many prompts so repeats can hit the cache. 0 makes every prompt unique")
+    parser.add_argument("--controlnet", action="store_true", default=False, help="Send an openpose ControlNet unit with each request")
+    parser.add_argument("--queue-size", type=int, default=64, help="Client request queue size")
+    parser.add_argument("--wire-format", choices=ImageTransport.WIRE_FORMATS, default="png", help="Request image encoding")
+    parser.add_argument("--cache-size", type=int, default=0, help="Wrap the backend in a result cache of this size (in a temp dir), 0 to disable")
+    parser.add_argument("--coalesce", action="store_true", default=False, help="Join identical requests which are in flight at the same time")
+
+    import mock_a1111_server
+    mock_a1111_server.add_args(parser)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO if args.verbose else logging.WARNING)
+
+    endpoints = [(endpoint.rsplit(":", 1)[0], int(endpoint.rsplit(":", 1)[1])) for endpoint in args.endpoints or []]
+    if args.spawn_mock > 0:
+        import mock_a1111_server
+        from mock_utils import start_server
+        endpoints = []
+        for _ in range(args.spawn_mock):
+            server, _ = start_server(mock_a1111_server.make_handler(mock_a1111_server.config_from_args(args)), host="127.0.0.1", port=0)
+            endpoints.append(("127.0.0.1", server.server_address[1]))
+    if not endpoints:
+        endpoints = [(args.host, args.port)]
+
+    ImageTransport.install(wire_format=args.wire_format)
+    if len(endpoints) > 1:
+        from image_gen_backends.automatic1111_pool import Automatic1111Pool
+        image_gen: ImageGen = Automatic1111Pool(endpoints=endpoints, queue_size=args.queue_size)
+    else:
+        image_gen = Automatic1111(api_host=endpoints[0][0], api_port=endpoints[0][1], queue_size=args.queue_size)
+
+    cache_dir = None
+    if args.cache_size > 0:
+        from utils.image_gen_cache import CachedImageGen, ImageGenCache
+        cache_dir = tempfile.mkdtemp(prefix="bench_image_gen_")
+        image_gen = CachedImageGen(image_gen=image_gen, cache=ImageGenCache(cache_dir=cache_dir, max_entries=args.cache_size))
+
+    coalescer = None
+    if args.coalesce:
+        from utils.image_gen_coalescer import CoalescingImageGen
+        image_gen = coalescer = CoalescingImageGen(image_gen=image_gen)
+
+    from mock_a1111_server import make_image
+    pose_image = make_image(seed=0, width=args.size, height=args.size)
+
+    def session(session_id: int, result: BenchResult):
+        for idx in range(args.requests):
+            prompt_idx = (session_id * args.requests + idx) % args.distinct_prompts if args.distinct_prompts > 0 else f"{session_id}-{idx}"
+            controlnet_units = [ControlNetUnit(input_image=pose_image, module="openpose", model="control_openpose-mock [a1b2c3d4]")] if args.controlnet else []
+            timed_call(result, image_gen.gen_image, prompt=f"Benchmark prompt {prompt_idx}", seed=args.seed, steps=args.steps,
+                       width=args.size, height=args.size, controlnet_units=controlnet_units)
+
+    result = run_sessions(session, sessions=args.sessions, verbose=args.verbose)
+    result.report(f"{type(image_gen).__name__}: {args.sessions} sessions x {args.requests} requests against "
+                  f"{', '.join(f'{host}:{port}' for host, port in endpoints)}")
+    print(f"  {'encode memo':>16}: {ImageTransport.get_stats()}")
+    if coalescer is not None:
+        print(f"  {'coalescing':>16}: {coalescer.get_stats()}")
+    if cache_dir is not None:
+        # The cache may still be storing the last results, so don't fail on a busy directory
+        shutil.rmtree(cache_dir, ignore_errors=True)
@@ -0,0 +1,122 @@
+''' Shared helpers for the benchmark scripts '''
+from __future__ import annotations
+
+import os
+import pathlib
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List
+
+
+def add_src_to_path():
+    ''' Makes the application modules importable, the same way main.py does '''
+    root_dir = pathlib.Path(__file__).parent.parent.resolve()
+    sys.path.append(os.path.join(root_dir, "src"))
+    sys.path.append(os.path.join(root_dir, "external", "repos"))
+
+
+def percentile(values: List[float], pct: float) -> float:
+    '''
+    Returns the pct percentile of values, using linear interpolation
+
+    Args:
+        values (List[float]): samples
+        pct (float): percentile in the range [0, 100]
+
+    Returns:
+        float: the percentile, or 0 if there are no samples
+    '''
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+@dataclass
+class BenchResult:
+    latencies: List[float] = field(default_factory=list)
+    errors: Counter = field(default_factory=Counter)
+    elapsed: float = 0.0
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def add_latency(self, latency: float):
+        with self._lock:
+            self.latencies.append(latency)
+
+    def add_error(self, error: Exception):
+        with self._lock:
+            self.errors[type(error).__name__] += 1
+
+    def summary(self) -> Dict[str, float]:
+        ''' Returns throughput and latency percentiles '''
+        completed = len(self.latencies)
+        return {"requests": completed + sum(self.errors.values()),
+                "completed": completed,
+                "errors": sum(self.errors.values()),
+                "elapsed_s": self.elapsed,
+                "throughput_rps": completed / self.elapsed if self.elapsed > 0 else 0.0,
+                "p50_s": percentile(self.latencies, 50),
+                "p95_s": percentile(self.latencies, 95),
+                "p99_s": percentile(self.latencies, 99)}
+
+    def report(self, title: str):
+        ''' Prints a summary of the results '''
+        print(f"\n{title}")
+        for key, value in self.summary().items():
+            print(f"  {key:>16}: {value:.3f}" if isinstance(value, float) else f"  {key:>16}: {value}")
+        for name, cnt in self.errors.most_common():
+            print(f"  {'error':>16}: {name} x{cnt}")
+
+
+def run_sessions(session_func: Callable[[int, BenchResult], None], sessions: int, verbose: bool = False) -> BenchResult:
+    '''
+    Runs session_func concurrently, once per session, and collects the timing results
+
+    Args:
+        session_func (Callable[[int, BenchResult], None]): function run by each session. Records its own latencies in the BenchResult
+        sessions (int): number of concurrent sessions
+        verbose (bool, optional): print tracebacks of session failures
+
+    Returns:
+        BenchResult: the collected results
+    '''
+    result = BenchResult()
+
+    def wrapped(session_id: int):
+        try:
+            session_func(session_id, result)
+        except Exception as e:
+            if verbose:
+                traceback.print_exception(e)
+            result.add_error(e)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=sessions) as pool:
+        list(pool.map(wrapped, range(sessions)))
+    result.elapsed = time.perf_counter() - start
+    return result
+
+
+def timed_call(result: BenchResult, func: Callable, *args, **kwargs):
+    '''
+    Calls func, recording its latency or error in result
+
+    Returns:
+        the return value of func, or None on error
+    '''
+    start = time.perf_counter()
+    try:
+        ret = func(*args, **kwargs)
+    except Exception as e:
+        result.add_error(e)
+        return None
+    result.add_latency(time.perf_counter() - start)
+    return ret
@@ -0,0 +1,118 @@
+''' Compares Wav2Lip inference speed and output of the torch and onnxruntime (float and int8) lip sync modes '''
+import argparse
+import logging
+import os
+import sys
+import time
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from bench_utils import add_src_to_path, percentile
+
+#fmt: off
+add_src_to_path()
+from avatar.wav2lip_onnx import Wav2LipOnnx
+from avatar.wav2lip_worker import Wav2LipWorker
+#fmt: on
+
+logger = logging.getLogger(__file__)
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description="Wav2Lip torch vs onnxruntime benchmark",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--verbose', '-v', help="Verbose", action='store_true', default=False)
+    parser.add_argument("--checkpoint", default=os.path.join("models", "wav2lip", "wav2lip_gan.pth"), help="Wav2Lip checkpoint")
+    parser.add_argument("--onnx-dir", default=None, help="Where the exported models are (and are exported to if missing). Defaults to the checkpoint's directory")
+    parser.add_argument("--modes", nargs="+", choices=["torch", "onnx", "onnx-int8"], default=["torch", "onnx", "onnx-int8"], help="Modes to compare")
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 16, 128], help="Frames per model call")
+    parser.add_argument("--iterations", "-n", type=int, default=5, help="Timed model calls per mode and batch size")
+    parser.add_argument("--threads", type=int, default=0, help="onnxruntime threads per operator, 0 for one per physical core")
+    parser.add_argument("--torch-threads", type=int, default=0, help="torch CPU threads, 0 for the torch default")
+    parser.add_argument("--face", default=None, help="Face image to feed the model, random pixels if not given")
+    parser.add_argument("--audio", default=None, help="Speech to take mel windows from, random if not given")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for generated inputs")
+    return parser.parse_args()
+
+
+def _make_inputs(args: argparse.Namespace, batch_size: int) -> Dict[str, np.ndarray]:
+    ''' Returns model inputs in NCHW layout, made the same way the worker makes them '''
+    rng = np.random.default_rng(args.seed)
+    img_size = Wav2LipWorker.IMG_SIZE
+    if args.face:
+        import cv2
+        face = cv2.resize(cv2.imread(args.face), (img_size, img_size))
+    else:
+        face = rng.integers(0, 256, size=(img_size, img_size, 3), dtype=np.uint8)
+    masked = face.copy()
+    masked[img_size // 2:] = 0
+    faces = np.repeat((np.concatenate((masked, face), axis=2) / 255.)[np.newaxis], batch_size, axis=0)
+
+    if args.audio:
+        from wav2lip.wav2lip import audio as wav2lip_audio
+        mel = wav2lip_audio.melspectrogram(wav2lip_audio.load_wav(args.audio, Wav2LipWorker.SAMPLE_RATE))
+        starts = np.linspace(0, mel.shape[1] - Wav2LipWorker.MEL_STEP_SIZE, batch_size).astype(int)
+        mels = np.stack([mel[:, start:start + Wav2LipWorker.MEL_STEP_SIZE] for start in starts])
+    else:
+        mels = rng.normal(-2.0, 1.5, size=(batch_size, 80, Wav2LipWorker.MEL_STEP_SIZE))
+    return {"face": faces.transpose(0, 3, 1, 2).astype(np.float32), "mel": mels[:, np.newaxis].astype(np.float32)}
+
+
+def _load_models(args: argparse.Namespace) -> Dict[str, Callable[[np.ndarray, np.ndarray], np.ndarray]]:
+    import torch
+    if args.torch_threads > 0:
+        torch.set_num_threads(args.torch_threads)
+    torch_model = Wav2LipWorker.load_torch_model(args.checkpoint, "cpu")
+
+    def run_torch(mel: np.ndarray, face: np.ndarray) -> np.ndarray:
+        with torch.no_grad():
+            return torch_model(torch.from_numpy(mel), torch.from_numpy(face)).numpy()
+
+    onnx_dir = args.onnx_dir or os.path.dirname(args.checkpoint)
+    onnx_path = os.path.join(onnx_dir, "wav2lip_gan.onnx")
+    int8_path = os.path.join(onnx_dir, "wav2lip_gan.int8.onnx")
+    if any(mode.startswith("onnx") for mode in args.modes) and not os.path.exists(onnx_path):
+        Wav2LipOnnx.export(torch_model, onnx_path)
+    if "onnx-int8" in args.modes and not os.path.exists(int8_path):
+        Wav2LipOnnx.quantize(onnx_path, int8_path)
+
+    # torch is always loaded, it is the reference output
+    models = {"torch": run_torch}
+    if "onnx" in args.modes:
+        models["onnx"] = Wav2LipOnnx(onnx_path, intra_op_threads=args.threads)
+    if "onnx-int8" in args.modes:
+        models["onnx-int8"] = Wav2LipOnnx(int8_path, intra_op_threads=args.threads)
+    return models
+
+
+def _psnr(reference: np.ndarray, output: np.ndarray) -> float:
+    mse = np.mean((reference * 255. - output * 255.) ** 2)
+    return float("inf") if mse == 0 else 10 * np.log10(255. ** 2 / mse)
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO if args.verbose else logging.WARNING)
+
+    models = _load_models(args)
+    print(f"{'mode':>10} {'batch':>6} {'p50 ms/frame':>13} {'p95 ms/frame':>13} {'speedup':>8} {'max abs err':>12} {'psnr dB':>8}")
+    for batch_size in args.batch_sizes:
+        inputs = _make_inputs(args, batch_size)
+        reference = None
+        torch_p50 = None
+        for mode in ["torch"] + [mode for mode in args.modes if mode != "torch"]:
+            model = models[mode]
+            output = model(inputs["mel"], inputs["face"])  # warm up
+            latencies: List[float] = []
+            for _ in range(args.iterations):
+                start_time = time.perf_counter()
+                model(inputs["mel"], inputs["face"])
+                latencies.append((time.perf_counter() - start_time) * 1000 / batch_size)
+            p50 = percentile(latencies, 50)
+            if mode == "torch":
+                reference, torch_p50 = output, p50
+                if "torch" not in args.modes:
+                    continue
+            print(f"{mode:>10} {batch_size:>6} {p50:>13.2f} {percentile(latencies, 95):>13.2f} {torch_p50 / p50:>7.2f}x "
+                  f"{np.abs(reference - output).max() * 255:>12.2f} {_psnr(reference, output):>8.1f}")
@@ -0,0 +1,283 @@
+''' Local stand-in for the AUTOMATIC1111 webui API (with the ControlNet extension), for testing the image path without a GPU '''
+from __future__ import annotations
+
+import argparse
+import base64
+import io
+import json
+import logging
+import random
+import sys
+import time
+from dataclasses import dataclass, field
+from threading import Lock, Semaphore
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from PIL import Image
+
+from mock_utils import FaultInjector, JsonRequestHandler, LatencyModel, start_server
+
+logger = logging.getLogger(__file__)
+
+
+@dataclass
+class MockA1111Config:
+    step_latency: LatencyModel = field(default_factory=LatencyModel)
+    detect_latency: LatencyModel = field(default_factory=LatencyModel)
+    faults: FaultInjector = field(default_factory=FaultInjector)
+    gpu_slots: int = 1
+    sd_models: List[str] = field(default_factory=lambda: ["mock-v1-5.safetensors [0123456789]"])
+    controlnet_models: List[str] = field(default_factory=lambda: ["control_openpose-mock [a1b2c3d4]", "control_canny-mock [e5f6a7b8]"])
+    controlnet_modules: List[str] = field(default_factory=lambda: ["none", "openpose", "canny", "depth"])
+
+
+class MockGpu:
+    '''
+    Simulated GPU. Runs one job per slot, tracks progress of the current job and honours interrupt/skip like the webui
+    '''
+
+    def __init__(self, slots: int):
+        self._slots: Semaphore = Semaphore(slots)
+        self._lock: Lock = Lock()
+        self.job_count: int = 0
+        self.job_no: int = 0
+        self.sampling_step: int = 0
+        self.sampling_steps: int = 0
+        self.started: float = 0.0
+        self.current_image: Optional[Image.Image] = None
+        self.interrupted: bool = False
+        self.skipped: bool = False
+
+    def run(self, steps: int, job_count: int, step_latency: LatencyModel, make_image) -> List[Image.Image]:
+        '''
+        Runs job_count jobs of steps steps each, sleeping step_latency per step
+
+        Args:
+            steps (int): sampling steps per job
+            job_count (int): number of jobs (n_iter)
+            step_latency (LatencyModel): time taken by each step
+            make_image (Callable[[int], List[Image.Image]]): makes the images of job N
+
+        Returns:
+            List[Image.Image]: images of every job which was not skipped, partial if interrupted
+        '''
+        images: List[Image.Image] = []
+        with self._slots:
+            with self._lock:
+                self.job_count, self.job_no, self.sampling_steps = job_count, 0, steps
+                self.started, self.interrupted, self.skipped = time.time(), False, False
+            try:
+                for job_no in range(job_count):
+                    job_images = make_image(job_no)
+                    with self._lock:
+                        self.job_no, self.sampling_step, self.skipped = job_no, 0, False
+                    for step in range(steps):
+                        step_latency.sleep()
+                        with self._lock:
+                            self.sampling_step = step + 1
+                            self.current_image = job_images[0]
+                            if self.interrupted or self.skipped:
+                                break
+                    if not self.skipped:
+                        images += job_images
+                    if self.interrupted:
+                        break
+            finally:
+                with self._lock:
+                    self.job_count, self.sampling_step, self.sampling_steps, self.current_image = 0, 0, 0, None
+        return images
+
+    def interrupt(self):
+        with self._lock:
+            self.interrupted = True
+
+    def skip(self):
+        with self._lock:
+            self.skipped = True
+
+    def get_progress(self) -> Dict[str, Any]:
+        ''' Returns the fields of the webui /sdapi/v1/progress response '''
+        with self._lock:
+            if self.job_count == 0 or self.sampling_steps == 0:
+                return {"progress": 0.0, "eta_relative": 0.0, "current_image": None,
+                        "state": {"job_count": 0, "job_no": 0, "sampling_step": 0, "sampling_steps": 0, "interrupted": False, "skipped": False}}
+            progress = (self.job_no + self.sampling_step / self.sampling_steps) / self.job_count
+            elapsed = time.time() - self.started
+            eta = elapsed / progress - elapsed if progress > 0 else 0.0
+            return {"progress": progress, "eta_relative": eta, "current_image": self.current_image,
+                    "state": {"job_count": self.job_count, "job_no": self.job_no, "sampling_step": self.sampling_step,
+                              "sampling_steps": self.sampling_steps, "interrupted": self.interrupted, "skipped": self.skipped}}
+
+
+def make_image(seed: int, width: int, height: int) -> Image.Image:
+    '''
+    Makes a cheap synthetic image which is the same for the same seed and size
+
+    Args:
+        seed (int): random seed
+        width (int): image width
+        height (int): image height
+
+    Returns:
+        Image.Image: the image
+    '''
+    rng = np.random.default_rng(seed)
+    cells = rng.integers(0, 256, size=(8, 8, 3), dtype=np.uint8)
+    return Image.fromarray(cells).resize((width, height), Image.NEAREST)
+
+
+def encode_image(image: Image.Image) -> str:
+    buffered = io.BytesIO()
+    image.save(buffered, format="PNG")
+    return str(base64.b64encode(buffered.getvalue()), "utf-8")
+
+
+def decode_image(data: str) -> Image.Image:
+    if data.startswith("data:"):
+        data = data.split(",", 1)[1]
+    return Image.open(io.BytesIO(base64.b64decode(data)))
+
+
+def make_handler(config: MockA1111Config) -> type:
+    '''
+    Creates a request handler class bound to a configuration
+
+    Args:
+        config (MockA1111Config): server behaviour
+
+    Returns:
+        type: a JsonRequestHandler subclass
+    '''
+    gpu = MockGpu(config.gpu_slots)
+    options: Dict[str, Any] = {"sd_model_checkpoint": config.sd_models[0]}
+
+    class MockA1111Handler(JsonRequestHandler):
+        GEN_PATHS = ["/sdapi/v1/txt2img", "/sdapi/v1/img2img", "/controlnet/txt2img", "/controlnet/img2img"]
+
+        def handle_get(self, path: str):
+            if path == "/sdapi/v1/progress":
+                ret = gpu.get_progress()
+                skip_image = "skip_current_image=true" in self.path.lower()
+                ret["current_image"] = encode_image(ret["current_image"]) if ret["current_image"] is not None and not skip_image else None
+                self.send_json(200, ret)
+            elif path == "/sdapi/v1/sd-models":
+                self.send_json(200, [{"title": model, "model_name": model.split(" ")[0].rsplit(".", 1)[0], "hash": None, "filename": model}
+                                     for model in config.sd_models])
+            elif path == "/sdapi/v1/options":
+                self.send_json(200, options)
+            elif path == "/controlnet/model_list":
+                self.send_json(200, {"model_list": config.controlnet_models})
+            elif path == "/controlnet/module_list":
+                self.send_json(200, {"module_list": config.controlnet_modules})
+            else:
+                super().handle_get(path)
+
+        def handle_post(self, path: str, body: Dict[str, Any]):
+            if path == "/sdapi/v1/interrupt":
+                gpu.interrupt()
+                self.send_json(200, {})
+            elif path == "/sdapi/v1/skip":
+                gpu.skip()
+                self.send_json(200, {})
+            elif path == "/sdapi/v1/options":
+                options.update(body)
+                self.send_json(200, None)
+            elif path == "/controlnet/detect":
+                self._detect(body)
+            elif path in MockA1111Handler.GEN_PATHS:
+                self._generate(path, body)
+            else:
+                super().handle_post(path, body)
+
+        def _send_fault(self) -> bool:
+            fault = config.faults.pick_fault()
+            if fault:
+                self.send_json(fault, {"error": "MockError", "detail": "Injected fault (mock)"},
+                               headers={"Retry-After": str(config.faults.retry_after)} if fault == 429 else None)
+            return bool(fault)
+
+        def _generate(self, path: str, body: Dict[str, Any]):
+            if self._send_fault():
+                return
+            checkpoint = (body.get("override_settings") or {}).get("sd_model_checkpoint")
+            if checkpoint and checkpoint not in config.sd_models:
+                return self.send_json(404, {"error": "HTTPException", "detail": f"Model not found: {checkpoint}"})
+            for unit in (body.get("controlnet_units") or []):
+                if unit.get("model") not in config.controlnet_models + ["None", None]:
+                    return self.send_json(404, {"error": "HTTPException", "detail": f"ControlNet model not found: {unit.get('model')}"})
+
+            width, height = int(body.get("width", 512)), int(body.get("height", 512))
+            batch_size, n_iter = max(1, int(body.get("batch_size", 1))), max(1, int(body.get("n_iter", 1)))
+            seed = int(body.get("seed", -1))
+            if seed == -1:
+                seed = random.randrange(2**32)
+            all_seeds = [seed + idx for idx in range(batch_size * n_iter)]
+
+            def make_job_images(job_no: int) -> List[Image.Image]:
+                return [make_image(all_seeds[job_no * batch_size + idx], width, height) for idx in range(batch_size)]
+            images = gpu.run(steps=max(1, int(body.get("steps", 20))), job_count=n_iter, step_latency=config.step_latency, make_image=make_job_images)
+
+            info = {"prompt": body.get("prompt", ""), "negative_prompt": body.get("negative_prompt", ""), "seed": seed, "all_seeds": all_seeds[:len(images)],
+                    "width": width, "height": height, "batch_size": batch_size, "sd_model_hash": None, "job_timestamp": time.strftime("%Y%m%d%H%M%S")}
+            parameters = {key: value for key, value in body.items() if key not in ["init_images", "mask", "controlnet_units", "alwayson_scripts"]}
+            self.send_json(200, {"images": [encode_image(image) for image in images], "parameters": parameters, "info": json.dumps(info)})
+
+        def _detect(self, body: Dict[str, Any]):
+            if self._send_fault():
+                return
+            module = body.get("controlnet_module", "none")
+            if module not in config.controlnet_modules:
+                return self.send_json(404, {"detail": f"Module not available: {module}"})
+            config.detect_latency.sleep()
+            images = []
+            for data in body.get("controlnet_input_images", []):
+                image = decode_image(data)
+                images.append(encode_image(image.convert("L").convert("RGB")))
+            self.send_json(200, {"images": images, "info": "Success"})
+
+    return MockA1111Handler
+
+
+def add_args(parser: argparse.ArgumentParser):
+    ''' Adds the mock server configuration arguments to a parser '''
+    LatencyModel.add_args(parser, prefix="step-latency", default_mean=0.05, default_stddev=0.01)
+    LatencyModel.add_args(parser, prefix="detect-latency", default_mean=0.2, default_stddev=0.05)
+    FaultInjector.add_args(parser)
+    parser.add_argument("--gpu-slots", type=int, default=1, help="Number of generation requests processed at once")
+    parser.add_argument("--sd-models", nargs="+", default=MockA1111Config().sd_models, help="Checkpoint titles to report")
+    parser.add_argument("--controlnet-models", nargs="+", default=MockA1111Config().controlnet_models, help="ControlNet models to report")
+    parser.add_argument("--controlnet-modules", nargs="+", default=MockA1111Config().controlnet_modules, help="ControlNet modules to report")
+
+
+def config_from_args(args: argparse.Namespace) -> MockA1111Config:
+    ''' Creates a MockA1111Config from arguments added by add_args '''
+    return MockA1111Config(step_latency=LatencyModel.from_args(args, prefix="step-latency"),
+                           detect_latency=LatencyModel.from_args(args, prefix="detect-latency"),
+                           faults=FaultInjector.from_args(args),
+                           gpu_slots=args.gpu_slots,
+                           sd_models=args.sd_models,
+                           controlnet_models=args.controlnet_models,
+                           controlnet_modules=args.controlnet_modules)
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description="Mock AUTOMATIC1111 webui server",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--verbose', '-v', help="Verbose", action='store_true', default=False)
+    parser.add_argument("--host", default="127.0.0.1", help="Host to listen on")
+    parser.add_argument("--port", type=int, default=7860, help="Port to listen on")
+    add_args(parser)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO if args.verbose else logging.WARNING)
+
+    server, thread = start_server(make_handler(config_from_args(args)), host=args.host, port=args.port, daemon=False)
+    print(f"Mock AUTOMATIC1111 server listening. Use --image-gen-webui-host={args.host} --image-gen-webui-port={args.port}")
+    try:
+        thread.join()
+    except KeyboardInterrupt:
+        server.shutdown()
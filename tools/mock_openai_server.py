@@ -0,0 +1,146 @@
+''' Local stand-in for the OpenAI ChatCompletion API, for load testing without cost or rate limits '''
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import sys
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Dict, List
+
+from mock_utils import FaultInjector, JsonRequestHandler, LatencyModel, start_server
+
+logger = logging.getLogger(__file__)
+
+
+@dataclass
+class MockOpenAiConfig:
+    latency: LatencyModel = field(default_factory=LatencyModel)
+    token_latency: LatencyModel = field(default_factory=LatencyModel)
+    faults: FaultInjector = field(default_factory=FaultInjector)
+    reply_words: int = 40
+
+
+def make_handler(config: MockOpenAiConfig) -> type:
+    '''
+    Creates a request handler class bound to a configuration
+
+    Args:
+        config (MockOpenAiConfig): server behaviour
+
+    Returns:
+        type: a JsonRequestHandler subclass
+    '''
+    class MockOpenAiHandler(JsonRequestHandler):
+        CHAT_PATHS = ["/v1/chat/completions", "/chat/completions"]
+
+        def handle_get(self, path: str):
+            if path in ["/v1/models", "/models"]:
+                self.send_json(200, {"object": "list", "data": [{"id": "gpt-3.5-turbo", "object": "model"}]})
+            else:
+                super().handle_get(path)
+
+        def handle_post(self, path: str, body: Dict[str, Any]):
+            if path not in MockOpenAiHandler.CHAT_PATHS:
+                return super().handle_post(path, body)
+
+            config.latency.sleep()
+            fault = config.faults.pick_fault()
+            if fault == 429:
+                return self.send_json(429, {"error": {"message": "Rate limit reached (mock)", "type": "requests", "param": None, "code": None}},
+                                      headers={"Retry-After": str(config.faults.retry_after)})
+            elif fault:
+                return self.send_json(fault, {"error": {"message": "The server had an error (mock)", "type": "server_error", "param": None, "code": None}})
+
+            words = self._build_reply(body.get("messages", []))
+            if body.get("stream", False):
+                self._send_stream(body, words)
+            else:
+                self._send_completion(body, words)
+
+        def _build_reply(self, messages: List[Dict[str, str]]) -> List[str]:
+            ''' Returns the words of a canned reply to the last message '''
+            last = messages[-1]["content"] if messages else ""
+            words = f"Mock reply to: {last}".split()
+            filler = ["lorem", "ipsum", "dolor", "sit", "amet."]
+            while len(words) < config.reply_words:
+                words.append(filler[len(words) % len(filler)])
+            return words[:max(config.reply_words, 1)]
+
+        def _send_completion(self, body: Dict[str, Any], words: List[str]):
+            prompt_tokens = sum(len(msg.get("content", "").split()) for msg in body.get("messages", []))
+            self.send_json(200, {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "gpt-3.5-turbo"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(words), "total_tokens": prompt_tokens + len(words)}
+            })
+
+        def _send_stream(self, body: Dict[str, Any], words: List[str]):
+            ''' Sends the reply as server-sent events, one word per chunk '''
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+            completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+            deltas = [{"role": "assistant"}] + [{"content": f"{word} "} for word in words] + [{}]
+            for idx, delta in enumerate(deltas):
+                if 0 < idx < len(deltas) - 1:
+                    config.token_latency.sleep()
+                chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                         "model": body.get("model", "gpt-3.5-turbo"),
+                         "choices": [{"index": 0, "delta": delta, "finish_reason": "stop" if idx == len(deltas) - 1 else None}]}
+                self._write_chunk(f"data: {json.dumps(chunk)}\n\n")
+            self._write_chunk("data: [DONE]\n\n")
+            self._write_chunk("")
+
+        def _write_chunk(self, text: str):
+            data = text.encode("utf-8")
+            self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+    return MockOpenAiHandler
+
+
+def add_args(parser: argparse.ArgumentParser):
+    ''' Adds the mock server configuration arguments to a parser '''
+    LatencyModel.add_args(parser, prefix="latency", default_mean=1.0, default_stddev=0.25)
+    LatencyModel.add_args(parser, prefix="token-latency", default_mean=0.02, default_stddev=0.005)
+    FaultInjector.add_args(parser)
+    parser.add_argument("--reply-words", type=int, default=40, help="Number of words in each reply")
+
+
+def config_from_args(args: argparse.Namespace) -> MockOpenAiConfig:
+    ''' Creates a MockOpenAiConfig from arguments added by add_args '''
+    return MockOpenAiConfig(latency=LatencyModel.from_args(args, prefix="latency"),
+                            token_latency=LatencyModel.from_args(args, prefix="token-latency"),
+                            faults=FaultInjector.from_args(args),
+                            reply_words=args.reply_words)
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description="Mock OpenAI ChatCompletion server",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--verbose', '-v', help="Verbose", action='store_true', default=False)
+    parser.add_argument("--host", default="127.0.0.1", help="Host to listen on")
+    parser.add_argument("--port", type=int, default=5990, help="Port to listen on")
+    add_args(parser)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO if args.verbose else logging.WARNING)
+
+    server, thread = start_server(make_handler(config_from_args(args)), host=args.host, port=args.port, daemon=False)
+    print(f"Mock OpenAI server listening. Use --openai-api-base=http://{args.host}:{args.port}/v1")
+    try:
+        thread.join()
+    except KeyboardInterrupt:
+        server.shutdown()
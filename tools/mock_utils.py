@@ -0,0 +1,165 @@
+''' Shared helpers for the local mock servers '''
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import math
+import random
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__file__)
+
+
+@dataclass
+class LatencyModel:
+    '''
+    A configurable latency distribution, in seconds
+    '''
+    DISTRIBUTIONS = ["fixed", "uniform", "normal", "lognormal", "exponential"]
+
+    distribution: str = "fixed"
+    mean: float = 0.0
+    stddev: float = 0.0
+    minimum: float = 0.0
+
+    def sample(self) -> float:
+        ''' Returns a latency drawn from the distribution '''
+        if self.distribution == "fixed":
+            value = self.mean
+        elif self.distribution == "uniform":
+            value = random.uniform(self.mean - self.stddev, self.mean + self.stddev)
+        elif self.distribution == "normal":
+            value = random.gauss(self.mean, self.stddev)
+        elif self.distribution == "lognormal":
+            # Parameterize by the mean/stddev of the resulting distribution rather than of the underlying normal
+            if self.mean <= 0:
+                value = 0.0
+            else:
+                sigma_sq = math.log(1 + (self.stddev / self.mean) ** 2)
+                value = random.lognormvariate(math.log(self.mean) - sigma_sq / 2, math.sqrt(sigma_sq))
+        elif self.distribution == "exponential":
+            value = random.expovariate(1 / self.mean) if self.mean > 0 else 0.0
+        else:
+            raise Exception(f"Unsupported latency distribution: {self.distribution}")
+        return max(self.minimum, value)
+
+    def sleep(self) -> float:
+        ''' Sleeps for a sampled latency and returns how long was slept '''
+        value = self.sample()
+        if value > 0:
+            time.sleep(value)
+        return value
+
+    @classmethod
+    def add_args(cls, parser: argparse.ArgumentParser, prefix: str = "latency", default_mean: float = 0.5, default_stddev: float = 0.1):
+        ''' Adds command line arguments for configuring a LatencyModel '''
+        parser.add_argument(f"--{prefix}-dist", choices=LatencyModel.DISTRIBUTIONS, default="normal",
+                            help="Latency distribution")
+        parser.add_argument(f"--{prefix}-mean", type=float, default=default_mean, help="Mean latency (seconds)")
+        parser.add_argument(f"--{prefix}-stddev", type=float, default=default_stddev, help="Latency standard deviation (seconds)")
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace, prefix: str = "latency") -> LatencyModel:
+        ''' Creates a LatencyModel from arguments added by add_args '''
+        prefix = prefix.replace("-", "_")
+        return LatencyModel(distribution=getattr(args, f"{prefix}_dist"),
+                            mean=getattr(args, f"{prefix}_mean"),
+                            stddev=getattr(args, f"{prefix}_stddev"))
+
+
+@dataclass
+class FaultInjector:
+    '''
+    Randomly decides whether a request should fail, and how
+    '''
+    rate_limit_rate: float = 0.0
+    server_error_rate: float = 0.0
+    retry_after: int = 1
+
+    def pick_fault(self) -> Optional[int]:
+        ''' Returns an HTTP error status to respond with, or None to respond normally '''
+        roll = random.random()
+        if roll < self.rate_limit_rate:
+            return 429
+        if roll < self.rate_limit_rate + self.server_error_rate:
+            return random.choice([500, 502, 503])
+        return None
+
+    @classmethod
+    def add_args(cls, parser: argparse.ArgumentParser):
+        ''' Adds command line arguments for configuring a FaultInjector '''
+        parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of requests answered with a 429")
+        parser.add_argument("--server-error-rate", type=float, default=0.0, help="Fraction of requests answered with a 5xx")
+        parser.add_argument("--retry-after", type=int, default=1, help="Retry-After header value on 429 responses")
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> FaultInjector:
+        ''' Creates a FaultInjector from arguments added by add_args '''
+        return FaultInjector(rate_limit_rate=args.rate_limit_rate, server_error_rate=args.server_error_rate,
+                             retry_after=args.retry_after)
+
+
+class JsonRequestHandler(BaseHTTPRequestHandler):
+    '''
+    Base request handler with JSON helpers. Subclasses implement handle_get/handle_post
+    '''
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args):
+        logger.info(f"{self.address_string()} - {format % args}")
+
+    def read_json(self) -> Dict[str, Any]:
+        ''' Reads and decodes the JSON request body '''
+        length = int(self.headers.get("Content-Length", 0))
+        if length == 0:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    def send_json(self, status: int, body: Any, headers: Optional[Dict[str, str]] = None):
+        ''' Sends a JSON response '''
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.handle_get(self.path.split("?")[0])
+
+    def do_POST(self):
+        self.handle_post(self.path.split("?")[0], self.read_json())
+
+    def handle_get(self, path: str):
+        self.send_json(404, {"detail": "Not Found"})
+
+    def handle_post(self, path: str, body: Dict[str, Any]):
+        self.send_json(404, {"detail": "Not Found"})
+
+
+def start_server(handler_class: type, host: str, port: int, daemon: bool = True) -> Tuple[ThreadingHTTPServer, threading.Thread]:
+    '''
+    Starts a threaded HTTP server on a background thread
+
+    Args:
+        handler_class (type): request handler class
+        host (str): host to bind to
+        port (int): port to bind to, 0 for any free port
+        daemon (bool, optional): if True the server thread will not keep the process alive
+
+    Returns:
+        Tuple[ThreadingHTTPServer, threading.Thread]: the server and the thread running it
+    '''
+    server = ThreadingHTTPServer((host, port), handler_class)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name=f"{handler_class.__name__}_server", daemon=daemon)
+    thread.start()
+    logger.info(f"{handler_class.__name__} listening on {server.server_address[0]}:{server.server_address[1]}")
+    return server, thread